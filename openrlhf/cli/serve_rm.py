@@ -1,5 +1,7 @@
 import argparse
+import asyncio
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import uvicorn
@@ -9,6 +11,7 @@ from fastapi.responses import JSONResponse
 from openrlhf.models import get_llm_for_sequence_regression
 from openrlhf.utils import get_tokenizer
 from openrlhf.utils.logging_utils import init_logger
+from openrlhf.utils.remote_rm_utils import TOKEN_IDS_CONTENT_TYPE, RewardCache, decode_token_ids
 
 logger = init_logger(__name__)
 
@@ -45,12 +48,7 @@ class RewardModelProxy:
         self.max_length = args.max_len
         self.batch_size = args.batch_size
 
-    def get_reward(self, queries, prompts):
-        if self.batch_size is None:
-            batch_size = len(queries)
-        else:
-            batch_size = self.batch_size
-
+    def preprocess_queries(self, queries):
         # remove pad_token
         for i in range(len(queries)):
             queries[i] = (
@@ -58,6 +56,15 @@ class RewardModelProxy:
                 + self.tokenizer.eos_token
             )
         logger.info(f"queries[0]: {queries[0]}")
+        return queries
+
+    def get_reward(self, queries, prompts):
+        if self.batch_size is None:
+            batch_size = len(queries)
+        else:
+            batch_size = self.batch_size
+
+        queries = self.preprocess_queries(queries)
 
         scores = []
         # batch
@@ -71,6 +78,43 @@ class RewardModelProxy:
                 scores.extend(r)
         return scores
 
+    def get_reward_ids(self, batch_ids):
+        batch_size = self.batch_size or len(batch_ids)
+        scores = []
+        for i in range(0, len(batch_ids), batch_size):
+            scores.extend(self.score_ids(batch_ids[i : i + batch_size]))
+        return scores
+
+    def normalize_ids(self, ids):
+        """Token ids counterpart of `preprocess_queries` followed by `tokenize_ids`."""
+        special_ids = (self.tokenizer.pad_token_id, self.tokenizer.eos_token_id)
+        start, end = 0, len(ids)
+        while start < end and ids[start] in special_ids:
+            start += 1
+        while end > start and ids[end - 1] in special_ids:
+            end -= 1
+        return (ids[start:end] + [self.tokenizer.eos_token_id])[: self.max_length]
+
+    def tokenize_ids(self, queries):
+        return self.tokenizer(
+            self.preprocess_queries(queries),
+            add_special_tokens=False,
+            max_length=self.max_length,
+            truncation=True,
+        )["input_ids"]
+
+    def score_ids(self, batch_ids):
+        """Scores of a batch of token ids, left padded like `tokenize_fn`."""
+        max_len = max(len(ids) for ids in batch_ids)
+        input_ids = torch.full((len(batch_ids), max_len), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch_ids), max_len), dtype=torch.long)
+        for i, ids in enumerate(batch_ids):
+            input_ids[i, max_len - len(ids) :] = torch.tensor(ids)
+            attention_mask[i, max_len - len(ids) :] = 1
+        with torch.no_grad():
+            r = self.reward_model(input_ids.to(self.reward_model.device), attention_mask.to(self.reward_model.device))
+        return r.tolist()
+
     def tokenize_fn(self, texts, device):
         batch = self.tokenizer(
             texts,
@@ -83,6 +127,126 @@ class RewardModelProxy:
         return {k: v.to(device) for k, v in batch.items()}
 
 
+class RewardBatchScheduler:
+    """
+    Batch the queries of all concurrent requests to the reward model.
+
+    The queries of every request are tokenized and queued. A background task collects queued queries until
+    `max_batch_tokens` tokens are pending or the oldest query has waited `max_wait_ms`. It then sorts them
+    by length and splits them into micro-batches whose padded size stays within `max_batch_tokens` (and at
+    most `max_batch_size` queries). The model runs in a worker thread so the event loop keeps accepting
+    requests, and every caller gets the scores of its own queries. `metrics` reports the queue depth and
+    how well the batches are filled.
+    """
+
+    def __init__(self, reward_model: RewardModelProxy, max_batch_tokens: int, max_wait_ms: float, max_batch_size=None):
+        self.reward_model = reward_model
+        self.max_batch_tokens = max_batch_tokens
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.task = None
+
+        self.queued_tokens = 0
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_queries = 0
+        self.num_tokens = 0
+        self.num_padded_tokens = 0
+        self.total_wait = 0.0
+
+    async def get_reward(self, queries):
+        return await self.get_reward_ids(self.reward_model.tokenize_ids(queries))
+
+    async def get_reward_ids(self, batch_ids):
+        if self.task is None:
+            self.queue = asyncio.Queue()
+            self.task = asyncio.get_running_loop().create_task(self.run())
+
+        loop = asyncio.get_running_loop()
+        futures = []
+        for ids in batch_ids:
+            future = loop.create_future()
+            self.queue.put_nowait((ids, future, loop.time()))
+            self.queued_tokens += len(ids)
+            futures.append(future)
+        self.num_requests += 1
+        return list(await asyncio.gather(*futures))
+
+    async def collect(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        num_tokens = len(batch[0][0])
+        deadline = batch[0][2] + self.max_wait
+        while num_tokens < self.max_batch_tokens:
+            try:
+                item = self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            batch.append(item)
+            num_tokens += len(item[0])
+        self.queued_tokens -= num_tokens
+        return batch
+
+    def micro_batches(self, batch):
+        # sorted by decreasing length, the padded size of a micro-batch is its first length times its size
+        batch = sorted(batch, key=lambda item: len(item[0]), reverse=True)
+        micro_batch = []
+        for item in batch:
+            if micro_batch and (
+                len(micro_batch[0][0]) * (len(micro_batch) + 1) > self.max_batch_tokens
+                or (self.max_batch_size and len(micro_batch) >= self.max_batch_size)
+            ):
+                yield micro_batch
+                micro_batch = []
+            micro_batch.append(item)
+        yield micro_batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.collect()
+            for micro_batch in self.micro_batches(batch):
+                batch_ids = [ids for ids, _, _ in micro_batch]
+                now = loop.time()
+                try:
+                    scores = await loop.run_in_executor(self.executor, self.reward_model.score_ids, batch_ids)
+                except Exception as e:
+                    for _, future, _ in micro_batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+
+                for (_, future, _), score in zip(micro_batch, scores):
+                    if not future.done():
+                        future.set_result(score)
+                self.num_batches += 1
+                self.num_queries += len(micro_batch)
+                self.num_tokens += sum(len(ids) for ids in batch_ids)
+                self.num_padded_tokens += len(batch_ids[0]) * len(batch_ids)
+                self.total_wait += sum(now - enqueue_time for _, _, enqueue_time in micro_batch)
+
+    def metrics(self):
+        num_batches = max(self.num_batches, 1)
+        return {
+            "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+            "queued_tokens": self.queued_tokens,
+            "num_requests": self.num_requests,
+            "num_batches": self.num_batches,
+            "queries_per_batch": self.num_queries / num_batches,
+            "batch_fill": self.num_padded_tokens / (num_batches * self.max_batch_tokens),
+            "padding_efficiency": self.num_tokens / max(self.num_padded_tokens, 1),
+            "mean_queue_wait_ms": 1000 * self.total_wait / max(self.num_queries, 1),
+        }
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     # Reward Model
@@ -100,6 +264,27 @@ if __name__ == "__main__":
     parser.add_argument("--flash_attn", action="store_true", default=False, help="Enable FlashAttention2")
     parser.add_argument("--disable_fast_tokenizer", action="store_true", default=False)
     parser.add_argument("--batch_size", type=int, default=None)
+    parser.add_argument(
+        "--max_batch_tokens",
+        type=int,
+        default=None,
+        help="Batch the queries of concurrent requests into micro-batches of at most this many padded tokens",
+    )
+    parser.add_argument(
+        "--max_wait_ms", type=float, default=5, help="Max time a query waits for other queries to batch with"
+    )
+    parser.add_argument(
+        "--reward_cache_size",
+        type=int,
+        default=0,
+        help="Cache the rewards of up to this many normalized queries in memory, disabled if 0",
+    )
+    parser.add_argument(
+        "--reward_cache_dir",
+        type=str,
+        default=None,
+        help="Persist the cached rewards to an on-disk cache in this directory, reused across restarts",
+    )
 
     # ModelScope parameters
     parser.add_argument("--use_ms", action="store_true", default=False)
@@ -116,14 +301,54 @@ if __name__ == "__main__":
     reward_model = RewardModelProxy(args)
     app = FastAPI()
 
+    scheduler = None
+    if args.max_batch_tokens:
+        scheduler = RewardBatchScheduler(reward_model, args.max_batch_tokens, args.max_wait_ms, args.batch_size)
+
+    reward_cache = None
+    if args.reward_cache_size or args.reward_cache_dir:
+        # the rewards only depend on the model and the normalized query
+        identity = [args.reward_pretrain, args.value_head_prefix, args.normalize_reward, args.max_len]
+        reward_cache = RewardCache(str(identity), args.reward_cache_size, args.reward_cache_dir)
+
+    async def compute_rewards(queries, prompts, token_ids):
+        if scheduler is not None:
+            return await (scheduler.get_reward_ids(queries) if token_ids else scheduler.get_reward(queries))
+        return reward_model.get_reward_ids(queries) if token_ids else reward_model.get_reward(queries, prompts)
+
     @app.post("/get_reward")
     async def get_reward(request: Request):
-        data = await request.json()
-        queries = data.get("query")
-        prompts = data.get("prompts")
-        rewards = reward_model.get_reward(queries, prompts)
+        # token ids of the RM tokenizer in the binary encoding of encode_token_ids, or texts in JSON
+        token_ids = request.headers.get("content-type") == TOKEN_IDS_CONTENT_TYPE
+        if token_ids:
+            queries = [reward_model.normalize_ids(ids) for ids in decode_token_ids(await request.body())]
+            prompts = None
+        else:
+            data = await request.json()
+            queries = data.get("query")
+            prompts = data.get("prompts")
+        if reward_cache is not None:
+            if not token_ids:
+                queries = reward_model.preprocess_queries(queries)
+            keys = [reward_cache.key(query) for query in queries]
+            rewards, missing = reward_cache.lookup(keys)
+            missing_rewards = []
+            if missing:
+                missing_rewards = await compute_rewards(
+                    [queries[i] for i in missing], [prompts[i] for i in missing] if prompts else prompts, token_ids
+                )
+            rewards = reward_cache.fill(keys, rewards, missing, missing_rewards)
+        else:
+            rewards = await compute_rewards(queries, prompts, token_ids)
         result = {"rewards": rewards}
         logger.info(f"Sent JSON: {result}")
         return JSONResponse(result)
 
+    @app.get("/metrics")
+    async def metrics():
+        result = scheduler.metrics() if scheduler is not None else {}
+        if reward_cache is not None:
+            result.update({f"reward_cache_{k}": v for k, v in reward_cache.stats().items()})
+        return JSONResponse(result)
+
     uvicorn.run(app, host=args.host, port=args.port, log_level="info")
@@ -202,6 +202,12 @@ if __name__ == "__main__":
 
     parser.add_argument("--max_samples", type=int, default=1e8, help="Max number of samples")
     parser.add_argument("--max_len", type=int, default=2048, help="Max tokens for the samples")
+    parser.add_argument(
+        "--dataset_cache_dir",
+        type=str,
+        default=None,
+        help="Directory of the tokenized dataset cache, reused by later runs with the same data and tokenizer",
+    )
 
     # wandb parameters
     parser.add_argument("--use_wandb", type=str, default=None)
@@ -195,6 +195,12 @@ if __name__ == "__main__":
         "--apply_chat_template", action="store_true", default=False, help="Use HF tokenizer chat template"
     )
     parser.add_argument("--max_len", type=int, default=2048, help="Max tokens for the samples")
+    parser.add_argument(
+        "--dataset_cache_dir",
+        type=str,
+        default=None,
+        help="Directory of the tokenized dataset cache, reused by later runs with the same data and tokenizer",
+    )
     parser.add_argument("--max_samples", type=int, default=1e8, help="Max number of samples")
 
     # wandb parameters
@@ -308,6 +308,12 @@ if __name__ == "__main__":
     parser.add_argument("--prompt_max_len", type=int, default=1024, help="Max tokens for each prompt")
     parser.add_argument("--generate_max_len", type=int, default=1024, help="Max tokens to generate in PPO")
     parser.add_argument("--max_len", type=int, default=None, help="deprecated max_len")
+    parser.add_argument(
+        "--dataset_cache_dir",
+        type=str,
+        default=None,
+        help="Directory of the tokenized dataset cache, reused by later runs with the same data and tokenizer",
+    )
     parser.add_argument("--max_samples", type=int, default=1000000)
     parser.add_argument("--max_norm", type=float, default=1.0, help="Gradient clipping")
     parser.add_argument("--l2", type=float, default=0.0, help="weight decay loss")
@@ -317,6 +323,18 @@ if __name__ == "__main__":
     parser.add_argument("--lambd", type=float, default=0.95, help="PPO GAE lambd")
     parser.add_argument("--gamma", type=float, default=1, help="PPO GAE gamma")
     parser.add_argument("--micro_train_batch_size", type=int, default=4, help="batch size per GPU")
+    parser.add_argument(
+        "--columnar_replay_buffer",
+        action="store_true",
+        default=False,
+        help="Store the replay buffer as flat columns instead of one item per sample",
+    )
+    parser.add_argument(
+        "--group_by_length",
+        action="store_true",
+        default=False,
+        help="Group replay buffer samples of similar length into the same micro batch to reduce padding",
+    )
     parser.add_argument("--train_batch_size", type=int, default=128, help="Global training batch size")
     parser.add_argument("--normalize_reward", action="store_true", default=False, help="Enable Reward Normazation")
     parser.add_argument("--top_p", type=float, default=1.0)
@@ -379,7 +397,63 @@ if __name__ == "__main__":
     # Models
     parser.add_argument("--pretrain", type=str, default=None, help="HF model name or path")
     parser.add_argument("--reward_pretrain", type=str, default=None, help="HF model name or path")
-    parser.add_argument("--remote_rm_url", type=str, default=None, help="remote RM API")
+    parser.add_argument(
+        "--remote_rm_url", type=str, default=None, help="remote RM API, replicas of the same RM separated by |"
+    )
+    parser.add_argument(
+        "--remote_rm_cache_size",
+        type=int,
+        default=0,
+        help="Cache the remote RM rewards of up to this many (query, prompt) pairs per process, disabled if 0",
+    )
+    parser.add_argument(
+        "--remote_rm_cache_dir",
+        type=str,
+        default=None,
+        help="Persist the remote RM rewards to an on-disk cache in this directory, reused across restarts",
+    )
+    parser.add_argument(
+        "--remote_rm_cache_namespace",
+        type=str,
+        default=None,
+        help=(
+            "Identity of the remote RM (e.g. model name and revision) in the reward cache keys, required with "
+            "--remote_rm_cache_dir so that a different RM served at the same URL does not reuse stale rewards"
+        ),
+    )
+    parser.add_argument(
+        "--remote_rm_chunk_size",
+        type=int,
+        default=None,
+        help="Max number of queries per remote RM request, by default a batch is split evenly across the replicas",
+    )
+    parser.add_argument(
+        "--remote_rm_max_concurrency", type=int, default=8, help="Max number of remote RM requests in flight"
+    )
+    parser.add_argument(
+        "--remote_rm_token_ids",
+        action="store_true",
+        default=False,
+        help="Send token ids instead of decoded texts to the remote RM, which must share the policy tokenizer",
+    )
+    parser.add_argument(
+        "--reward_func_num_workers",
+        type=int,
+        default=0,
+        help="Score the samples of a custom reward_func (--remote_rm_url *.py) over this many worker processes",
+    )
+    parser.add_argument(
+        "--reward_func_timeout",
+        type=float,
+        default=30,
+        help="Max seconds to score a chunk of samples with the custom reward_func, which then get a reward of 0",
+    )
+    parser.add_argument(
+        "--reward_func_chunk_size",
+        type=int,
+        default=1,
+        help="Number of samples passed to the custom reward_func at once, larger for batched reward functions",
+    )
     parser.add_argument("--critic_pretrain", type=str, default=None, help="HF model name or path")
     parser.add_argument("--value_head_prefix", type=str, default="score")
 
@@ -446,6 +520,9 @@ if __name__ == "__main__":
             "You likely want to pass $'\\n' in Bash or \"`n\" in PowerShell."
         )
 
+    if args.remote_rm_cache_dir:
+        assert args.remote_rm_cache_namespace, "--remote_rm_cache_dir requires --remote_rm_cache_namespace"
+
     if args.use_ms:
         from modelscope.utils.hf_util import patch_hub
 
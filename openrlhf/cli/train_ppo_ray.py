@@ -230,6 +230,36 @@ if __name__ == "__main__":
     )
     parser.add_argument("--vllm_sync_backend", type=str, default="nccl", help="DeepSpeed -> vLLM weight sync backend")
     parser.add_argument("--vllm_sync_with_ray", action="store_true", default=False)
+    parser.add_argument(
+        "--vllm_sync_bucket_mb",
+        type=int,
+        default=0,
+        help="Broadcast the weights to vLLM in flattened buckets of this size (MB), 0 to broadcast per parameter",
+    )
+    parser.add_argument(
+        "--vllm_streaming",
+        action="store_true",
+        default=False,
+        help="Make experiences from vLLM responses as they finish instead of waiting for the whole rollout",
+    )
+    parser.add_argument(
+        "--experience_pipeline_depth",
+        type=int,
+        default=1,
+        help="Number of micro batches whose ref/critic/reward forward are in flight while making experiences",
+    )
+    parser.add_argument(
+        "--async_rollout_staleness",
+        type=int,
+        default=0,
+        help="Generate the rollouts of the next steps with vLLM while training, at most this many steps behind the actor",
+    )
+    parser.add_argument(
+        "--async_rollout_max_importance_ratio",
+        type=float,
+        default=2.0,
+        help="Truncation of the importance ratio between the actor and the vLLM policy for async rollouts",
+    )
     parser.add_argument("--enable_prefix_caching", action="store_true", default=False)
     parser.add_argument("--enforce_eager", action="store_true", default=False, help="Disable CUDA graph in vLLM")
     parser.add_argument(
@@ -291,6 +321,12 @@ if __name__ == "__main__":
     parser.add_argument("--prompt_max_len", type=int, default=1024, help="Max tokens for each prompt")
     parser.add_argument("--generate_max_len", type=int, default=1024, help="Max tokens to generate in PPO")
     parser.add_argument("--max_len", type=int, default=None, help="deprecated max_len")
+    parser.add_argument(
+        "--dataset_cache_dir",
+        type=str,
+        default=None,
+        help="Directory of the tokenized dataset cache, reused by later runs with the same data and tokenizer",
+    )
     parser.add_argument("--max_samples", type=int, default=1e8, help="Max number of samples")
     parser.add_argument("--max_norm", type=float, default=1.0, help="Gradient clipping")
     parser.add_argument("--l2", type=float, default=0.0, help="weight decay loss")
@@ -300,6 +336,24 @@ if __name__ == "__main__":
     parser.add_argument("--lambd", type=float, default=0.95, help="PPO GAE lambd")
     parser.add_argument("--gamma", type=float, default=1, help="PPO GAE gamma")
     parser.add_argument("--micro_train_batch_size", type=int, default=4, help="batch size per GPU")
+    parser.add_argument(
+        "--columnar_replay_buffer",
+        action="store_true",
+        default=False,
+        help="Store the replay buffer as flat columns instead of one item per sample",
+    )
+    parser.add_argument(
+        "--group_by_length",
+        action="store_true",
+        default=False,
+        help="Group replay buffer samples of similar length into the same micro batch to reduce padding",
+    )
+    parser.add_argument(
+        "--train_max_tokens_per_gpu",
+        type=int,
+        default=None,
+        help="Token budget of a training micro batch with --packing_samples, replaces --micro_train_batch_size",
+    )
     parser.add_argument("--train_batch_size", type=int, default=128, help="Global training batch size")
     parser.add_argument("--normalize_reward", action="store_true", default=False, help="Enable Reward Normazation")
     parser.add_argument("--top_p", type=float, default=1.0)
@@ -341,7 +395,66 @@ if __name__ == "__main__":
     #  Models
     parser.add_argument("--pretrain", type=str, default=None, help="HF model name or path")
     parser.add_argument("--reward_pretrain", type=str, default=None, help="HF model name or path")
-    parser.add_argument("--remote_rm_url", type=str, default=None, help="remote RM API (HTTP)")
+    parser.add_argument(
+        "--remote_rm_url", type=str, default=None, help="remote RM API (HTTP), replicas of the same RM separated by |"
+    )
+    parser.add_argument(
+        "--remote_rm_cache_size",
+        type=int,
+        default=0,
+        help=(
+            "Cache the remote RM rewards of up to this many (query, prompt) pairs in memory, disabled if 0. "
+            "The memory cache is private to each Ray worker process, use --remote_rm_cache_dir to share it"
+        ),
+    )
+    parser.add_argument(
+        "--remote_rm_cache_dir",
+        type=str,
+        default=None,
+        help="Persist the remote RM rewards to an on-disk cache in this directory, reused across restarts",
+    )
+    parser.add_argument(
+        "--remote_rm_cache_namespace",
+        type=str,
+        default=None,
+        help=(
+            "Identity of the remote RM (e.g. model name and revision) in the reward cache keys, required with "
+            "--remote_rm_cache_dir so that a different RM served at the same URL does not reuse stale rewards"
+        ),
+    )
+    parser.add_argument(
+        "--remote_rm_chunk_size",
+        type=int,
+        default=None,
+        help="Max number of queries per remote RM request, by default a batch is split evenly across the replicas",
+    )
+    parser.add_argument(
+        "--remote_rm_max_concurrency", type=int, default=8, help="Max number of remote RM requests in flight"
+    )
+    parser.add_argument(
+        "--remote_rm_token_ids",
+        action="store_true",
+        default=False,
+        help="Send token ids instead of decoded texts to the remote RM, which must share the policy tokenizer",
+    )
+    parser.add_argument(
+        "--reward_func_num_workers",
+        type=int,
+        default=0,
+        help="Score the samples of a custom reward_func (--remote_rm_url *.py) over this many worker processes",
+    )
+    parser.add_argument(
+        "--reward_func_timeout",
+        type=float,
+        default=30,
+        help="Max seconds to score a chunk of samples with the custom reward_func, which then get a reward of 0",
+    )
+    parser.add_argument(
+        "--reward_func_chunk_size",
+        type=int,
+        default=1,
+        help="Number of samples passed to the custom reward_func at once, larger for batched reward functions",
+    )
     parser.add_argument("--critic_pretrain", type=str, default=None, help="HF model name or path")
     parser.add_argument("--value_head_prefix", type=str, default="score")
     parser.add_argument("--ref_reward_offload", action="store_true", default=False)
@@ -425,11 +538,27 @@ if __name__ == "__main__":
             args.flash_attn = True
         assert args.vllm_num_engines > 0, "Only support `--packing_samples` with vLLM."
         assert not args.pretrain_data, "`--pretrain_data` is not supported with `--packing_samples` yet."
+    elif args.train_max_tokens_per_gpu:
+        print("[Warning] --train_max_tokens_per_gpu only takes effect with --packing_samples.")
 
     if args.vllm_enable_sleep and not args.colocate_all_models:
         print("Set args.vllm_enable_sleep to False when args.colocate_all_models is disabled.")
         args.vllm_enable_sleep = False
 
+    if args.vllm_streaming and args.vllm_enable_sleep:
+        print("Set args.vllm_streaming to False when args.vllm_enable_sleep is enabled.")
+        args.vllm_streaming = False
+
+    if args.async_rollout_staleness > 0:
+        assert args.vllm_num_engines > 0, "Only support `--async_rollout_staleness` with vLLM."
+        assert not args.vllm_enable_sleep, "`--async_rollout_staleness` is not supported with `--vllm_enable_sleep`."
+        if args.vllm_streaming:
+            print("Set args.vllm_streaming to False when args.async_rollout_staleness is enabled.")
+            args.vllm_streaming = False
+
+    if args.remote_rm_cache_dir:
+        assert args.remote_rm_cache_namespace, "--remote_rm_cache_dir requires --remote_rm_cache_namespace"
+
     if args.use_ms:
         from modelscope.utils.hf_util import patch_hub
 
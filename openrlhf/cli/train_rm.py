@@ -78,6 +78,7 @@ def train(args):
         True,
         True,
         train_dataset.packing_collate_fn if args.packing_samples else train_dataset.collate_fn,
+        packing_max_tokens=args.packing_max_tokens if args.packing_samples else None,
     )
     eval_dataloader = strategy.setup_dataloader(
         eval_dataset,
@@ -85,10 +86,14 @@ def train(args):
         True,
         False,
         eval_dataset.packing_collate_fn if args.packing_samples else eval_dataset.collate_fn,
+        packing_max_tokens=args.packing_max_tokens if args.packing_samples else None,
     )
 
     # scheduler
-    num_update_steps_per_epoch = len(train_dataset) // args.train_batch_size
+    if args.packing_samples and args.packing_max_tokens:
+        num_update_steps_per_epoch = len(train_dataloader) // strategy.accumulated_gradient
+    else:
+        num_update_steps_per_epoch = len(train_dataset) // args.train_batch_size
     max_steps = math.ceil(args.max_epochs * num_update_steps_per_epoch)
 
     scheduler = get_scheduler(
@@ -208,6 +213,12 @@ if __name__ == "__main__":
 
     # packing samples using Flash Attention2
     parser.add_argument("--packing_samples", action="store_true", default=False)
+    parser.add_argument(
+        "--packing_max_tokens",
+        type=int,
+        default=None,
+        help="Plan the packs offline with at most this many tokens per micro batch, instead of packing micro_train_batch_size samples",
+    )
 
     # Custom dataset
     parser.add_argument("--dataset", type=str, default=None)
@@ -224,6 +235,12 @@ if __name__ == "__main__":
     parser.add_argument("--eval_split", type=str, default="test", help="test split of the dataset")
     parser.add_argument("--max_samples", type=int, default=1e8, help="Max number of samples")
     parser.add_argument("--max_len", type=int, default=512)
+    parser.add_argument(
+        "--dataset_cache_dir",
+        type=str,
+        default=None,
+        help="Directory of the tokenized dataset cache, reused by later runs with the same data and tokenizer",
+    )
 
     # wandb parameters
     parser.add_argument("--use_wandb", type=str, default=None)
@@ -5,7 +5,7 @@ from datetime import datetime
 
 from transformers.trainer import get_scheduler
 
-from openrlhf.datasets import SFTDataset
+from openrlhf.datasets import SFTDataset, StreamingSFTDataset
 from openrlhf.models import Actor
 from openrlhf.trainer import SFTTrainer
 from openrlhf.utils import blending_datasets, get_strategy, get_tokenizer
@@ -52,19 +52,34 @@ def train(args):
         max_count=args.max_samples,
         train_split=args.train_split,
         eval_split=args.eval_split,
+        streaming=args.streaming,
     )
-    train_data = train_data.select(range(min(args.max_samples, len(train_data))))
     eval_data = eval_data.select(range(min(args.max_samples, len(eval_data))))
-    train_dataset = SFTDataset(
-        train_data,
-        tokenizer,
-        args.max_len,
-        strategy,
-        pretrain_mode=args.pretrain_mode,
-        input_template=args.input_template,
-        multiple_of=args.ring_attn_size,
-        multiturn=args.multiturn,
-    )
+    if args.streaming:
+        # an epoch is max_samples samples of the stream, split between the data parallel ranks
+        train_dataset = StreamingSFTDataset(
+            train_data,
+            tokenizer,
+            args.max_len,
+            strategy,
+            int(args.max_samples) * args.ring_attn_size // strategy.world_size,
+            pretrain_mode=args.pretrain_mode,
+            input_template=args.input_template,
+            multiple_of=args.ring_attn_size,
+            multiturn=args.multiturn,
+        )
+    else:
+        train_data = train_data.select(range(min(args.max_samples, len(train_data))))
+        train_dataset = SFTDataset(
+            train_data,
+            tokenizer,
+            args.max_len,
+            strategy,
+            pretrain_mode=args.pretrain_mode,
+            input_template=args.input_template,
+            multiple_of=args.ring_attn_size,
+            multiturn=args.multiturn,
+        )
     eval_dataset = SFTDataset(
         eval_data,
         tokenizer,
@@ -83,6 +98,7 @@ def train(args):
         True,
         True,
         train_dataset.packing_collate_fn if args.packing_samples else train_dataset.collate_fn,
+        packing_max_tokens=args.packing_max_tokens if args.packing_samples else None,
     )
     eval_dataloader = strategy.setup_dataloader(
         eval_dataset,
@@ -90,10 +106,16 @@ def train(args):
         True,
         False,
         eval_dataset.packing_collate_fn if args.packing_samples else eval_dataset.collate_fn,
+        packing_max_tokens=args.packing_max_tokens if args.packing_samples else None,
     )
 
     # scheduler
-    num_update_steps_per_epoch = len(train_dataset) // args.train_batch_size
+    if args.streaming:
+        num_update_steps_per_epoch = int(args.max_samples) // args.train_batch_size
+    elif args.packing_samples and args.packing_max_tokens:
+        num_update_steps_per_epoch = len(train_dataloader) // strategy.accumulated_gradient
+    else:
+        num_update_steps_per_epoch = len(train_dataset) // args.train_batch_size
     max_steps = math.ceil(args.max_epochs * num_update_steps_per_epoch)
 
     scheduler = get_scheduler(
@@ -112,6 +134,8 @@ def train(args):
     if args.load_checkpoint and os.path.exists(args.ckpt_path):
         _, states = strategy.load_ckpt(model.model, args.ckpt_path)
         consumed_samples = states["consumed_samples"]
+        if args.streaming and "dataset_states" in states:
+            train_dataset.load_state_dict(states["dataset_states"][strategy.get_rank()])
         strategy.print(f"Loaded the checkpoint: {args.ckpt_path}, consumed_samples: {consumed_samples}")
 
     os.makedirs(args.save_path, exist_ok=True)
@@ -201,6 +225,12 @@ if __name__ == "__main__":
 
     # packing SFT samples without CrossAttention
     parser.add_argument("--packing_samples", action="store_true", default=False)
+    parser.add_argument(
+        "--packing_max_tokens",
+        type=int,
+        default=None,
+        help="Plan the packs offline with at most this many tokens per micro batch, instead of packing micro_train_batch_size samples",
+    )
 
     # custom dataset
     parser.add_argument("--dataset", type=str, default=None)
@@ -208,6 +238,18 @@ if __name__ == "__main__":
     parser.add_argument("--train_split", type=str, default="train", help="train split of the HF dataset")
     parser.add_argument("--eval_split", type=str, default="test", help="test split of the dataset")
     parser.add_argument("--multiturn", action="store_true", default=False, help="Use compacted multiturn dataset")
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        default=False,
+        help="Stream the train datasets instead of loading them in memory, an epoch is --max_samples samples (required)",
+    )
+    parser.add_argument(
+        "--lazy_sampler",
+        action="store_true",
+        default=False,
+        help="Shuffle with a lazily computed permutation instead of materializing the index list on every rank",
+    )
 
     parser.add_argument("--input_key", type=str, default="input", help="JSON dataset key")
     parser.add_argument("--output_key", type=str, default=None, help="JSON dataset key")
@@ -218,6 +260,12 @@ if __name__ == "__main__":
     parser.add_argument("--tokenizer_chat_template", type=str, default=None)
     parser.add_argument("--max_samples", type=int, default=1e8, help="Max number of samples")
     parser.add_argument("--max_len", type=int, default=2048, help="Max tokens for the samples")
+    parser.add_argument(
+        "--dataset_cache_dir",
+        type=str,
+        default=None,
+        help="Directory of the tokenized dataset cache, reused by later runs with the same data and tokenizer",
+    )
 
     # wandb parameters
     parser.add_argument("--use_wandb", type=str, default=None)
@@ -258,6 +306,14 @@ if __name__ == "__main__":
     if args.ring_attn_size > 1:
         assert args.packing_samples, "packing_samples must be enabled when using ring attention"
 
+    if args.streaming:
+        # the size of the stream is unknown, the epoch length and the LR schedule are derived from max_samples
+        assert args.max_samples != parser.get_default("max_samples"), "--streaming requires an explicit --max_samples"
+
+    if args.streaming and args.packing_max_tokens:
+        print("[Warning] --packing_max_tokens needs the lengths of all samples, disabled with --streaming.")
+        args.packing_max_tokens = None
+
     if args.use_ms:
         from modelscope.utils.hf_util import patch_hub
 
@@ -1,7 +1,7 @@
 from .process_reward_dataset import ProcessRewardDataset
 from .prompts_dataset import PromptDataset
 from .reward_dataset import RewardDataset
-from .sft_dataset import SFTDataset
+from .sft_dataset import SFTDataset, StreamingSFTDataset
 from .unpaired_preference_dataset import UnpairedPreferenceDataset
 
-__all__ = ["ProcessRewardDataset", "PromptDataset", "RewardDataset", "SFTDataset", "UnpairedPreferenceDataset"]
+__all__ = ["ProcessRewardDataset", "PromptDataset", "RewardDataset", "SFTDataset", "StreamingSFTDataset", "UnpairedPreferenceDataset"]
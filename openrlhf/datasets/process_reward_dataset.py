@@ -1,4 +1,5 @@
 import numbers
+import os
 from typing import Callable
 
 import torch
@@ -6,7 +7,7 @@ import torch.nn.functional as F
 from torch.utils.data import Dataset
 
 from openrlhf.utils.utils import convert_token_to_id
-from .utils import zero_pad_sequences
+from .utils import load_or_build_token_cache, preprocessing_fingerprint, zero_pad_sequences
 
 
 class ProcessRewardDataset(Dataset):
@@ -17,6 +18,10 @@ class ProcessRewardDataset(Dataset):
         dataset: dataset for reward model
         self.tokenizer: self.tokenizer for reward model
         self.max_length: max length of input
+
+    When `args.dataset_cache_dir` is set, the samples are tokenized once and stored there as memory-mapped
+    arrays of token ids, placeholder positions and label values, so that `__getitem__` only scatters the
+    labels at the placeholder positions.
     """
 
     def __init__(
@@ -26,6 +31,7 @@ class ProcessRewardDataset(Dataset):
         max_length: int,
         strategy,
         multiple_of=1,
+        num_processors=8,
     ) -> None:
         super().__init__()
         self.tokenizer = tokenizer
@@ -41,26 +47,41 @@ class ProcessRewardDataset(Dataset):
 
         self.placeholder_token_id = convert_token_to_id(self.placeholder_token, self.tokenizer)
 
+        self.token_cache = None
+        cache_dir = getattr(self.strategy.args, "dataset_cache_dir", None)
+        fingerprint = preprocessing_fingerprint(
+            dataset,
+            tokenizer,
+            type="process_reward",
+            max_length=max_length,
+            input_key=self.input_key,
+            label_key=self.label_key,
+            placeholder_token=self.placeholder_token,
+            reward_tokens=self.reward_tokens,
+        )
+        if cache_dir and fingerprint and len(dataset) > 0:
+            # hard labels are token ids, soft labels are reward values
+            hard_labels = isinstance(dataset[0][self.label_key][0], str)
+            self.token_cache = load_or_build_token_cache(
+                os.path.join(cache_dir, f"process_reward-{fingerprint}"),
+                lambda: dataset.map(self.process_data, remove_columns=dataset.column_names, num_proc=num_processors),
+                {"input_ids": "uint32", "label_positions": "int64", "label_values": "int64" if hard_labels else "float32"},
+                [],
+            )
+            self.num_samples = len(self.token_cache["input_ids.offsets"]) - 1
+            return
+
         # Store the processed data in class attributes
         self.inputs = dataset[self.input_key]
         self.labels = dataset[self.label_key]
 
     def __len__(self):
+        if self.token_cache is not None:
+            return self.num_samples
         length = len(self.inputs)
         return length
 
-    def __getitem__(self, idx):
-        input_token = self.tokenizer(
-            self.inputs[idx],
-            max_length=self.max_length,
-            padding=False,
-            truncation=True,
-            return_tensors="pt",
-            add_special_tokens=False,
-        )
-
-        input_ids = input_token["input_ids"]
-        label_values = self.labels[idx]
+    def label_tensor(self, label_values, dtype):
         assert isinstance(label_values, list), "labels should be a list of strings or numbers"
         if isinstance(label_values[0], str):
             label_tokens = []
@@ -71,10 +92,40 @@ class ProcessRewardDataset(Dataset):
                 label_tokens.append(convert_token_to_id(label, self.tokenizer))
 
             # label_tokens is list of token id (for '+', '-', etc)
-            label_tensor = torch.tensor(label_tokens, dtype=input_ids.dtype)
+            return torch.tensor(label_tokens, dtype=dtype)
         else:
             # label_values is list of float numbers (for reward values)
-            label_tensor = torch.tensor(label_values, dtype=torch.float)
+            return torch.tensor(label_values, dtype=torch.float)
+
+    def process_data(self, data):
+        """Tokenize a sample for the token cache, keeping the positions and values of its labels."""
+        input_ids = self.tokenizer(
+            data[self.input_key],
+            max_length=self.max_length,
+            padding=False,
+            truncation=True,
+            add_special_tokens=False,
+        )["input_ids"]
+        # the placeholder tokens at the end may be truncated, truncate the labels to match
+        label_positions = [i for i, token in enumerate(input_ids) if token == self.placeholder_token_id]
+        label_values = self.label_tensor(data[self.label_key], torch.long)[: len(label_positions)]
+        return {"input_ids": input_ids, "label_positions": label_positions, "label_values": label_values.tolist()}
+
+    def __getitem__(self, idx):
+        if self.token_cache is not None:
+            return self.get_cached_item(idx)
+
+        input_token = self.tokenizer(
+            self.inputs[idx],
+            max_length=self.max_length,
+            padding=False,
+            truncation=True,
+            return_tensors="pt",
+            add_special_tokens=False,
+        )
+
+        input_ids = input_token["input_ids"]
+        label_tensor = self.label_tensor(self.labels[idx], input_ids.dtype)
         # Motivation: inputs_ids maybe truncated to self.max_length, where placeholder_tokens at the end may be removed.
         # We should also truncate the labels to match the length of input_ids
         # Step 1: Create a mask for placeholder token positions
@@ -94,6 +145,19 @@ class ProcessRewardDataset(Dataset):
             labels,
         )
 
+    def get_cached_item(self, idx):
+        def cached(name):
+            offsets = self.token_cache[f"{name}.offsets"]
+            return self.token_cache[name][offsets[idx] : offsets[idx + 1]]
+
+        input_ids = torch.from_numpy(cached("input_ids").astype("int64")).unsqueeze(0)
+        label_positions = torch.from_numpy(cached("label_positions").copy())
+        label_values = torch.from_numpy(cached("label_values").copy())
+
+        labels = torch.full_like(input_ids, -100, dtype=label_values.dtype)
+        labels[0, label_positions] = label_values
+        return input_ids, torch.ones_like(input_ids), labels
+
     def collate_fn(self, item_list):
         input_ids = []
         input_masks = []
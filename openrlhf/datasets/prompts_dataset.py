@@ -1,7 +1,6 @@
 from torch.utils.data import Dataset
-from tqdm import tqdm
 
-from openrlhf.utils.logging_utils import make_progress_logger
+from .utils import load_or_build_dataset, preprocessing_fingerprint
 
 
 def preprocess_data(data, input_template=None, input_key="input", apply_chat_template=None) -> str:
@@ -24,7 +23,7 @@ class PromptDataset(Dataset):
     Args:
         dataset: dataset for PPO model
         tokenizer: tokenizer for PPO model
-        max_length: max length of input
+        max_length: max length of input, when set the prompts are also tokenized into `prompt_token_ids`
     """
 
     def __init__(
@@ -33,29 +32,54 @@ class PromptDataset(Dataset):
         tokenizer,
         strategy,
         input_template=None,
+        max_length=None,
+        num_processors=8,
     ) -> None:
         super().__init__()
         self.strategy = strategy
         self.tokenizer = tokenizer
+        self.max_length = max_length
 
         # chat_template
         self.input_template = input_template
-        input_key = getattr(self.strategy.args, "input_key", None)
-        apply_chat_template = getattr(self.strategy.args, "apply_chat_template", False)
+        self.input_key = getattr(self.strategy.args, "input_key", None)
+        self.apply_chat_template = getattr(self.strategy.args, "apply_chat_template", False)
 
-        if apply_chat_template:
-            apply_chat_template = self.tokenizer.apply_chat_template
+        if self.apply_chat_template:
+            self.apply_chat_template = self.tokenizer.apply_chat_template
 
-        self.prompts = []
-        log_progress = make_progress_logger(
-            len(dataset), log_every_percent=10, desc="Preprocessing data",
+        fingerprint = preprocessing_fingerprint(
+            dataset,
+            tokenizer,
+            type="prompt",
+            max_length=max_length,
+            input_template=input_template,
+            input_key=self.input_key,
+            apply_chat_template=bool(self.apply_chat_template),
         )
-        log_progress(0, force=True)
-        for step, data in enumerate(dataset, start=1):
-            prompt = preprocess_data(data, input_template, input_key, apply_chat_template)
-            data["prompt"] = prompt
-            self.prompts.append(data)
-            log_progress(step)
+        # the prompts are kept as Arrow-backed rows
+        self.prompts = load_or_build_dataset(
+            getattr(self.strategy.args, "dataset_cache_dir", None),
+            "prompt",
+            fingerprint,
+            lambda: dataset.map(self.process_batch, batched=True, num_proc=num_processors),
+        )
+
+    def process_batch(self, batch):
+        rows = [dict(zip(batch.keys(), values)) for values in zip(*batch.values())]
+        prompts = [
+            preprocess_data(data, self.input_template, self.input_key, self.apply_chat_template) for data in rows
+        ]
+        if not self.max_length:
+            return {"prompt": prompts}
+
+        prompt_token_ids = self.tokenizer(
+            prompts,
+            add_special_tokens=False,
+            max_length=self.max_length,
+            truncation=True,
+        )["input_ids"]
+        return {"prompt": prompts, "prompt_token_ids": prompt_token_ids}
 
     def __len__(self):
         length = len(self.prompts)
@@ -1,10 +1,17 @@
+import os
 from typing import Callable
 
+import numpy as np
 import torch
 import torch.nn.functional as F
 from torch.utils.data import Dataset
 
-from .utils import exist_and_not_none, zero_pad_sequences
+from .utils import (
+    exist_and_not_none,
+    load_or_build_token_cache,
+    preprocessing_fingerprint,
+    zero_pad_sequences,
+)
 
 
 def preprocess_data(
@@ -54,6 +61,10 @@ class RewardDataset(Dataset):
         dataset: dataset for reward model
         self.tokenizer: self.tokenizer for reward model
         self.max_length: max length of input
+
+    When `args.dataset_cache_dir` is set, the samples are tokenized once and stored there as flat memory-mapped
+    token arrays: the ids shared by the chosen and rejected sequences once, followed by the two continuations.
+    `packing_collate_fn` then packs the chosen and rejected sequences of a batch without padding.
     """
 
     def __init__(
@@ -87,13 +98,39 @@ class RewardDataset(Dataset):
             if tokenizer_chat_template:
                 self.tokenizer.chat_template = tokenizer_chat_template
 
-        # Parallel loading datasets
-        processed_dataset = dataset.map(
-            self.process_data, remove_columns=dataset.column_names, num_proc=num_processors
+        fingerprint = preprocessing_fingerprint(
+            dataset,
+            tokenizer,
+            type="reward",
+            max_length=max_length,
+            input_template=input_template,
+            is_dpo=is_dpo,
+            prompt_key=self.prompt_key,
+            chosen_key=self.chosen_key,
+            rejected_key=self.rejected_key,
+            apply_chat_template=bool(self.apply_chat_template),
         )
-
-        # Filter out None values if necessary
-        processed_dataset = processed_dataset.filter(lambda x: x["prompt"] is not None)
+        cache_dir = getattr(self.strategy.args, "dataset_cache_dir", None)
+        self.token_cache = None
+        if cache_dir and fingerprint:
+            # token ids shared by chosen and rejected stored once, then the two continuations
+            self.token_cache = load_or_build_token_cache(
+                os.path.join(cache_dir, f"reward-tokens-{fingerprint}"),
+                lambda: self.tokenize_dataset(dataset, num_processors),
+                {"prefix_ids": "uint32", "chosen_ids": "uint32", "reject_ids": "uint32"},
+                ["extra"],
+            )
+            self.extras = self.token_cache["extra"]
+            return
+
+        processed_dataset = self.preprocess_dataset(dataset, num_processors)
+        # the samples are packed by token budget from their lengths, count them in the preprocessing workers
+        self.input_lengths = None
+        if getattr(self.strategy.args, "packing_samples", False) and getattr(
+            self.strategy.args, "packing_max_tokens", None
+        ):
+            processed_dataset = processed_dataset.map(self.count_tokens, batched=True, num_proc=num_processors)
+            self.input_lengths = processed_dataset["input_length"]
 
         # Store the processed data in class attributes
         self.prompts = processed_dataset["prompt"]
@@ -101,6 +138,37 @@ class RewardDataset(Dataset):
         self.rejects = processed_dataset["reject"]
         self.extras = processed_dataset["extra"]
 
+    def preprocess_dataset(self, dataset, num_processors):
+        # Parallel loading datasets
+        processed_dataset = dataset.map(
+            self.process_data, remove_columns=dataset.column_names, num_proc=num_processors
+        )
+
+        # Filter out None values if necessary
+        return processed_dataset.filter(lambda x: x["prompt"] is not None)
+
+    def tokenize_dataset(self, dataset, num_processors):
+        """Preprocess the dataset and tokenize every sample, for the token cache."""
+
+        def tokenize(data):
+            chosen_ids = self.tokenize(data["prompt"], data["chosen"])[0].tolist()
+            reject_ids = self.tokenize(data["prompt"], data["reject"])[0].tolist()
+            prefix_len = 0
+            for chosen_id, reject_id in zip(chosen_ids, reject_ids):
+                if chosen_id != reject_id:
+                    break
+                prefix_len += 1
+            return {
+                "prefix_ids": chosen_ids[:prefix_len],
+                "chosen_ids": chosen_ids[prefix_len:],
+                "reject_ids": reject_ids[prefix_len:],
+            }
+
+        processed_dataset = self.preprocess_dataset(dataset, num_processors)
+        return processed_dataset.map(
+            tokenize, remove_columns=["prompt", "chosen", "reject"], num_proc=num_processors
+        )
+
     def process_data(self, data):
         prompt, chosen, reject, margin = preprocess_data(
             data,
@@ -135,49 +203,76 @@ class RewardDataset(Dataset):
         }
 
     def __len__(self):
+        if self.token_cache is not None:
+            return len(self.extras)
         length = len(self.chosens)
         return length
 
-    def __getitem__(self, idx):
-        prompt, chosen, reject, extra = self.prompts[idx], self.chosens[idx], self.rejects[idx], self.extras[idx]
-
-        chosen = (prompt + chosen).rstrip("\n")
-        if not chosen.endswith(self.tokenizer.eos_token):
-            chosen += " " + self.tokenizer.eos_token
-        chosen_token = self.tokenizer(
-            chosen,
+    def sample_lengths(self):
+        """Number of tokens of every sample (chosen and rejected), used to plan the packing of the samples."""
+        if self.token_cache is not None:
+            return (
+                2 * np.diff(self.token_cache["prefix_ids.offsets"])
+                + np.diff(self.token_cache["chosen_ids.offsets"])
+                + np.diff(self.token_cache["reject_ids.offsets"])
+            ).tolist()
+
+        if self.input_lengths is None:
+            # not counted during preprocessing
+            batch = {"prompt": self.prompts, "chosen": self.chosens, "reject": self.rejects}
+            self.input_lengths = self.count_tokens(batch)["input_length"]
+        return list(self.input_lengths)
+
+    def count_tokens(self, batch):
+        num_tokens = [0] * len(batch["prompt"])
+        for responses in (batch["chosen"], batch["reject"]):
+            input_ids = self.tokenizer(
+                [self.format_text(prompt, response) for prompt, response in zip(batch["prompt"], responses)],
+                max_length=self.max_length,
+                padding=False,
+                truncation=True,
+                add_special_tokens=False,
+            )["input_ids"]
+            num_tokens = [n + len(ids) for n, ids in zip(num_tokens, input_ids)]
+        return {"input_length": num_tokens}
+
+    def format_text(self, prompt, response):
+        text = (prompt + response).rstrip("\n")
+        if not text.endswith(self.tokenizer.eos_token):
+            text += " " + self.tokenizer.eos_token
+        return text
+
+    def tokenize(self, prompt, response):
+        input_ids = self.tokenizer(
+            self.format_text(prompt, response),
             max_length=self.max_length,
             padding=False,
             truncation=True,
             return_tensors="pt",
             add_special_tokens=False,
-        )
+        )["input_ids"]
+        # to avoid EOS_token truncation
+        input_ids[0][-1] = self.tokenizer.eos_token_id
+        return input_ids
 
-        reject = (prompt + reject).rstrip("\n")
-        if not reject.endswith(self.tokenizer.eos_token):
-            reject += " " + self.tokenizer.eos_token
-        reject_token = self.tokenizer(
-            reject,
-            max_length=self.max_length,
-            padding=False,
-            truncation=True,
-            return_tensors="pt",
-            add_special_tokens=False,
-        )
+    def __getitem__(self, idx):
+        if self.token_cache is not None:
+            return self.get_cached_item(idx)
 
-        # to avoid EOS_token truncation
-        chosen_token["input_ids"][0][-1] = self.tokenizer.eos_token_id
-        reject_token["input_ids"][0][-1] = self.tokenizer.eos_token_id
-        chosen_token["attention_mask"][0][-1] = True
-        reject_token["attention_mask"][0][-1] = True
-
-        return (
-            chosen_token["input_ids"],
-            chosen_token["attention_mask"],
-            reject_token["input_ids"],
-            reject_token["attention_mask"],
-            extra,
-        )
+        prompt, chosen, reject, extra = self.prompts[idx], self.chosens[idx], self.rejects[idx], self.extras[idx]
+        chosen_ids = self.tokenize(prompt, chosen)
+        reject_ids = self.tokenize(prompt, reject)
+        return chosen_ids, torch.ones_like(chosen_ids), reject_ids, torch.ones_like(reject_ids), extra
+
+    def get_cached_item(self, idx):
+        def cached(name):
+            offsets = self.token_cache[f"{name}.offsets"]
+            return self.token_cache[name][offsets[idx] : offsets[idx + 1]]
+
+        prefix_ids = cached("prefix_ids")
+        chosen_ids = torch.from_numpy(np.concatenate([prefix_ids, cached("chosen_ids")]).astype("int64")).unsqueeze(0)
+        reject_ids = torch.from_numpy(np.concatenate([prefix_ids, cached("reject_ids")]).astype("int64")).unsqueeze(0)
+        return chosen_ids, torch.ones_like(chosen_ids), reject_ids, torch.ones_like(reject_ids), self.extras[idx].item()
 
     def collate_fn(self, item_list):
         chosen_ids = []
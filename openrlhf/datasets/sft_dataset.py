@@ -1,10 +1,12 @@
+import os
 from typing import Callable
 
+import numpy as np
 import torch
 import torch.nn.functional as F
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 
-from .utils import zero_pad_sequences
+from .utils import load_or_build_token_cache, preprocessing_fingerprint, zero_pad_sequences
 
 
 def preprocess_data(data, input_template=None, input_key="input", output_key=None, apply_chat_template=None, multiturn=False):
@@ -39,6 +41,9 @@ class SFTDataset(Dataset):
         dataset: dataset for SFT model
         tokenizer: tokenizer for SFT model
         max_length: max length of input
+
+    When `args.dataset_cache_dir` is set, the samples are tokenized once and stored there as a flat
+    memory-mapped token array, so that no tokenizer call happens in `__getitem__`.
     """
 
     def __init__(
@@ -54,6 +59,54 @@ class SFTDataset(Dataset):
         multiturn=False,
     ) -> None:
         super().__init__()
+        self.setup_preprocessing(tokenizer, max_length, strategy, input_template, pretrain_mode, multiple_of, multiturn)
+
+        self.token_cache = None
+        cache_dir = getattr(self.strategy.args, "dataset_cache_dir", None)
+        fingerprint = preprocessing_fingerprint(
+            dataset,
+            tokenizer,
+            type="sft",
+            max_length=max_length,
+            input_template=input_template,
+            pretrain_mode=pretrain_mode,
+            multiturn=multiturn,
+            input_key=self.input_key,
+            output_key=self.output_key,
+            apply_chat_template=bool(self.apply_chat_template),
+        )
+        if cache_dir and fingerprint:
+            ragged_columns = {"input_ids": "uint32"}
+            if self.multiturn:
+                ragged_columns["response_ranges"] = "int64"
+            self.token_cache = load_or_build_token_cache(
+                os.path.join(cache_dir, f"sft-{fingerprint}"),
+                lambda: self.tokenize_dataset(dataset, num_processors),
+                ragged_columns,
+                ["prompt_ids_len"],
+            )
+            self.prompt_ids_lens = self.token_cache["prompt_ids_len"]
+            return
+
+        # Parallel loading datasets
+        processed_dataset = self.preprocess_dataset(dataset, num_processors)
+        # the samples are packed by token budget from their lengths, count them in the preprocessing workers
+        self.input_lengths = None
+        if getattr(self.strategy.args, "packing_samples", False) and getattr(
+            self.strategy.args, "packing_max_tokens", None
+        ):
+            processed_dataset = processed_dataset.map(self.count_tokens, batched=True, num_proc=num_processors)
+            self.input_lengths = processed_dataset["input_length"]
+
+        # Store the processed data in class attributes
+        self.prompts = processed_dataset["prompt"]
+        self.responses = processed_dataset["response"]
+        self.prompt_ids_lens = processed_dataset["prompt_ids_len"]
+        self.response_ranges = processed_dataset["response_ranges"] if self.multiturn else None
+
+    def setup_preprocessing(
+        self, tokenizer, max_length, strategy, input_template, pretrain_mode, multiple_of, multiturn
+    ) -> None:
         self.tokenizer = tokenizer
         self.strategy = strategy
         self.pretrain_mode = pretrain_mode
@@ -73,19 +126,116 @@ class SFTDataset(Dataset):
             if tokenizer_chat_template:
                 self.tokenizer.chat_template = tokenizer_chat_template
 
-        # Parallel loading datasets
+    def preprocess_dataset(self, dataset, num_processors):
         processed_dataset = dataset.map(
             self.process_data, 
             remove_columns=dataset.column_names,
             num_proc=num_processors,
         )
-        processed_dataset = processed_dataset.filter(lambda x: x["prompt"] is not None)
+        return processed_dataset.filter(lambda x: x["prompt"] is not None)
+
+    def tokenize_dataset(self, dataset, num_processors):
+        """Preprocess the dataset and tokenize every sample, for the token cache."""
+        processed_dataset = self.preprocess_dataset(dataset, num_processors)
+        return processed_dataset.map(
+            lambda data: {"input_ids": self.tokenize(data["prompt"], data["response"])["input_ids"][0].tolist()},
+            remove_columns=["prompt", "response"],
+            num_proc=num_processors,
+        )
 
-        # Store the processed data in class attributes
-        self.prompts = processed_dataset["prompt"]
-        self.responses = processed_dataset["response"]
-        self.prompt_ids_lens = processed_dataset["prompt_ids_len"]
-        self.response_ranges = processed_dataset["response_ranges"] if self.multiturn else None
+    def multiturn_response_ranges(self, messages):
+        """
+        Token ranges of the assistant turns of a conversation.
+
+        The conversation is rendered once and tokenized once with the offsets mapping of the fast tokenizer,
+        then the character span of every assistant turn is mapped to tokens in a single pass. Falls back to
+        rendering and tokenizing every prefix when the tokenizer is not fast or the chat template does not
+        render the turns as a plain concatenation.
+
+        The ranges are clipped to `max_length`, the length the sample is truncated to, and the ranges starting
+        past it are dropped.
+        """
+        spans = self._assistant_char_spans(messages) if getattr(self.tokenizer, "is_fast", False) else None
+        if spans is None:
+            response_ranges = self._multiturn_response_ranges_by_prefix(messages)
+        else:
+            response_ranges = self._multiturn_response_ranges_by_offsets(messages, spans)
+        return [(start, min(end, self.max_length)) for start, end in response_ranges if start < self.max_length]
+
+    def _multiturn_response_ranges_by_offsets(self, messages, spans):
+        text = self.apply_chat_template(messages, tokenize=False)
+        offsets = self.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+
+        response_ranges = []
+        token_idx = 0
+        for span_start, span_end in spans:
+            # first token starting inside the response, then the first token starting after it
+            while token_idx < len(offsets) and offsets[token_idx][0] < span_start:
+                token_idx += 1
+            start_idx = token_idx
+            while token_idx < len(offsets) and offsets[token_idx][0] < span_end:
+                token_idx += 1
+            response_ranges.append((start_idx, token_idx - 1)) # left close right open
+        return response_ranges
+
+    def _assistant_char_spans(self, messages):
+        # Render a probe conversation to find the text the template puts before (generation prompt) and after
+        # an assistant content, then locate every assistant content in the full rendering.
+        probe_user = [{"role": "user", "content": "\x00"}]
+        probe_prompt = self.apply_chat_template(probe_user, tokenize=False, add_generation_prompt=True)
+        probe_chat = self.apply_chat_template(
+            probe_user + [{"role": "assistant", "content": "\x01"}], tokenize=False
+        )
+        if not probe_chat.startswith(probe_prompt) or probe_chat.count("\x01") != 1:
+            return None
+        turn_prefix, turn_suffix = probe_chat[len(probe_prompt) :].split("\x01")
+
+        text = self.apply_chat_template(messages, tokenize=False)
+        spans, cursor = [], 0
+        for message in messages:
+            content = message["content"]
+            if not isinstance(content, str) or not content:
+                return None
+            content_start = text.find(content, cursor)
+            if content_start < 0:
+                return None
+            cursor = content_start + len(content)
+            if message["role"] != "assistant":
+                continue
+            span_start, span_end = content_start - len(turn_prefix), cursor + len(turn_suffix)
+            if text[span_start:content_start] != turn_prefix or text[cursor:span_end] != turn_suffix:
+                return None
+            spans.append((span_start, span_end))
+            cursor = span_end
+        return spans
+
+    def _multiturn_response_ranges_by_prefix(self, messages):
+        apply_chat_template = self.apply_chat_template
+        response_ranges = []
+        for idx, message in enumerate(messages):
+            if message['role'] == 'assistant':
+                prompt = apply_chat_template(messages[: idx], tokenize=False, add_generation_prompt=True)
+                response = apply_chat_template(messages[: idx + 1], tokenize=False)[len(prompt):]
+
+                start_idx = self.tokenizer(
+                    prompt,
+                    max_length=self.max_length,
+                    padding=False,
+                    truncation=True,
+                    return_tensors="pt",
+                    add_special_tokens=False,
+                )["attention_mask"].int().sum().item()
+                
+                end_idx = start_idx + self.tokenizer(
+                    response,
+                    max_length=self.max_length,
+                    padding=False,
+                    truncation=True,
+                    return_tensors="pt",
+                    add_special_tokens=False,
+                )["attention_mask"].int().sum().item() - 1
+                response_ranges.append((start_idx, end_idx)) # left close right open
+        return response_ranges
 
     def process_data(self, data):
         if self.multiturn and self.output_key:
@@ -94,33 +244,8 @@ class SFTDataset(Dataset):
         
         if self.multiturn:
             assert not self.output_key or not data[self.output_key], "You should put the whole trajactory into data[input_key] and do not set output_key"
-            input_key = self.input_key
-            apply_chat_template = self.apply_chat_template
-            response_ranges = []
-            for idx, message in enumerate(data[input_key]):
-                if message['role'] == 'assistant':
-                    prompt = apply_chat_template(data[input_key][: idx], tokenize=False, add_generation_prompt=True)
-                    response = apply_chat_template(data[input_key][: idx + 1], tokenize=False)[len(prompt):]
-
-                    start_idx = self.tokenizer(
-                        prompt,
-                        max_length=self.max_length,
-                        padding=False,
-                        truncation=True,
-                        return_tensors="pt",
-                        add_special_tokens=False,
-                    )["attention_mask"].int().sum().item()
-                    
-                    end_idx = start_idx + self.tokenizer(
-                        response,
-                        max_length=self.max_length,
-                        padding=False,
-                        truncation=True,
-                        return_tensors="pt",
-                        add_special_tokens=False,
-                    )["attention_mask"].int().sum().item() - 1
-                    response_ranges.append((start_idx, end_idx)) # left close right open
-                    
+            response_ranges = self.multiturn_response_ranges(data[self.input_key])
+
         prompt, response = preprocess_data(
             data,
             None if self.pretrain_mode else self.input_template,
@@ -150,23 +275,71 @@ class SFTDataset(Dataset):
         return {"prompt": prompt, "response": response, "prompt_ids_len": prompt_ids_len, "response_ranges": response_ranges if self.multiturn else None}
 
     def __len__(self):
+        if self.token_cache is not None:
+            return len(self.prompt_ids_lens)
         length = len(self.prompts)
         return length
 
     def __getitem__(self, idx):
-        prompt_ids_len = self.prompt_ids_lens[idx]
-        prompt = self.prompts[idx]
-        response = self.responses[idx]
+        if self.token_cache is not None:
+            return self.get_cached_item(idx)
 
-        if not self.pretrain_mode:
-            text = (prompt + response).rstrip("\n")
-            if not text.endswith(self.tokenizer.eos_token):
-                text += " " + self.tokenizer.eos_token
-        else:
-            text = prompt
+        response_ranges = self.response_ranges[idx] if self.multiturn else None
+        return self.make_item(self.prompts[idx], self.responses[idx], self.prompt_ids_lens[idx], response_ranges)
+
+    def make_item(self, prompt, response, prompt_ids_len, response_ranges=None):
+        input_token = self.tokenize(prompt, response)
+        info = {"input": prompt, "output": response, "input_length": input_token["attention_mask"].int().sum().item(), "response_ranges": response_ranges}
 
+        return prompt_ids_len, input_token["input_ids"], input_token["attention_mask"], info
+
+    def get_cached_item(self, idx):
+        # the texts are not kept with the token cache, "input" and "output" are None
+        offsets = self.token_cache["input_ids.offsets"]
+        input_ids = torch.from_numpy(self.token_cache["input_ids"][offsets[idx] : offsets[idx + 1]].astype("int64"))
+        input_ids = input_ids.unsqueeze(0)
+        attention_mask = torch.ones_like(input_ids)
+
+        response_ranges = None
+        if self.multiturn:
+            offsets = self.token_cache["response_ranges.offsets"]
+            response_ranges = self.token_cache["response_ranges"][offsets[idx] : offsets[idx + 1]]
+            response_ranges = response_ranges.reshape(-1, 2).tolist()
+        info = {"input": None, "output": None, "input_length": input_ids.numel(), "response_ranges": response_ranges}
+
+        return int(self.prompt_ids_lens[idx]), input_ids, attention_mask, info
+
+    def count_tokens(self, batch):
+        texts = [self.format_text(prompt, response) for prompt, response in zip(batch["prompt"], batch["response"])]
+        input_ids = self.tokenizer(
+            texts,
+            max_length=self.max_length,
+            padding=False,
+            truncation=True,
+            add_special_tokens=False,
+        )["input_ids"]
+        return {"input_length": [len(ids) for ids in input_ids]}
+
+    def sample_lengths(self):
+        """Number of tokens of every sample, used to plan the packing of the samples."""
+        if self.token_cache is not None:
+            return np.diff(self.token_cache["input_ids.offsets"]).tolist()
+        if self.input_lengths is None:
+            # not counted during preprocessing
+            self.input_lengths = self.count_tokens({"prompt": self.prompts, "response": self.responses})["input_length"]
+        return list(self.input_lengths)
+
+    def format_text(self, prompt, response):
+        if self.pretrain_mode:
+            return prompt
+        text = (prompt + response).rstrip("\n")
+        if not text.endswith(self.tokenizer.eos_token):
+            text += " " + self.tokenizer.eos_token
+        return text
+
+    def tokenize(self, prompt, response):
         input_token = self.tokenizer(
-            text,
+            self.format_text(prompt, response),
             max_length=self.max_length,
             padding=False,
             truncation=True,
@@ -178,9 +351,7 @@ class SFTDataset(Dataset):
             # to avoid EOS_token truncation
             input_token["input_ids"][0][-1] = self.tokenizer.eos_token_id
             input_token["attention_mask"][0][-1] = True
-        info = {"input": prompt, "output": response, "input_length": input_token["attention_mask"].int().sum().item(), "response_ranges": self.response_ranges[idx] if self.multiturn else None}
-
-        return prompt_ids_len, input_token["input_ids"], input_token["attention_mask"], info
+        return input_token
 
     def collate_fn(self, item_list):
         prompt_ids_lens = []
@@ -229,3 +400,80 @@ class SFTDataset(Dataset):
             packed_attention_masks = F.pad(packed_attention_masks, (0, padding_len), value=0)
 
         return prompt_ids_lens, packed_input_ids, packed_attention_masks, infos
+
+
+class StreamingSFTDataset(SFTDataset, IterableDataset):
+    """
+    SFT dataset over a streaming dataset, e.g. from `blending_datasets(..., streaming=True)`, for corpora that
+    do not fit in memory. The samples are preprocessed and tokenized on the fly.
+
+    Every epoch yields `num_samples` samples starting where the previous epoch stopped, and passes over the
+    stream again once it is exhausted, so that all ranks run the same number of steps. `state_dict` and
+    `load_state_dict` save and restore the position in the stream, to resume training without replaying it.
+    The position is tracked in the main process, i.e. with the default `num_workers=0` of the dataloader.
+
+    Args:
+        dataset: streaming dataset, already sharded for this rank
+        tokenizer: tokenizer for SFT model
+        max_length: max length of input
+        num_samples: number of samples of an epoch on this rank
+    """
+
+    def __init__(
+        self,
+        dataset,
+        tokenizer: Callable,
+        max_length: int,
+        strategy,
+        num_samples: int,
+        input_template=None,
+        pretrain_mode=False,
+        multiple_of=1,
+        multiturn=False,
+    ) -> None:
+        self.setup_preprocessing(tokenizer, max_length, strategy, input_template, pretrain_mode, multiple_of, multiturn)
+        self.dataset = dataset
+        self.num_samples = num_samples
+        self.num_passes = 0
+        self.position = 0  # samples yielded in the current epoch
+        self.iterator = None
+
+    def __len__(self):
+        return self.num_samples - self.position
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        num_workers, worker_id = (worker_info.num_workers, worker_info.id) if worker_info else (1, 0)
+        num_samples = len(range(worker_id, self.num_samples, num_workers))
+
+        empty_pass = False
+        while self.position < num_samples:
+            if self.iterator is None:
+                self.dataset.set_epoch(self.num_passes)
+                self.iterator = iter(self.dataset)
+            data = next(self.iterator, None)
+            if data is None:
+                # the stream is exhausted, pass over it again
+                if empty_pass:
+                    raise ValueError("The streaming dataset has no valid sample")
+                self.iterator = None
+                self.num_passes += 1
+                empty_pass = True
+                continue
+
+            data = self.process_data(data)
+            if data["prompt"] is None:
+                continue
+            empty_pass = False
+            self.position += 1
+            yield self.make_item(data["prompt"], data["response"], data["prompt_ids_len"], data["response_ranges"])
+        self.position = 0
+
+    def state_dict(self):
+        return {"dataset": self.dataset.state_dict(), "num_passes": self.num_passes, "position": self.position}
+
+    def load_state_dict(self, state_dict):
+        self.dataset.load_state_dict(state_dict["dataset"])
+        self.num_passes = state_dict["num_passes"]
+        self.position = state_dict["position"]
+        self.iterator = None
@@ -3,7 +3,7 @@ from typing import Callable
 import torch
 from torch.utils.data import Dataset
 
-from .utils import zero_pad_sequences
+from .utils import load_or_build_dataset, preprocessing_fingerprint, zero_pad_sequences
 
 
 def preprocess_data(
@@ -36,6 +36,9 @@ class UnpairedPreferenceDataset(Dataset):
     """
     Unpaired preference dataset for algorithm, like KTO
 
+    The samples are tokenized once in preprocessing. The mismatched prompt/response pairs of the KL term are
+    assembled in `collate_fn` from slices of the token ids of the batch, without calling the tokenizer.
+
     Args:
         dataset: raw dataset
         self.tokenizer: self.tokenizer for model
@@ -63,19 +66,38 @@ class UnpairedPreferenceDataset(Dataset):
             if tokenizer_chat_template:
                 self.tokenizer.chat_template = tokenizer_chat_template
 
+        fingerprint = preprocessing_fingerprint(
+            dataset,
+            tokenizer,
+            type="unpaired_preference",
+            max_length=max_length,
+            input_template=input_template,
+            input_key=self.input_key,
+            output_key=self.output_key,
+            label_key=self.label_key,
+            apply_chat_template=bool(self.apply_chat_template),
+            pretokenized=True,
+        )
+        processed_dataset = load_or_build_dataset(
+            getattr(self.strategy.args, "dataset_cache_dir", None),
+            "unpaired_preference",
+            fingerprint,
+            lambda: self.preprocess_dataset(dataset, num_processors),
+        )
+
+        # Store the processed data in class attributes
+        self.input_ids = processed_dataset["input_ids"]
+        self.labels = processed_dataset["label"]
+        self.prompt_ids_lens = processed_dataset["prompt_ids_len"]
+
+    def preprocess_dataset(self, dataset, num_processors):
         # Parallel loading datasets
         processed_dataset = dataset.map(
             self.process_data, remove_columns=dataset.column_names, num_proc=num_processors
         )
 
         # Filter out None values if necessary
-        processed_dataset = processed_dataset.filter(lambda x: x["prompt"] is not None)
-
-        # Store the processed data in class attributes
-        self.prompts = processed_dataset["prompt"]
-        self.responses = processed_dataset["response"]
-        self.labels = processed_dataset["label"]
-        self.prompt_ids_lens = processed_dataset["prompt_ids_len"]
+        return processed_dataset.filter(lambda x: x["prompt"] is not None)
 
     def process_data(self, data):
         prompt, response, label = preprocess_data(
@@ -93,51 +115,70 @@ class UnpairedPreferenceDataset(Dataset):
 
         # filter the sample whose length is greater than max_length (2 for answer length)
         if prompt_ids_len >= self.max_length - 2:
-            prompt = None
+            return {"prompt": None, "response": response, "label": label, "prompt_ids_len": prompt_ids_len, "input_ids": []}
+
+        text = (prompt + response).rstrip("\n")
+        if not text.endswith(self.tokenizer.eos_token):
+            text += " " + self.tokenizer.eos_token
+        # keep up to max_length response tokens, as the response may follow a shorter prompt in the KL pairs
+        input_ids = self.tokenizer(
+            text,
+            max_length=prompt_ids_len + self.max_length,
+            padding=False,
+            truncation=True,
+            add_special_tokens=False,
+        )["input_ids"]
 
-        return {"prompt": prompt, "response": response, "label": label, "prompt_ids_len": prompt_ids_len}
+        return {
+            "prompt": prompt,
+            "response": response,
+            "label": label,
+            "prompt_ids_len": prompt_ids_len,
+            "input_ids": input_ids,
+        }
 
     def __len__(self):
-        return len(self.prompts)
+        return len(self.input_ids)
 
     def __getitem__(self, index):
-        return self.prompts[index], self.responses[index], self.labels[index], self.prompt_ids_lens[index]
+        return self.input_ids[index], self.labels[index], self.prompt_ids_lens[index]
 
     def collate_fn(self, item_list):
-        def tokenizer(prompt, response):
-            text = (prompt + response).rstrip("\n")
-            if not text.endswith(self.tokenizer.eos_token):
-                text += " " + self.tokenizer.eos_token
-            inputs = self.tokenizer(
-                text,
-                max_length=self.max_length,
-                padding=False,
-                truncation=True,
-                return_tensors="pt",
-                add_special_tokens=False,
-            )
-
-            inputs["input_ids"][0][-1] = self.tokenizer.eos_token_id
-            inputs["attention_mask"][0][-1] = True
-            return inputs["input_ids"], inputs["attention_mask"]
-
-        tot_ids, tot_masks, tot_labels, prompt_ids_lens = [], [], [], []
-        for prompt, response, label, prompt_ids_len in item_list:
-            input_ids, attention_mask = tokenizer(prompt, response)
-            tot_ids.append(input_ids)
-            tot_masks.append(attention_mask)
-            tot_labels.append(label)
-            prompt_ids_lens.append(prompt_ids_len)
-
-        # add unmatched y'| x (used to estimate the KL divergence between policy and reference)
-        for idx in range(len(item_list)):
-            next_idx = (idx + 1) % len(item_list)
-            input_ids, attention_mask = tokenizer(item_list[idx][0], item_list[next_idx][1])
-            tot_ids.append(input_ids)
-            tot_masks.append(attention_mask)
-            tot_labels.append(-1)
-            prompt_ids_lens.append(item_list[idx][3])
-
-        input_ids = zero_pad_sequences(tot_ids, side="right", value=self.tokenizer.pad_token_id)
-        attention_mask = zero_pad_sequences(tot_masks, side="right")
-        return input_ids, attention_mask, torch.LongTensor(tot_labels), prompt_ids_lens
+        input_ids = [torch.tensor(ids) for ids, _, _ in item_list]
+        lengths = torch.tensor([ids.numel() for ids in input_ids])
+        prompt_ids_lens = [prompt_ids_len for _, _, prompt_ids_len in item_list]
+        input_ids = zero_pad_sequences(input_ids, side="right", value=self.tokenizer.pad_token_id)
+
+        # matched y | x, then unmatched y'| x (used to estimate the KL divergence between policy and reference)
+        batch_size = len(item_list)
+        response_idx = torch.cat([torch.arange(batch_size), torch.arange(1, batch_size + 1) % batch_size])
+        input_ids, lengths = self.concat_pairs(
+            input_ids, lengths, torch.tensor(prompt_ids_lens * 2), torch.arange(batch_size).repeat(2), response_idx
+        )
+        attention_mask = (torch.arange(input_ids.size(1)) < lengths.unsqueeze(1)).long()
+
+        labels = [label for _, label, _ in item_list] + [-1] * batch_size
+        return input_ids.unsqueeze(1), attention_mask.unsqueeze(1), torch.LongTensor(labels), prompt_ids_lens * 2
+
+    def concat_pairs(self, input_ids, lengths, prompt_ids_lens, prompt_idx, response_idx):
+        """
+        Concatenate the prompt of the samples `prompt_idx` with the response of the samples `response_idx`,
+        given the right padded token ids of the batch, truncated to max_length. Returns the right padded ids of
+        the pairs and their lengths.
+        """
+        prompt_lens = torch.minimum(prompt_ids_lens, lengths[prompt_idx])
+        response_starts = torch.minimum(prompt_ids_lens[response_idx], lengths[response_idx])
+        pair_lengths = (prompt_lens + lengths[response_idx] - response_starts).clamp(max=self.max_length)
+
+        # token t of a pair is token t of the prompt sample, then token t - prompt_len + response_start of the
+        # response sample
+        positions = torch.arange(pair_lengths.max()).unsqueeze(0)
+        in_prompt = positions < prompt_lens.unsqueeze(1)
+        rows = torch.where(in_prompt, prompt_idx.unsqueeze(1), response_idx.unsqueeze(1))
+        cols = torch.where(in_prompt, positions, positions - prompt_lens.unsqueeze(1) + response_starts.unsqueeze(1))
+        pair_ids = input_ids[rows, cols.clamp(max=input_ids.size(1) - 1)]
+
+        pair_ids = pair_ids.masked_fill(positions >= pair_lengths.unsqueeze(1), self.tokenizer.pad_token_id)
+        # to avoid EOS_token truncation
+        pair_ids[torch.arange(pair_ids.size(0)), pair_lengths - 1] = self.tokenizer.eos_token_id
+        return pair_ids, pair_lengths
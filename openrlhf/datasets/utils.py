@@ -1,6 +1,19 @@
+import hashlib
+import json
+import os
+import shutil
+import socket
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
 import torch
+import torch.distributed
 import torch.nn.functional as F
 
+from openrlhf.utils.logging_utils import init_logger
+
+logger = init_logger(__name__)
+
 
 def zero_pad_sequences(sequences, side: str = "left", value=0):
     assert side in ("left", "right")
@@ -15,3 +28,138 @@ def zero_pad_sequences(sequences, side: str = "left", value=0):
 
 def exist_and_not_none(d, key):
     return key in d and not d[key] is None
+
+
+def preprocessing_fingerprint(dataset, tokenizer, **kwargs) -> Optional[str]:
+    """
+    Hash of everything the preprocessing of a dataset depends on: the dataset fingerprint, the tokenizer,
+    its chat template and the preprocessing arguments in kwargs. Returns None if the dataset has no fingerprint.
+    """
+    dataset_fingerprint = getattr(dataset, "_fingerprint", None)
+    if dataset_fingerprint is None:
+        return None
+    state = {
+        "dataset": dataset_fingerprint,
+        "tokenizer": getattr(tokenizer, "name_or_path", None),
+        "vocab_size": len(tokenizer),
+        "chat_template": getattr(tokenizer, "chat_template", None),
+        **kwargs,
+    }
+    return hashlib.sha256(json.dumps(state, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def is_local_rank_0() -> bool:
+    """
+    Whether this process is the first rank of its node. The ranks are grouped by host name, as LOCAL_RANK
+    is not reliable (the Ray launcher sets it to 0 for every actor). Must be called by all ranks.
+    """
+    if not torch.distributed.is_initialized():
+        return True
+    hostnames = [None] * torch.distributed.get_world_size()
+    torch.distributed.all_gather_object(hostnames, socket.gethostname())
+    return hostnames.index(socket.gethostname()) == torch.distributed.get_rank()
+
+
+def write_token_cache(path: str, dataset, ragged_columns: Dict[str, str], columns: List[str]) -> None:
+    """
+    Write the columns of a processed dataset as flat arrays that can be memory-mapped: every ragged (list)
+    column as `<name>.bin` with the row offsets in `<name>.offsets.npy`, every scalar column as `<name>.npy`.
+    The cache is written to a temporary directory first and renamed to `path` once complete.
+    """
+    tmp_path = f"{path}.tmp-{socket.gethostname()}-{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+
+    files = {name: open(os.path.join(tmp_path, f"{name}.bin"), "wb") for name in ragged_columns}
+    offsets = {name: [0] for name in ragged_columns}
+    values = {name: [] for name in columns}
+    for batch in dataset.iter(batch_size=10000):
+        for name, dtype in ragged_columns.items():
+            for row in batch[name]:
+                row = np.asarray(row, dtype=dtype).reshape(-1)
+                files[name].write(row.tobytes())
+                offsets[name].append(offsets[name][-1] + row.size)
+        for name in columns:
+            values[name].extend(batch[name])
+
+    for name, f in files.items():
+        f.close()
+        np.save(os.path.join(tmp_path, f"{name}.offsets.npy"), np.asarray(offsets[name], dtype=np.int64))
+    for name in columns:
+        np.save(os.path.join(tmp_path, f"{name}.npy"), np.asarray(values[name]))
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump({"num_rows": len(dataset), "ragged_columns": ragged_columns, "columns": columns}, f)
+
+    _commit_cache(tmp_path, path)
+
+
+def _commit_cache(tmp_path: str, path: str) -> None:
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process has written the same cache in the meantime
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_token_cache(path: str) -> Dict[str, np.ndarray]:
+    """
+    Memory-map a cache written by `write_token_cache`. Ragged columns are returned as the flat array
+    under `<name>` and the row offsets under `<name>.offsets`.
+    """
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+
+    cache = {}
+    for name, dtype in meta["ragged_columns"].items():
+        cache[f"{name}.offsets"] = np.load(os.path.join(path, f"{name}.offsets.npy"), mmap_mode="r")
+        if cache[f"{name}.offsets"][-1] > 0:
+            cache[name] = np.memmap(os.path.join(path, f"{name}.bin"), dtype=dtype, mode="r")
+        else:
+            cache[name] = np.zeros(0, dtype=dtype)
+    for name in meta["columns"]:
+        cache[name] = np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+    return cache
+
+
+def load_or_build_token_cache(
+    path: str, build_dataset: Callable, ragged_columns: Dict[str, str], columns: List[str]
+) -> Dict[str, np.ndarray]:
+    """
+    Load the token cache at `path`, building it with `build_dataset()` on the first rank of every node if it
+    does not exist yet. Must be called by all ranks.
+    """
+    build = is_local_rank_0()
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        if build:
+            logger.info(f"Preprocessing cache miss, building {path}")
+            write_token_cache(path, build_dataset(), ragged_columns, columns)
+    else:
+        logger.info(f"Preprocessing cache hit, loading {path}")
+    if torch.distributed.is_initialized():
+        torch.distributed.barrier()
+    return load_token_cache(path)
+
+
+def load_or_build_dataset(cache_dir: Optional[str], name: str, fingerprint: Optional[str], build_dataset: Callable):
+    """
+    Return the preprocessed dataset saved in `cache_dir` by a previous run with the same fingerprint. Otherwise
+    build it with `build_dataset()` on the first rank of every node and save it for the other ranks and later
+    runs. Without `cache_dir` (or fingerprint), the dataset is simply built. Must be called by all ranks.
+    """
+    if not cache_dir or fingerprint is None:
+        return build_dataset()
+
+    from datasets import load_from_disk
+
+    path = os.path.join(cache_dir, f"{name}-{fingerprint}")
+    build = is_local_rank_0()
+    if not os.path.exists(os.path.join(path, "state.json")):
+        if build:
+            logger.info(f"Preprocessing cache miss, building {path}")
+            tmp_path = f"{path}.tmp-{socket.gethostname()}-{os.getpid()}"
+            build_dataset().save_to_disk(tmp_path)
+            _commit_cache(tmp_path, path)
+    else:
+        logger.info(f"Preprocessing cache hit, loading {path}")
+    if torch.distributed.is_initialized():
+        torch.distributed.barrier()
+    return load_from_disk(path)
@@ -296,6 +296,12 @@ class PRMLoss(nn.Module):
         self.placeholder_token_id = placeholder_token_id
         self.reward_token_ids = reward_token_ids
 
+        # label_map[token] is the class index of a reward token, other token ids are left unchanged
+        label_map = torch.arange(max(reward_token_ids) + 1 if reward_token_ids else 0)
+        if reward_token_ids:
+            label_map[reward_token_ids] = torch.arange(len(reward_token_ids))
+        self.register_buffer("label_map", label_map, persistent=False)
+
     def forward(self, inputs: torch.Tensor, logits: torch.Tensor, labels: torch.Tensor, *, return_acc: bool = False):
         placeholder_mask = inputs == self.placeholder_token_id
         logits = logits[placeholder_mask]
@@ -312,9 +318,10 @@ class PRMLoss(nn.Module):
         elif self.reward_token_ids is not None:
             # hard label with reward_token_ids set. (otherwise the whole vocab will be trained together.)
             logits = logits[..., self.reward_token_ids]
-            # this is slow....
-            for i, token in enumerate(self.reward_token_ids):
-                labels = torch.where(labels == token, i, labels)
+            if self.label_map.device != labels.device:
+                self.label_map = self.label_map.to(labels.device)
+            in_map = (labels >= 0) & (labels < self.label_map.numel())
+            labels = torch.where(in_map, self.label_map[labels.clamp(0, self.label_map.numel() - 1)], labels)
 
         loss = self.loss(logits, labels)
         if not return_acc:
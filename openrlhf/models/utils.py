@@ -1,3 +1,4 @@
+import math
 from typing import Optional, Tuple, Union
 
 import torch
@@ -42,6 +43,13 @@ def compute_reward(
     num_actions: Optional[Union[int, list[int]]] = None,
     reward_clip_range: Tuple[float, float] = None,
 ) -> Union[torch.Tensor, list[torch.Tensor]]:
+    """
+    Compute the per-token rewards: the KL penalty on every action plus the reward at the last action.
+
+    When the samples are packed (action_mask is None), kl is either the list of per-sample kl or
+    the concatenated (1, total_actions) kl tensor, and num_actions gives the length of each sample.
+    A list of per-sample rewards is returned in this case.
+    """
     if kl_coef <= 0.0:
         kl_coef = 0.0
 
@@ -64,16 +72,67 @@ def compute_reward(
 
         reward = last_reward + kl_reward
     else:
-        # TODO: write a more efficient version
-        reward = []
-        for i, (kl_seg, action_len) in enumerate(zip(kl, num_actions)):
-            kl_reward = -kl_coef * kl_seg
-            kl_reward[action_len - 1] += r[i]
-            reward.append(kl_reward)
+        # Packed samples: apply the KL penalty on the concatenated kl of all samples and add the
+        # terminal reward of every sample at its last action in a single scatter.
+        # The following code is equivalent to:
+        #
+        # reward = []
+        # for i, (kl_seg, action_len) in enumerate(zip(kl, num_actions)):
+        #     kl_reward = -kl_coef * kl_seg
+        #     kl_reward[action_len - 1] += r[i]
+        #     reward.append(kl_reward)
+        #
+        kl = torch.cat(kl) if isinstance(kl, list) else kl.flatten()
+        eos_indices = torch.tensor(num_actions, device=kl.device).cumsum(dim=0) - 1
+        reward = (-kl_coef * kl).index_add_(0, eos_indices, r.to(device=kl.device, dtype=kl.dtype))
+        reward = list(reward.split(num_actions))
 
     return reward
 
 
+def _discount_matrix(size: int, discount: float, device=None) -> torch.Tensor:
+    # M[k, t] = discount^(k - t) for k >= t, 0 otherwise
+    index = torch.arange(size, device=device)
+    exponent = (index.unsqueeze(1) - index.unsqueeze(0)).to(torch.float64)
+    decay = torch.pow(torch.tensor(discount, dtype=torch.float64, device=device), exponent.clamp(min=0))
+    return torch.where(exponent >= 0, decay, torch.zeros_like(decay)).float()
+
+
+def reverse_discounted_cumsum(x: torch.Tensor, discount: float, chunk_size: int = 256) -> torch.Tensor:
+    """
+    Compute y[:, t] = sum_{k >= t} discount^(k - t) * x[:, k] without a Python loop over time steps.
+
+    The last dimension is split into chunks of `chunk_size`. The discounted sums inside every chunk
+    are computed with one matmul against a (chunk_size, chunk_size) decay matrix, and the carry
+    between chunks is resolved with a second matmul over the chunk heads.
+
+    Args:
+        x: Tensor of shape (batch_size, length).
+        discount: Discount factor applied per step.
+        chunk_size: Size of the chunks, trading matmul size for the number of chunks.
+    """
+    x = x.float()
+    if discount == 1.0:
+        return x.flip(-1).cumsum(-1).flip(-1)
+
+    batch_size, length = x.shape
+    chunk_size = max(1, min(chunk_size, length))
+    num_chunks = math.ceil(length / chunk_size)
+
+    chunks = F.pad(x, (0, num_chunks * chunk_size - length)).view(batch_size, num_chunks, chunk_size)
+    # discounted sums restricted to each chunk
+    local = torch.matmul(chunks, _discount_matrix(chunk_size, discount, device=x.device))
+
+    # full discounted sums at the first position of each chunk
+    heads = torch.matmul(local[:, :, 0], _discount_matrix(num_chunks, discount**chunk_size, device=x.device))
+    carry = F.pad(heads[:, 1:], (0, 1))
+
+    steps_to_next_chunk = chunk_size - torch.arange(chunk_size, device=x.device, dtype=torch.float64)
+    carry_decay = torch.pow(discount, steps_to_next_chunk).float()
+    out = local + carry.unsqueeze(-1) * carry_decay
+    return out.view(batch_size, -1)[:, :length]
+
+
 def log_probs_from_logits(logits: torch.Tensor, labels: torch.Tensor) -> torch.Tensor:
     # https://github.com/OpenRLHF/OpenRLHF/pull/718#issuecomment-2641081881
     if logits.dtype in [torch.float32, torch.float64]:
@@ -9,7 +9,7 @@ from tqdm import tqdm
 
 from openrlhf.models import DPOLoss
 from openrlhf.models.utils import log_probs_from_logits
-from openrlhf.utils.distributed_sampler import DistributedSampler
+from openrlhf.utils.distributed_sampler import DistributedSampler, PackingBatchSampler
 
 
 class DPOTrainer(ABC):
@@ -130,6 +130,10 @@ class DPOTrainer(ABC):
                 self.train_dataloader.sampler.set_epoch(
                     epoch, consumed_samples=0 if epoch > start_epoch else consumed_samples
                 )
+            elif isinstance(self.train_dataloader.batch_sampler, PackingBatchSampler):
+                self.train_dataloader.batch_sampler.set_epoch(
+                    epoch, consumed_samples=0 if epoch > start_epoch else consumed_samples
+                )
 
             step_bar = tqdm(
                 range(self.train_dataloader.__len__()),
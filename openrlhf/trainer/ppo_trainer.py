@@ -14,7 +14,16 @@ from openrlhf.models import Actor, GPTLMLoss, PolicyLoss, ValueLoss
 from openrlhf.models.utils import masked_mean
 from openrlhf.utils.distributed_sampler import DistributedSampler
 from openrlhf.utils.logging_utils import make_progress_logger
-from .ppo_utils import AdaptiveKLController, Experience, FixedKLController, NaiveExperienceMaker, NaiveReplayBuffer
+from .ppo_utils import (
+    AdaptiveKLController,
+    ColumnarReplayBuffer,
+    Experience,
+    FixedKLController,
+    LengthGroupedBatchSampler,
+    NaiveExperienceMaker,
+    NaiveReplayBuffer,
+    TokenBudgetBatchSampler,
+)
 
 
 class PPOTrainer(ABC):
@@ -132,6 +141,9 @@ class PPOTrainer(ABC):
 
         self.freezing_actor_steps = getattr(self.args, "freezing_actor_steps", -1)
 
+        # weight of the current micro batch loss, see `update_loss_scale`
+        self.loss_scale = 1.0
+
         # Mixtral 8x7b
         self.aux_loss = self.args.aux_loss_coef > 1e-8
 
@@ -153,7 +165,10 @@ class PPOTrainer(ABC):
             reward_fn,
         )
         packing_samples = getattr(self.args, "packing_samples", False)
-        self.replay_buffer = NaiveReplayBuffer(
+        replay_buffer_cls = (
+            ColumnarReplayBuffer if getattr(self.args, "columnar_replay_buffer", False) else NaiveReplayBuffer
+        )
+        self.replay_buffer = replay_buffer_cls(
             micro_train_batch_size, buffer_limit, buffer_cpu_offload, packing_samples
         )
 
@@ -232,35 +247,29 @@ class PPOTrainer(ABC):
             )
             log_progress(0)
 
+            status = {}
             for episode_step, rand_prompts in enumerate(self.prompts_dataloader, start=1):
-                for i, experience in enumerate(
-                    self.experience_maker.make_experience_list(rand_prompts, **self.generate_kwargs)
-                ):
-                    if i == 0:
-                        output = self.tokenizer.batch_decode(
-                            experience.sequences[0].unsqueeze(0), skip_special_tokens=False,
-                        )[0]
-                        self.strategy.print(output)
-                        self.strategy.print("Reward: ", experience.info["reward"][0].item())
-                    self.replay_buffer.append(experience)
-
-                self.replay_buffer.normalize("advantages", self.strategy)
-                status = self.ppo_train(steps)
-                self.replay_buffer.clear()
-
-                if "kl" in status:
-                    self.kl_ctl.update(status["kl"], args.rollout_batch_size * args.n_samples_per_prompt)
-
-                # logs/checkpoints
-                client_states = {"consumed_samples": steps * args.rollout_batch_size}
-                self.save_logs_and_checkpoints(args, steps, status, client_states)
-
+                experiences = self.experience_maker.make_experience_list(rand_prompts, **self.generate_kwargs)
+                # async rollout: the first rollouts are still being generated, there is nothing to train on yet.
+                # `steps` only counts the rollouts trained on, so that consumed_samples never covers the prompts
+                # of rollouts still in flight, which are lost on resume.
+                if not experiences:
+                    log_progress(episode_step, msg="waiting for the first rollouts")
+                    continue
+
+                status = self.train_on_experiences(args, experiences, steps)
                 log_progress(episode_step, msg=f"reward: {status['reward']:.4f}")
 
                 steps = steps + 1
 
-            # save last checkpoint
-            client_states = {"consumed_samples": steps * args.rollout_batch_size}
+            # async rollout: train on the rollouts still in flight, so that none is dropped
+            while self.experience_maker.num_pending_rollouts() > 0:
+                experiences = self.experience_maker.make_experience_list(None, **self.generate_kwargs)
+                status = self.train_on_experiences(args, experiences, steps)
+                steps = steps + 1
+
+            # save last checkpoint, the rollouts of steps 1 to steps - 1 have been trained on
+            client_states = {"consumed_samples": (steps - 1) * args.rollout_batch_size}
             self.save_logs_and_checkpoints(
                 args, steps, status, client_states, force_save=True
             )
@@ -270,10 +279,56 @@ class PPOTrainer(ABC):
         if self._tensorboard is not None and self.strategy.is_rank_0():
             self._tensorboard.close()
 
-    def ppo_train(self, global_steps=0):
-        torch.cuda.empty_cache()
+    def train_on_experiences(self, args, experiences, steps) -> Dict[str, float]:
+        for i, experience in enumerate(experiences):
+            if i == 0:
+                output = self.tokenizer.batch_decode(
+                    experience.sequences[0].unsqueeze(0), skip_special_tokens=False,
+                )[0]
+                self.strategy.print(output)
+                self.strategy.print("Reward: ", experience.info["reward"][0].item())
+            self.replay_buffer.append(experience)
+
+        self.replay_buffer.normalize("advantages", self.strategy)
+        status = self.ppo_train(steps)
+        self.replay_buffer.clear()
+
+        if "kl" in status:
+            self.kl_ctl.update(status["kl"], args.rollout_batch_size * args.n_samples_per_prompt)
+
+        # logs/checkpoints
+        client_states = {"consumed_samples": steps * args.rollout_batch_size}
+        self.save_logs_and_checkpoints(args, steps, status, client_states)
+        return status
+
+    def replay_buffer_dataloader(self) -> DataLoader:
         # replay buffer may be empty at first, we should rebuild at each training
-        dataloader = DataLoader(
+        max_tokens = getattr(self.args, "train_max_tokens_per_gpu", None)
+        if max_tokens and self.replay_buffer.packing_samples:
+            batch_sampler = TokenBudgetBatchSampler(
+                self.replay_buffer.sequence_lengths(),
+                max_tokens,
+                num_actions=self.replay_buffer.num_actions(),
+                strategy=self.strategy,
+                multiple_of=self.strategy.accumulated_gradient,
+            )
+            return DataLoader(
+                self.replay_buffer,
+                batch_sampler=batch_sampler,
+                pin_memory=self.dataloader_pin_memory,
+                collate_fn=self.replay_buffer.collate_fn,
+            )
+        if getattr(self.args, "group_by_length", False):
+            batch_sampler = LengthGroupedBatchSampler(
+                self.replay_buffer.sequence_lengths(), self.replay_buffer.sample_batch_size, drop_last=True
+            )
+            return DataLoader(
+                self.replay_buffer,
+                batch_sampler=batch_sampler,
+                pin_memory=self.dataloader_pin_memory,
+                collate_fn=self.replay_buffer.collate_fn,
+            )
+        return DataLoader(
             self.replay_buffer,
             batch_size=self.replay_buffer.sample_batch_size,
             shuffle=True,
@@ -281,6 +336,26 @@ class PPOTrainer(ABC):
             pin_memory=self.dataloader_pin_memory,
             collate_fn=self.replay_buffer.collate_fn,
         )
+
+    def update_loss_scale(self, dataloader: DataLoader, experience: Experience) -> None:
+        """
+        Token budget minibatches hold different numbers of actions, so the token-mean loss of each
+        micro batch is weighted by its share of actions to keep every action weighted equally.
+        """
+        batch_sampler = dataloader.batch_sampler
+        if not isinstance(batch_sampler, TokenBudgetBatchSampler):
+            self.loss_scale = 1.0
+            return
+        if experience.is_padding:
+            # only run to keep the number of micro steps equal across ranks
+            self.loss_scale = 0.0
+            return
+        num_actions = sum(v.numel() for v in experience.advantages)
+        self.loss_scale = num_actions / batch_sampler.num_actions_per_batch
+
+    def ppo_train(self, global_steps=0):
+        torch.cuda.empty_cache()
+        dataloader = self.replay_buffer_dataloader()
         device = torch.cuda.current_device()
 
         status_list = []
@@ -294,7 +369,11 @@ class PPOTrainer(ABC):
         for _ in range(self.max_epochs):
             for experience in dataloader:
                 experience.to_device(device)
+                self.update_loss_scale(dataloader, experience)
                 status = self.training_step(experience, global_steps)
+                # the packed samples comes with no padding
+                if experience.attention_mask is not None:
+                    status["padding_efficiency"] = experience.attention_mask.float().mean().item()
 
                 # for DP
                 # weighted mean for kl
@@ -368,7 +447,7 @@ class PPOTrainer(ABC):
         else:
             aux_loss = 0
         loss = actor_loss + aux_loss * self.args.aux_loss_coef
-        self.strategy.backward(loss, self.actor, self.actor_optim)
+        self.strategy.backward(loss * self.loss_scale, self.actor, self.actor_optim)
 
         # ptx loss
         if self.pretrain_dataloader is not None:
@@ -453,7 +532,7 @@ class PPOTrainer(ABC):
         else:
             aux_loss = 0
         loss = critic_loss + aux_loss * self.args.aux_loss_coef
-        self.strategy.backward(loss, self.critic, self.critic_optim)
+        self.strategy.backward(loss * self.loss_scale, self.critic, self.critic_optim)
         self.strategy.optimizer_step(self.critic_optim, self.critic, self.critic_scheduler, name="critic")
 
         # status
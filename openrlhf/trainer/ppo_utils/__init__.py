@@ -1,6 +1,6 @@
 from .experience_maker import Experience, NaiveExperienceMaker, RemoteExperienceMaker
 from .kl_controller import AdaptiveKLController, FixedKLController
-from .replay_buffer import NaiveReplayBuffer
+from .replay_buffer import ColumnarReplayBuffer, LengthGroupedBatchSampler, NaiveReplayBuffer, TokenBudgetBatchSampler
 
 __all__ = [
     "Experience",
@@ -9,4 +9,7 @@ __all__ = [
     "AdaptiveKLController",
     "FixedKLController",
     "NaiveReplayBuffer",
+    "ColumnarReplayBuffer",
+    "LengthGroupedBatchSampler",
+    "TokenBudgetBatchSampler",
 ]
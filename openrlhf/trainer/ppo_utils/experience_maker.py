@@ -1,17 +1,27 @@
+import math
 import time
 from abc import ABC
+from collections import deque
 from copy import deepcopy
 from dataclasses import dataclass
-from typing import List, Optional, Tuple, Union
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
 
 import ray
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
 
 from openrlhf.models.actor import Actor
-from openrlhf.models.utils import compute_approx_kl, compute_reward, masked_mean, unpacking_samples
+from openrlhf.models.utils import (
+    compute_approx_kl,
+    compute_reward,
+    masked_mean,
+    reverse_discounted_cumsum,
+    unpacking_samples,
+)
 from openrlhf.utils.logging_utils import init_logger, make_progress_logger
-from openrlhf.utils.remote_rm_utils import remote_rm_fn, remote_rm_fn_ray
+from openrlhf.utils.remote_rm_utils import RewardFuncExecutor, remote_rm_fn, remote_rm_fn_ray
 
 logger = init_logger(__name__)
 
@@ -28,6 +38,14 @@ def pin_memory(tensor: Union[torch.Tensor, list[torch.Tensor]]):
     return tensor.pin_memory() if isinstance(tensor, torch.Tensor) else tensor
 
 
+def pad_unpacked_samples(tensors: list[torch.Tensor]) -> Tuple[torch.Tensor, torch.BoolTensor]:
+    """Right pad a list of 1D tensors to (B, max_len) and return it together with the mask of valid positions."""
+    lengths = torch.tensor([t.numel() for t in tensors], device=tensors[0].device)
+    padded = pad_sequence(tensors, batch_first=True)
+    mask = torch.arange(padded.size(1), device=padded.device).unsqueeze(0) < lengths.unsqueeze(1)
+    return padded, mask
+
+
 @dataclass
 class Experience:
     """Experience is a batch of data.
@@ -43,8 +61,10 @@ class Experience:
     attention_mask: (B, S)
     action_mask: (B, A)
     kl: (B, A)
+    importance_weights: (B, A), only set for off-policy (async) rollouts
 
     "A" is the number of actions.
+    is_padding: zero weighted minibatch only run to keep the number of micro steps equal across ranks
     """
 
     sequences: torch.Tensor
@@ -56,6 +76,8 @@ class Experience:
     action_mask: Optional[torch.BoolTensor]
     info: Optional[dict]
     kl: Optional[torch.Tensor] = None
+    importance_weights: Optional[torch.Tensor] = None
+    is_padding: bool = False
 
     @torch.no_grad()
     def to_device(self, device: torch.device):
@@ -67,6 +89,7 @@ class Experience:
         self.attention_mask = to(self.attention_mask, device)
         self.action_mask = to(self.action_mask, device)
         self.kl = to(self.kl, device)
+        self.importance_weights = to(self.importance_weights, device)
         self.info = {key: to(value, device) for key, value in self.info.items()}
         return self
 
@@ -79,6 +102,7 @@ class Experience:
         self.attention_mask = pin_memory(self.attention_mask)
         self.action_mask = pin_memory(self.action_mask)
         self.kl = pin_memory(self.kl)
+        self.importance_weights = pin_memory(self.importance_weights)
         self.info = {key: pin_memory(value) for key, value in self.info.items()}
         return self
 
@@ -105,6 +129,8 @@ class Samples:
     total_length: (B,), the total number of tokens in the sequences.
     prompts_batch: the prompts used to generate responses, toghether with any other
         information in the batch.
+    behavior_log_probs: (B, A) or (1, total_actions), the log probs of the actions under the
+        policy that generated them, only set for off-policy (async) rollouts.
     """
 
     sequences: torch.Tensor
@@ -115,6 +141,7 @@ class Samples:
     response_length: torch.Tensor
     total_length: torch.Tensor
     prompts_batch: list[dict]
+    behavior_log_probs: Optional[torch.Tensor] = None
 
 
 class NaiveExperienceMaker(ABC):
@@ -151,14 +178,31 @@ class NaiveExperienceMaker(ABC):
 
         # custom reward func for reinforced finetuning
         self.custom_reward_func = None
+        self.reward_func_executor = None
         if remote_rm_url and remote_rm_url[0].endswith(".py"):
-            print(f"Loading custom `reward_func(queries, prompts)` from {remote_rm_url[0]}")
-            import importlib.util
+            if getattr(strategy.args, "reward_func_num_workers", 0) > 0:
+                # score the samples over a pool of worker processes, the module is only loaded by the workers so
+                # that a crashing or hanging import does not take down this process
+                print(f"Scoring custom `reward_func(queries, prompts)` from {remote_rm_url[0]} in worker processes")
+                self.reward_func_executor = self.create_reward_func_executor(remote_rm_url[0])
+                self.custom_reward_func = self.reward_func_executor.get_rewards
+            else:
+                print(f"Loading custom `reward_func(queries, prompts)` from {remote_rm_url[0]}")
+                import importlib.util
 
-            spec = importlib.util.spec_from_file_location("reward_func", remote_rm_url[0])
-            reward_module = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(reward_module)
-            self.custom_reward_func = reward_module.reward_func
+                spec = importlib.util.spec_from_file_location("reward_func", remote_rm_url[0])
+                reward_module = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(reward_module)
+                self.custom_reward_func = reward_module.reward_func
+
+    def create_reward_func_executor(self, reward_func_path):
+        args = self.strategy.args
+        return RewardFuncExecutor(
+            reward_func_path,
+            args.reward_func_num_workers,
+            timeout=getattr(args, "reward_func_timeout", 30),
+            chunk_size=getattr(args, "reward_func_chunk_size", 1),
+        )
 
     # tokenizer
     def tokenize_fn(self, texts, max_length, padding=True, device=None):
@@ -180,6 +224,16 @@ class NaiveExperienceMaker(ABC):
         )
         return {k: v.to(device) for k, v in batch.items()}
 
+    def special_tokens(self, token_ids=False):
+        """Pad and EOS tokens (ids if token_ids) stripped from the queries for the remote RM cache keys."""
+        if token_ids:
+            return (self.tokenizer.pad_token_id, self.tokenizer.eos_token_id)
+        return (self.tokenizer.pad_token, self.tokenizer.eos_token)
+
+    def num_pending_rollouts(self) -> int:
+        """Number of rollouts sent but not made into experiences yet, only async rollouts leave some."""
+        return 0
+
     @torch.no_grad()
     def make_experience_list(self, prompts_batch: Union[dict, List[dict]], **generate_kwargs) -> List[Experience]:
         """
@@ -189,15 +243,21 @@ class NaiveExperienceMaker(ABC):
         Then, if we need certain processing for the rewards or do certain filtering, we can process the rollout as a whole.
         After that, we will calculate the advantages and returns for each experience.
         """
-        args = self.strategy.args
         if isinstance(prompts_batch, dict):
             prompts_batch = [prompts_batch]
         # generate responses
         samples_list = self.generate_samples(prompts_batch, **generate_kwargs)
         torch.distributed.barrier()
 
+        experiences = self.make_experiences(samples_list)
+        return self.compute_advantages_and_returns(experiences, **generate_kwargs)
+
+    @torch.no_grad()
+    def make_experiences(self, samples_list: List[Samples]) -> List[Experience]:
+        """
+        Turn every micro batch of samples into an experience, which is kept on CPU.
+        """
         experiences = []
-        
         log_progress = make_progress_logger(
             len(samples_list),
             log_every_percent=10,
@@ -207,7 +267,14 @@ class NaiveExperienceMaker(ABC):
         for step, samples in enumerate(samples_list, start=1):
             experiences.append(self.make_experience(samples).to_device("cpu"))
             log_progress(step)
+        return experiences
 
+    @torch.no_grad()
+    def compute_advantages_and_returns(self, experiences: List[Experience], **generate_kwargs) -> List[Experience]:
+        """
+        Shape the rewards of the whole rollout, then calculate the advantages and returns of every experience.
+        """
+        args = self.strategy.args
         experiences, rewards = self.process_experiences(experiences)
 
         # calculate return and advantages
@@ -242,6 +309,16 @@ class NaiveExperienceMaker(ABC):
             else:
                 raise Exception(f"Unkown advantage_estimator {self.advantage_estimator}")
 
+            # truncated importance sampling of the off-policy (async) rollout
+            if experience.importance_weights is not None:
+                if isinstance(experience.advantages, list):
+                    experience.advantages = [
+                        advantage * weight
+                        for advantage, weight in zip(experience.advantages, experience.importance_weights)
+                    ]
+                else:
+                    experience.advantages = experience.advantages * experience.importance_weights
+
             # calculate the return info.
             if not getattr(self, "packing_samples", False):
                 return_sums = reward.sum(dim=-1)
@@ -252,6 +329,7 @@ class NaiveExperienceMaker(ABC):
             experience.info["return"] = return_sums
             # remove unnecessary info
             experience.kl = None
+            experience.importance_weights = None
             del experience.info["num_actions"]
             experience.to_device("cpu")
         return experiences
@@ -322,14 +400,28 @@ class NaiveExperienceMaker(ABC):
         # rewards
         if self.remote_rm_url is not None:
             # remote RM
-            queries = self.tokenizer.batch_decode(sequences.cpu(), skip_special_tokens=False)
+            token_ids = getattr(self.strategy.args, "remote_rm_token_ids", False) and not self.custom_reward_func
+            if token_ids:
+                # send the unpadded token ids, skipping the decode and re-tokenization round trip
+                queries = [seq[mask.bool()].tolist() for seq, mask in zip(sequences.cpu(), attention_mask.cpu())]
+            else:
+                queries = self.tokenizer.batch_decode(sequences.cpu(), skip_special_tokens=False)
             if self.custom_reward_func:
                 r = self.custom_reward_func(queries, samples.prompts_batch).to(device=action_log_probs.device)
             else:
                 prompts = [prompt["prompt"] for prompt in samples.prompts_batch]
-                r = remote_rm_fn(self.remote_rm_url, queries=queries, prompts=prompts).to(
-                    device=action_log_probs.device
-                )
+                r = remote_rm_fn(
+                    self.remote_rm_url,
+                    queries=queries,
+                    prompts=prompts,
+                    cache_size=getattr(self.strategy.args, "remote_rm_cache_size", 0),
+                    cache_dir=getattr(self.strategy.args, "remote_rm_cache_dir", None),
+                    chunk_size=getattr(self.strategy.args, "remote_rm_chunk_size", None),
+                    max_concurrency=getattr(self.strategy.args, "remote_rm_max_concurrency", 8),
+                    token_ids=token_ids,
+                    special_tokens=self.special_tokens(token_ids),
+                    cache_namespace=getattr(self.strategy.args, "remote_rm_cache_namespace", None),
+                ).to(device=action_log_probs.device)
         else:
             # local RM
             r = self.reward_model(sequences, attention_mask)
@@ -420,8 +512,8 @@ class NaiveExperienceMaker(ABC):
                    + γ * (1 - λ) V2 + γ^2 * λ * (1 - λ) V3 + ...
 
         Input:
-        - values: Tensor of shape (batch_size, response_size)
-        - rewards: Tensor of shape (batch_size, response_size)
+        - values: Tensor of shape (batch_size, response_size) or list of (response_size,) when packing samples
+        - rewards: Tensor of shape (batch_size, response_size) or list of (response_size,) when packing samples
 
         Output:
         - advantages: Tensor of shape (batch_size, response_size)
@@ -429,30 +521,22 @@ class NaiveExperienceMaker(ABC):
         """
         if isinstance(values, list):
             # packing samples
-            # TODO: this is slow...
-            advantages = []
-            returns = []
-            for v, r in zip(values, rewards):
-                adv, ret = self.get_advantages_and_returns(v.unsqueeze(0), r.unsqueeze(0), action_mask, gamma, lambd)
-                advantages.append(adv.squeeze(0))
-                returns.append(ret.squeeze(0))
-            return advantages, returns
-
-        lastgaelam = 0
-        advantages_reversed = []
-        response_length = rewards.size(1)
+            # Compute all samples at once on a right padded view. Padded positions hold zero
+            # values and rewards, so they do not leak into the advantages of the valid positions.
+            num_actions = [v.numel() for v in values]
+            values, action_mask = pad_unpacked_samples(values)
+            rewards, _ = pad_unpacked_samples(rewards)
+            advantages, returns = self.get_advantages_and_returns(values, rewards, action_mask, gamma, lambd)
+            return list(advantages[action_mask].split(num_actions)), list(returns[action_mask].split(num_actions))
 
         # Mask invalid responses
         if action_mask is not None:
             values = action_mask * values
             rewards = action_mask * rewards
 
-        for t in reversed(range(response_length)):
-            nextvalues = values[:, t + 1] if t < response_length - 1 else 0.0
-            delta = rewards[:, t] + gamma * nextvalues - values[:, t]
-            lastgaelam = delta + gamma * lambd * lastgaelam
-            advantages_reversed.append(lastgaelam)
-        advantages = torch.stack(advantages_reversed[::-1], dim=1)
+        nextvalues = F.pad(values[:, 1:], (0, 1))
+        deltas = rewards + gamma * nextvalues - values
+        advantages = reverse_discounted_cumsum(deltas, gamma * lambd)
         returns = advantages + values
         return advantages.detach(), returns
 
@@ -468,7 +552,7 @@ class NaiveExperienceMaker(ABC):
         REINFORCE uses cumulative returns without the GAE (Generalized Advantage Estimation).
 
         Input:
-        - rewards: Tensor of shape (batch_size, response_size)
+        - rewards: Tensor of shape (batch_size, response_size) or list of (response_size,) when packing samples
         - action_mask: Tensor of shape (batch_size, response_size), binary mask
         - gamma: discount factor
 
@@ -478,27 +562,18 @@ class NaiveExperienceMaker(ABC):
 
         if isinstance(rewards, list):
             # packing samples
-            # TODO: this is slow...
-            returns = []
-            for r in rewards:
-                ret = self.get_cumulative_returns(r.unsqueeze(0), action_mask, gamma)
-                returns.append(ret.squeeze(0))
-            return returns
-
-        response_length = rewards.size(1)
-        returns = torch.zeros_like(rewards)
-        cumulative_return = torch.zeros(rewards.size(0), device=rewards.device)
+            # Compute all samples at once on a right padded view, see get_advantages_and_returns.
+            num_actions = [r.numel() for r in rewards]
+            rewards, action_mask = pad_unpacked_samples(rewards)
+            returns = self.get_cumulative_returns(rewards, action_mask, gamma)
+            return list(returns[action_mask].split(num_actions))
 
         # Mask invalid responses if action_mask is provided
         if action_mask is not None:
             rewards = action_mask * rewards
 
         # Calculate returns by accumulating discounted rewards
-        for t in reversed(range(response_length)):
-            cumulative_return = rewards[:, t] + gamma * cumulative_return
-            returns[:, t] = cumulative_return
-
-        return returns
+        return reverse_discounted_cumsum(rewards, gamma)
 
 
 class RemoteExperienceMaker(NaiveExperienceMaker):
@@ -506,10 +581,22 @@ class RemoteExperienceMaker(NaiveExperienceMaker):
         super().__init__(*args, **kwargs)
         self.vllm_engines = vllm_engines
         self.packing_samples = packing_samples
+        # vLLM rollouts sent but not made into experiences yet, see `make_experience_list_async`
+        self.pending_rollouts = deque()
 
-        if self.custom_reward_func:
+        if self.custom_reward_func and not self.reward_func_executor:
             self.custom_reward_func = ray.remote(self.custom_reward_func)
 
+    def create_reward_func_executor(self, reward_func_path):
+        # the executor runs in its own actor, so that its get_rewards returns object refs like the ray tasks
+        args = self.strategy.args
+        return ray.remote(RewardFuncExecutor).remote(
+            reward_func_path,
+            args.reward_func_num_workers,
+            timeout=getattr(args, "reward_func_timeout", 30),
+            chunk_size=getattr(args, "reward_func_chunk_size", 1),
+        )
+
     @torch.no_grad()
     def make_experience_list(self, all_prompts: Union[str, List[str]], **generate_kwargs) -> List[Experience]:
         if self.strategy.args.perf:
@@ -518,7 +605,12 @@ class RemoteExperienceMaker(NaiveExperienceMaker):
                 "actor_value_rm_time": 0,
                 "wait_time": 0,
             }
-        experiences = super().make_experience_list(all_prompts, **generate_kwargs)
+        if self.vllm_engines is not None and getattr(self.strategy.args, "async_rollout_staleness", 0) > 0:
+            experiences = self.make_experience_list_async(all_prompts, **generate_kwargs)
+        elif self.vllm_engines is not None and getattr(self.strategy.args, "vllm_streaming", False):
+            experiences = self.make_experience_list_streaming(all_prompts, **generate_kwargs)
+        else:
+            experiences = super().make_experience_list(all_prompts, **generate_kwargs)
         if self.critic is not None:
             for experience in experiences:
                 # send experience to critic
@@ -527,6 +619,42 @@ class RemoteExperienceMaker(NaiveExperienceMaker):
                 self._ref = self.critic.append.remote(experience_cpu)
         return experiences
 
+    @torch.no_grad()
+    def make_experience_list_async(self, all_prompts: Optional[List[dict]], **generate_kwargs) -> List[Experience]:
+        """
+        Off-policy rollout: the prompts are sent to the vLLM engines without waiting for the responses, and the
+        experiences are made from the oldest rollout in flight instead. That rollout is generated while the actor
+        trains, with the weights of up to `async_rollout_staleness` steps ago, so the advantages are reweighted
+        by the truncated importance ratio between the actor and the behavior policy.
+
+        An empty list is returned while the first `async_rollout_staleness` rollouts are in flight. With
+        `all_prompts` None, no rollout is sent and the experiences of the oldest rollout in flight are made,
+        to flush the rollouts at the end of an episode (see `num_pending_rollouts`).
+        """
+        if all_prompts is not None:
+            self.pending_rollouts.append(self._send_vllm_requests(all_prompts, **generate_kwargs))
+            if len(self.pending_rollouts) <= self.strategy.args.async_rollout_staleness:
+                return []
+
+        samples_list = self._receive_vllm_responses(*self.pending_rollouts.popleft())
+        experiences = self.make_experiences(samples_list)
+        return self.compute_advantages_and_returns(experiences, **generate_kwargs)
+
+    def num_pending_rollouts(self) -> int:
+        return len(self.pending_rollouts)
+
+    @torch.no_grad()
+    def make_experience_list_streaming(self, all_prompts: List[dict], **generate_kwargs) -> List[Experience]:
+        """
+        Make experiences from the vLLM micro batches as they finish, instead of waiting for the whole rollout.
+        """
+        # all the micro batches but the last are full, see `_generate_vllm_streaming`
+        num_samples = len(all_prompts) * self.strategy.args.n_samples_per_prompt
+        num_batches = math.ceil(num_samples / self.strategy.args.micro_rollout_batch_size)
+        experiences = self.make_experiences(self._generate_vllm_streaming(all_prompts, **generate_kwargs), num_batches)
+        torch.distributed.barrier()
+        return self.compute_advantages_and_returns(experiences, **generate_kwargs)
+
     @torch.no_grad()
     def generate_samples(self, all_prompts: List[str], **generate_kwargs) -> List[Samples]:
         """
@@ -550,26 +678,75 @@ class RemoteExperienceMaker(NaiveExperienceMaker):
                 ray.get(refs)
         return samples
 
+    @torch.no_grad()
+    def make_experiences(self, samples_list: Iterable[Samples], num_batches: int = None) -> List[Experience]:
+        """
+        Turn every micro batch of samples into an experience with a pipeline of `experience_pipeline_depth`
+        micro batches: the ref/critic/reward forward of the next micro batches are dispatched before the
+        actor log probs of the current one are computed, so the remote models work while the actor does.
+
+        `num_batches` is the number of micro batches for the progress log, when samples_list has no length.
+        """
+        args = self.strategy.args
+        depth = max(1, getattr(args, "experience_pipeline_depth", 1))
+        # colocated models run one after the other on the same GPU
+        if args.colocate_actor_ref or args.colocate_critic_reward or args.colocate_all_models:
+            depth = 1
+
+        if args.perf:
+            self.perf_stats["dispatch_time"] = 0
+            self.perf_stats["pipeline_time"] = 0
+            self.pipeline_stalls = {"ref": 0, "critic": 0, "reward": 0}
+        start = time.time()
+
+        log_progress = make_progress_logger(
+            len(samples_list) if num_batches is None else num_batches,
+            log_every_percent=10,
+            desc="Episode experiences",
+        )
+        log_progress(0, force=True)
+
+        experiences = []
+        in_flight = deque()
+        for samples in samples_list:
+            in_flight.append((samples, self._dispatch_remote_forward(samples)))
+            if len(in_flight) >= depth:
+                experiences.append(self._finish_experience(*in_flight.popleft()).to_device("cpu"))
+                log_progress(len(experiences))
+        while in_flight:
+            experiences.append(self._finish_experience(*in_flight.popleft()).to_device("cpu"))
+            log_progress(len(experiences))
+
+        if args.perf:
+            # fraction of the experience making time the actor was busy, and fraction of the micro batches
+            # for which each remote stage was not done yet when the actor needed it
+            pipeline_time = time.time() - start
+            self.perf_stats["pipeline_time"] = pipeline_time
+            self.perf_stats["actor_utilization"] = self.perf_stats["actor_value_rm_time"] / max(pipeline_time, 1e-6)
+            for stage, stalls in self.pipeline_stalls.items():
+                self.perf_stats[f"{stage}_stall_ratio"] = stalls / max(len(experiences), 1)
+        return experiences
+
     @torch.no_grad()
     def make_experience(self, samples: Samples) -> Experience:
         """
         Turn samples into experience by calculating logprobs, values, rewards, and kl divergence.
         """
+        return self._finish_experience(samples, self._dispatch_remote_forward(samples))
+
+    def _dispatch_remote_forward(self, samples: Samples) -> dict:
+        """
+        Send the samples to the reference, critic and reward models and return the object refs of their outputs.
+        """
         args = self.strategy.args
-        self.actor.eval()
-        device = torch.cuda.current_device()
+        start = time.time()
 
         # extract values from samples
-        sequences = samples.sequences
-        attention_mask = samples.attention_mask
-        action_mask = samples.action_mask
         num_actions = samples.num_actions
         packed_seq_lens = samples.packed_seq_lens
-
-        start = time.time()
         sequences_cpu, attention_mask_cpu = (
-            sequences.to("cpu"),
-            attention_mask.to("cpu"),
+            samples.sequences.to("cpu"),
+            samples.attention_mask.to("cpu"),
         )
 
         # init log probs
@@ -604,8 +781,13 @@ class RemoteExperienceMaker(NaiveExperienceMaker):
                 r_refs.append(rm.forward.remote(sequences_cpu, attention_mask_cpu, packed_seq_lens=packed_seq_lens))
         else:
             # remote RM
+            token_ids = getattr(args, "remote_rm_token_ids", False) and not self.custom_reward_func
             if not self.packing_samples:
-                queries = self.tokenizer.batch_decode(sequences_cpu, skip_special_tokens=False)
+                if token_ids:
+                    # send the unpadded token ids, skipping the decode and re-tokenization round trip
+                    queries = [seq[mask.bool()].tolist() for seq, mask in zip(sequences_cpu, attention_mask_cpu)]
+                else:
+                    queries = self.tokenizer.batch_decode(sequences_cpu, skip_special_tokens=False)
             else:
                 sequences_list = []
                 offset = 0
@@ -613,7 +795,10 @@ class RemoteExperienceMaker(NaiveExperienceMaker):
                 for length in packed_seq_lens:
                     sequences_list.append(tokens_list[offset : offset + length])
                     offset += length
-                queries = self.tokenizer.batch_decode(sequences_list, skip_special_tokens=False)
+                if token_ids:
+                    queries = sequences_list
+                else:
+                    queries = self.tokenizer.batch_decode(sequences_list, skip_special_tokens=False)
 
             if self.custom_reward_func:
                 r = self.custom_reward_func.remote(queries, samples.prompts_batch)
@@ -621,17 +806,56 @@ class RemoteExperienceMaker(NaiveExperienceMaker):
             else:
                 prompts = [prompt["prompt"] for prompt in samples.prompts_batch]
                 for rm in self.remote_rm_url:
-                    r = remote_rm_fn_ray.remote(rm, queries=queries, prompts=prompts)
+                    r = remote_rm_fn_ray.remote(
+                        rm,
+                        queries=queries,
+                        prompts=prompts,
+                        cache_size=getattr(args, "remote_rm_cache_size", 0),
+                        cache_dir=getattr(args, "remote_rm_cache_dir", None),
+                        chunk_size=getattr(args, "remote_rm_chunk_size", None),
+                        max_concurrency=getattr(args, "remote_rm_max_concurrency", 8),
+                        token_ids=token_ids,
+                        special_tokens=self.special_tokens(token_ids),
+                        cache_namespace=getattr(args, "remote_rm_cache_namespace", None),
+                    )
                     r_refs.append(r)
 
         if args.colocate_all_models and not self.remote_rm_url:
             ray.get(r_refs)
             ray.get([self.reward_model[0].empty_cache.remote()])
 
+        if args.perf:
+            self.perf_stats["dispatch_time"] = self.perf_stats.get("dispatch_time", 0) + time.time() - start
+        return {"ref": base_action_log_probs_ref, "critic": value_ref, "reward": r_refs}
+
+    @torch.no_grad()
+    def _finish_experience(self, samples: Samples, refs: dict) -> Experience:
+        """
+        Compute the actor log probs of the samples, then gather the outputs of the remote models into an experience.
+        """
+        args = self.strategy.args
+        self.actor.eval()
+        device = torch.cuda.current_device()
+
+        # extract values from samples
+        sequences = samples.sequences
+        attention_mask = samples.attention_mask
+        action_mask = samples.action_mask
+        num_actions = samples.num_actions
+        packed_seq_lens = samples.packed_seq_lens
+        base_action_log_probs_ref, value_ref, r_refs = refs["ref"], refs["critic"], refs["reward"]
+
         # log probs
+        start = time.time()
         action_log_probs = self.actor(sequences, num_actions, attention_mask, packed_seq_lens=packed_seq_lens)
         actor_value_rm_time = time.time() - start
 
+        if args.perf and getattr(self, "pipeline_stalls", None) is not None:
+            for stage, stage_refs in (("ref", [base_action_log_probs_ref]), ("critic", [value_ref]), ("reward", r_refs)):
+                if stage_refs:
+                    _, not_ready = ray.wait(stage_refs, num_returns=len(stage_refs), timeout=0)
+                    self.pipeline_stalls[stage] += int(len(not_ready) > 0)
+
         # wait initial/critic/reward model done
         start = time.time()
         ref_values = ray.get([base_action_log_probs_ref, value_ref] + r_refs)
@@ -662,6 +886,12 @@ class RemoteExperienceMaker(NaiveExperienceMaker):
         else:
             kl = torch.zeros_like(action_log_probs, dtype=action_log_probs.dtype, device=device)
 
+        # truncated importance weights between the actor and the (older) policy of the vLLM engines
+        importance_weights = None
+        if samples.behavior_log_probs is not None:
+            log_ratio = action_log_probs.float() - samples.behavior_log_probs.to(device)
+            importance_weights = log_ratio.exp().clamp(max=args.async_rollout_max_importance_ratio)
+
         if not self.packing_samples:
             kl_mean = masked_mean(kl, action_mask, dim=-1)
         else:
@@ -673,8 +903,13 @@ class RemoteExperienceMaker(NaiveExperienceMaker):
             if value is not None:
                 value = unpacking_samples(value, num_actions)
 
+            num_actions_tensor = torch.tensor(num_actions, device=device)
+            sample_ids = torch.repeat_interleave(torch.arange(len(num_actions), device=device), num_actions_tensor)
+            kl_sum = torch.zeros(len(num_actions), dtype=kl.dtype, device=device).index_add_(0, sample_ids, kl.squeeze(0))
+            kl_mean = kl_sum / num_actions_tensor
             kl = unpacking_samples(kl, num_actions)
-            kl_mean = torch.tensor([each_kl.mean() for each_kl in kl], device=device)
+            if importance_weights is not None:
+                importance_weights = unpacking_samples(importance_weights, num_actions)
 
         info = {
             "kl": kl_mean,
@@ -698,27 +933,26 @@ class RemoteExperienceMaker(NaiveExperienceMaker):
             action_mask,
             info,
             kl,
+            importance_weights,
         )
 
         self.actor.train()  # reset model state
         return experience
 
-    def _generate_vllm(self, all_prompts: List[dict], **kwargs) -> List[Samples]:
-        from vllm import SamplingParams
-
+    def _select_vllm_engines(self) -> List:
         # round-robin load balance
         rank = torch.distributed.get_rank()
         world_size = torch.distributed.get_world_size()
 
         # Select LLM engines: assign each rank an engine, or cycle through engines if world_size < engine_count
         if len(self.vllm_engines) <= world_size:
-            llms = [self.vllm_engines[rank % len(self.vllm_engines)]]
-        else:
-            llms = self.vllm_engines[rank::world_size]
+            return [self.vllm_engines[rank % len(self.vllm_engines)]]
+        return self.vllm_engines[rank::world_size]
 
-        args = self.strategy.args
+    def _vllm_sampling_params(self, **kwargs):
+        from vllm import SamplingParams
 
-        sampling_params = SamplingParams(
+        return SamplingParams(
             temperature=kwargs.get("temperature", 1.0),
             top_p=kwargs.get("top_p", 1.0),
             top_k=kwargs.get("top_k", -1),
@@ -727,12 +961,38 @@ class RemoteExperienceMaker(NaiveExperienceMaker):
             skip_special_tokens=kwargs.get("skip_special_tokens", False),
             stop=kwargs.get("stop", None),
             include_stop_str_in_output=True,
+            # log prob of the sampled tokens, for the importance weights of async rollouts
+            logprobs=0 if getattr(self.strategy.args, "async_rollout_staleness", 0) > 0 else None,
         )
 
+    def _prompt_token_ids(self, all_prompts: List[dict]) -> List[List[int]]:
+        # the prompts tokenized by PromptDataset are sent to vLLM as they are
+        if all("prompt_token_ids" in prompt for prompt in all_prompts):
+            return [prompt["prompt_token_ids"] for prompt in all_prompts]
+        input_prompts = [prompt["prompt"] for prompt in all_prompts]
+        return self.tokenize_fn(input_prompts, self.prompt_max_len, padding=False)["input_ids"]
+
+    def _generate_vllm(self, all_prompts: List[dict], **kwargs) -> List[Samples]:
+        llms, all_prompts, refs = self._send_vllm_requests(all_prompts, **kwargs)
+        ray.get(refs)
+
+        # Make sure all requests are sent.
+        torch.distributed.barrier()
+
+        return self._receive_vllm_responses(llms, all_prompts, refs)
+
+    def _send_vllm_requests(self, all_prompts: List[dict], **kwargs) -> Tuple[List, List[dict], List]:
+        """
+        Send the requests to the engines without waiting, return the engines, the expanded prompts and the refs.
+        """
+        rank = torch.distributed.get_rank()
+        llms = self._select_vllm_engines()
+        args = self.strategy.args
+        sampling_params = self._vllm_sampling_params(**kwargs)
+
         # Expand prompt list based on the number of samples per prompt
         all_prompts = sum([[prompt] * args.n_samples_per_prompt for prompt in all_prompts], [])
-        input_prompts = [prompt["prompt"] for prompt in all_prompts]
-        all_prompt_token_ids = self.tokenize_fn(input_prompts, self.prompt_max_len, padding=False)["input_ids"]
+        all_prompt_token_ids = self._prompt_token_ids(all_prompts)
 
         # Distribute requests to engines and collect responses to outputs
         refs = []
@@ -742,10 +1002,15 @@ class RemoteExperienceMaker(NaiveExperienceMaker):
             refs.append(
                 llm.add_requests.remote(rank, sampling_params=sampling_params, prompt_token_ids=prompt_token_ids)
             )
-        ray.get(refs)
+        return llms, all_prompts, refs
 
-        # Make sure all requests are sent.
-        torch.distributed.barrier()
+    def _receive_vllm_responses(self, llms: List, all_prompts: List[dict], refs: List) -> List[Samples]:
+        """
+        Retrieve the responses of the requests sent with `_send_vllm_requests` and return them in micro batches.
+        """
+        rank = torch.distributed.get_rank()
+        args = self.strategy.args
+        ray.get(refs)
 
         # Retrieve and combine results from all outputs
         all_output_refs = []
@@ -755,93 +1020,169 @@ class RemoteExperienceMaker(NaiveExperienceMaker):
 
         samples_list = []
         for i in range(0, len(all_outputs), args.micro_rollout_batch_size):
-            outputs = all_outputs[i : i + self.strategy.args.micro_rollout_batch_size]
-            prompts = all_prompts[i : i + self.strategy.args.micro_rollout_batch_size]
-            if not self.packing_samples:
-                # NOTE: concat all outputs to following format:
-                #
-                # | [PAD] [PAD] token token token | token token [EOS] [PAD] |
-                # | token token token token token | token token [EOS] [PAD] |
-                # | [PAD] [PAD] [PAD] token token | token token token [EOS] |
-                # |<---------- prompt ----------->|<-------- answer ------->|
-                max_input_len, max_output_len = 0, 0
-                for output in outputs:
-                    max_input_len = max(max_input_len, len(output.prompt_token_ids))
-                    max_output_len = max(max_output_len, len(output.outputs[0].token_ids))
-
-                pad_token_id, eos_token_id = self.tokenizer.pad_token_id, self.tokenizer.eos_token_id
-                sequences = []
-                for output in outputs:
-                    # left padding input
-                    input_len = len(output.prompt_token_ids)
-                    input_ids = [pad_token_id] * (max_input_len - input_len) + list(output.prompt_token_ids)
-
-                    # right padding output
-                    output_len = len(output.outputs[0].token_ids)
-                    output_ids = list(output.outputs[0].token_ids) + [pad_token_id] * (max_output_len - output_len)
-
-                    # concat input and output
-                    sequences.append(input_ids + output_ids)
-
-                sequences = torch.tensor(sequences)
-                sequences, attention_mask, action_mask = self.actor.process_sequences(
-                    sequences, max_input_len, eos_token_id, pad_token_id
-                )
-                sequences = sequences.to("cuda")
-                attention_mask = attention_mask.to("cuda")
-                action_mask = action_mask.to("cuda")
-                samples_list.append(
-                    Samples(
-                        sequences=sequences,
-                        attention_mask=attention_mask,
-                        action_mask=action_mask,
-                        num_actions=action_mask.size(1),
-                        packed_seq_lens=None,
-                        response_length=action_mask.float().sum(dim=-1),
-                        total_length=attention_mask.float().sum(dim=-1),
-                        prompts_batch=prompts,
-                    )
-                )
-            else:
-                # NOTE: concat all outputs to following format:
-                #
-                # | token token token | token token [EOS] | token token token token token | token token [EOS] | token token | token token token [EOS] |
-                # |<---  prompt ----->|<---- answer ----->|<---------- prompt ----------->|<----- answer ---->|<- prompt -->|<-------- answer ------->|
-                pad_token_id, eos_token_id = self.tokenizer.pad_token_id, self.tokenizer.eos_token_id
-                sequences = []
-                packed_seq_lens = []
-                attention_mask = []
-                num_actions = []
-                for i, output in enumerate(outputs):
-                    input_len = len(output.prompt_token_ids)
-                    output_len = len(output.outputs[0].token_ids)
-                    packed_seq_lens.append(input_len + output_len)
-                    sequences.extend(output.prompt_token_ids + list(output.outputs[0].token_ids))
-                    attention_mask.extend([i + 1] * (input_len + output_len))
-
-                    # current_action_mask = [0] * (input_len - 1) + [1] * output_len + [0]
-                    # num_actions.append(max(1, sum(current_action_mask)))
-                    num_actions.append(max(1, output_len))
-
-                sequences = torch.tensor(sequences, device="cuda").unsqueeze(0)
-                attention_mask = torch.tensor(attention_mask, device="cuda").unsqueeze(0)
-                action_mask = None
-                response_length = torch.tensor(num_actions, device="cuda", dtype=torch.float)
-                total_length = torch.tensor(packed_seq_lens, device="cuda", dtype=torch.float)
-                samples_list.append(
-                    Samples(
-                        sequences=sequences,
-                        attention_mask=attention_mask,
-                        action_mask=None,
-                        num_actions=num_actions,
-                        packed_seq_lens=packed_seq_lens,
-                        response_length=response_length,
-                        total_length=total_length,
-                        prompts_batch=prompts,
-                    )
-                )
+            outputs = all_outputs[i : i + args.micro_rollout_batch_size]
+            prompts = all_prompts[i : i + args.micro_rollout_batch_size]
+            samples_list.append(self._make_vllm_samples(outputs, prompts))
         return samples_list
 
+    def _generate_vllm_streaming(self, all_prompts: List[dict], **kwargs) -> Iterator[Samples]:
+        """
+        Generate samples with vLLM and yield them in micro batches as soon as the responses are finished.
+
+        The requests are added to the engines right away and the finished responses are polled
+        incrementally, so the caller can make experiences while long responses are still decoding.
+        The responses of a prompt are only released once all its `n_samples_per_prompt` responses are
+        finished, which keeps them next to each other for the group baselines of rloo and reinforce_baseline.
+        """
+        rank = torch.distributed.get_rank()
+        llms = self._select_vllm_engines()
+        args = self.strategy.args
+        sampling_params = self._vllm_sampling_params(**kwargs)
+        n_samples_per_prompt = args.n_samples_per_prompt
+
+        # Expand prompt list based on the number of samples per prompt
+        all_prompts = sum([[prompt] * n_samples_per_prompt for prompt in all_prompts], [])
+        all_prompt_token_ids = self._prompt_token_ids(all_prompts)
+
+        refs = []
+        offsets = []
+        batch_size = (len(all_prompt_token_ids) + len(llms) - 1) // len(llms)
+        for i, llm in enumerate(llms):
+            prompt_token_ids = all_prompt_token_ids[i * batch_size : (i + 1) * batch_size]
+            offsets.append(i * batch_size)
+            refs.append(
+                llm.add_requests_streaming.remote(
+                    rank, sampling_params=sampling_params, prompt_token_ids=prompt_token_ids
+                )
+            )
+        ray.get(refs)
+
+        outputs = [None] * len(all_prompts)
+        group_pending = [n_samples_per_prompt] * ((len(all_prompts) + n_samples_per_prompt - 1) // n_samples_per_prompt)
+        ready = []
+        num_finished = 0
+        while num_finished < len(all_prompts):
+            # the engines keep decoding while the experiences of the yielded samples are made, and the
+            # short timeout only avoids spinning when no response has finished yet
+            responses = ray.get([llm.poll_responses.remote(rank, timeout=0.05) for llm in llms])
+            for offset, engine_responses in zip(offsets, responses):
+                for index, output in engine_responses:
+                    index += offset
+                    outputs[index] = output
+                    num_finished += 1
+                    group = index // n_samples_per_prompt
+                    group_pending[group] -= 1
+                    if group_pending[group] == 0:
+                        ready.extend(range(group * n_samples_per_prompt, (group + 1) * n_samples_per_prompt))
+
+            while len(ready) >= args.micro_rollout_batch_size or (ready and num_finished == len(all_prompts)):
+                indices, ready = ready[: args.micro_rollout_batch_size], ready[args.micro_rollout_batch_size :]
+                yield self._make_vllm_samples([outputs[i] for i in indices], [all_prompts[i] for i in indices])
+
+    def _make_vllm_samples(self, outputs: List, prompts: List[dict]) -> Samples:
+        if not self.packing_samples:
+            # NOTE: concat all outputs to following format:
+            #
+            # | [PAD] [PAD] token token token | token token [EOS] [PAD] |
+            # | token token token token token | token token [EOS] [PAD] |
+            # | [PAD] [PAD] [PAD] token token | token token token [EOS] |
+            # |<---------- prompt ----------->|<-------- answer ------->|
+            max_input_len, max_output_len = 0, 0
+            for output in outputs:
+                max_input_len = max(max_input_len, len(output.prompt_token_ids))
+                max_output_len = max(max_output_len, len(output.outputs[0].token_ids))
+
+            pad_token_id, eos_token_id = self.tokenizer.pad_token_id, self.tokenizer.eos_token_id
+            sequences = []
+            for output in outputs:
+                # left padding input
+                input_len = len(output.prompt_token_ids)
+                input_ids = [pad_token_id] * (max_input_len - input_len) + list(output.prompt_token_ids)
+
+                # right padding output
+                output_len = len(output.outputs[0].token_ids)
+                output_ids = list(output.outputs[0].token_ids) + [pad_token_id] * (max_output_len - output_len)
+
+                # concat input and output
+                sequences.append(input_ids + output_ids)
+
+            sequences = torch.tensor(sequences)
+            sequences, attention_mask, action_mask = self.actor.process_sequences(
+                sequences, max_input_len, eos_token_id, pad_token_id
+            )
+            sequences = sequences.to("cuda")
+            attention_mask = attention_mask.to("cuda")
+            action_mask = action_mask.to("cuda")
+
+            behavior_log_probs = None
+            if outputs[0].outputs[0].logprobs is not None:
+                behavior_log_probs = [
+                    log_probs + [0.0] * (max_output_len - len(log_probs))
+                    for log_probs in map(self._sampled_log_probs, outputs)
+                ]
+                behavior_log_probs = torch.tensor(behavior_log_probs, device="cuda")
+            return Samples(
+                sequences=sequences,
+                attention_mask=attention_mask,
+                action_mask=action_mask,
+                num_actions=action_mask.size(1),
+                packed_seq_lens=None,
+                response_length=action_mask.float().sum(dim=-1),
+                total_length=attention_mask.float().sum(dim=-1),
+                prompts_batch=prompts,
+                behavior_log_probs=behavior_log_probs,
+            )
+        else:
+            # NOTE: concat all outputs to following format:
+            #
+            # | token token token | token token [EOS] | token token token token token | token token [EOS] | token token | token token token [EOS] |
+            # |<---  prompt ----->|<---- answer ----->|<---------- prompt ----------->|<----- answer ---->|<- prompt -->|<-------- answer ------->|
+            pad_token_id, eos_token_id = self.tokenizer.pad_token_id, self.tokenizer.eos_token_id
+            sequences = []
+            packed_seq_lens = []
+            attention_mask = []
+            num_actions = []
+            for i, output in enumerate(outputs):
+                input_len = len(output.prompt_token_ids)
+                output_len = len(output.outputs[0].token_ids)
+                packed_seq_lens.append(input_len + output_len)
+                sequences.extend(output.prompt_token_ids + list(output.outputs[0].token_ids))
+                attention_mask.extend([i + 1] * (input_len + output_len))
+
+                # current_action_mask = [0] * (input_len - 1) + [1] * output_len + [0]
+                # num_actions.append(max(1, sum(current_action_mask)))
+                num_actions.append(max(1, output_len))
+
+            sequences = torch.tensor(sequences, device="cuda").unsqueeze(0)
+            attention_mask = torch.tensor(attention_mask, device="cuda").unsqueeze(0)
+            action_mask = None
+            response_length = torch.tensor(num_actions, device="cuda", dtype=torch.float)
+            total_length = torch.tensor(packed_seq_lens, device="cuda", dtype=torch.float)
+
+            behavior_log_probs = None
+            if outputs[0].outputs[0].logprobs is not None:
+                behavior_log_probs = []
+                for output, num in zip(outputs, num_actions):
+                    log_probs = self._sampled_log_probs(output)
+                    behavior_log_probs.extend(log_probs + [0.0] * (num - len(log_probs)))
+                behavior_log_probs = torch.tensor(behavior_log_probs, device="cuda").unsqueeze(0)
+            return Samples(
+                sequences=sequences,
+                attention_mask=attention_mask,
+                action_mask=None,
+                num_actions=num_actions,
+                packed_seq_lens=packed_seq_lens,
+                response_length=response_length,
+                total_length=total_length,
+                prompts_batch=prompts,
+                behavior_log_probs=behavior_log_probs,
+            )
+
+    @staticmethod
+    def _sampled_log_probs(output) -> List[float]:
+        completion = output.outputs[0]
+        return [log_probs[token_id].logprob for token_id, log_probs in zip(completion.token_ids, completion.logprobs)]
+
     def flush(self):
         "Ensure all experience has been send to critic"
         if self.critic is not None:
@@ -1,11 +1,13 @@
+import heapq
+import math
 import random
 from abc import ABC
-from dataclasses import dataclass
-from typing import List, Optional
+from dataclasses import dataclass, replace
+from typing import Iterator, List, Optional
 
 import torch
 import torch.nn.functional as F
-
+from torch.utils.data import Sampler
 
 from .experience_maker import Experience
 
@@ -24,6 +26,7 @@ class BufferItem:
     action_mask: (A)
 
     "A" is the number of actions.
+    is_padding: zero weighted copy of an item, see `TokenBudgetBatchSampler`
     """
 
     sequences: torch.Tensor
@@ -34,6 +37,15 @@ class BufferItem:
     attention_mask: Optional[torch.LongTensor]
     action_mask: Optional[torch.BoolTensor]
     info: Optional[dict]
+    is_padding: bool = False
+
+
+def padding_index(idx: int) -> int:
+    """
+    Marker index of a zero weighted copy of item `idx`, used by `TokenBudgetBatchSampler` to pad the number
+    of minibatches. The mapping is its own inverse, so it also gives back the item of a marker.
+    """
+    return -1 - idx
 
 
 def split_experience_batch(experience: Experience) -> List[BufferItem]:
@@ -110,6 +122,7 @@ def make_experience_batch(items: List[BufferItem], packing_samples=False) -> Exp
     for key in items[0].info.keys():
         vals = torch.tensor([item.info[key] for item in items])
         kwargs["info"][key] = vals
+    kwargs["is_padding"] = all(item.is_padding for item in items)
     return Experience(**kwargs)
 
 
@@ -199,8 +212,18 @@ class NaiveReplayBuffer(ABC):
         return len(self.items)
 
     def __getitem__(self, idx: int) -> BufferItem:
+        if idx < 0:
+            return replace(self.items[padding_index(idx)], is_padding=True)
         return self.items[idx]
 
+    def sequence_lengths(self) -> List[int]:
+        """Number of tokens (prompt and response, without padding) of every item."""
+        return [item.sequences.numel() for item in self.items]
+
+    def num_actions(self) -> List[int]:
+        """Number of actions (response tokens) of every item."""
+        return [item.action_log_probs.numel() for item in self.items]
+
     def collate_fn(self, batch) -> Experience:
         experience = make_experience_batch(batch, self.packing_samples)
         return experience
@@ -235,3 +258,350 @@ class NaiveReplayBuffer(ABC):
 
         for i, item in enumerate(self):
             setattr(item, attribute, (items[i] - mean) * rstd)
+
+
+class LengthGroupedBatchSampler(Sampler[List[int]]):
+    """Batch sampler that puts replay buffer items of similar length into the same minibatch.
+
+    Every epoch the indices are shuffled and split into buckets of `bucket_size` minibatches. Each
+    bucket is sorted by length and cut into minibatches, and the order of all minibatches is shuffled
+    again. Minibatches are still random across epochs, but the padding inside each one is small.
+
+    Args:
+        lengths (List[int]): Length of every item in the replay buffer.
+        batch_size (int): Number of items per minibatch.
+        drop_last (bool, optional): Drop the last incomplete minibatch. Defaults to True.
+        bucket_size (int, optional): Number of minibatches sorted together. Defaults to 50.
+    """
+
+    def __init__(self, lengths: List[int], batch_size: int, drop_last: bool = True, bucket_size: int = 50) -> None:
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.bucket_size = bucket_size
+
+    def __iter__(self) -> Iterator[List[int]]:
+        indices = torch.randperm(len(self.lengths)).tolist()
+        if self.drop_last:
+            indices = indices[: len(self) * self.batch_size]
+
+        batches = []
+        bucket_items = self.batch_size * self.bucket_size
+        for start in range(0, len(indices), bucket_items):
+            bucket = sorted(indices[start : start + bucket_items], key=self.lengths.__getitem__)
+            batches.extend(bucket[i : i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+
+        for i in torch.randperm(len(batches)).tolist():
+            yield batches[i]
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+class TokenBudgetBatchSampler(Sampler[List[int]]):
+    """Batch sampler that packs replay buffer items into minibatches of at most `max_tokens` tokens.
+
+    Every epoch the items are visited in random order and put into the first minibatch with enough
+    room left (worst fit); an item longer than the budget gets a minibatch of its own. When a strategy is
+    given, the number of minibatches is made equal on all ranks (and a multiple of `multiple_of`) by
+    splitting the largest minibatches, so that data parallel ranks run the same number of micro steps. A
+    rank with too few items to split into that many minibatches adds padding minibatches instead: their
+    indices are `padding_index` markers, which the replay buffer collates into an `Experience` with
+    `is_padding` set so that its loss gets a zero weight.
+
+    Since every minibatch holds a different number of actions, `num_actions_per_batch` gives the mean
+    number of actions per minibatch over all ranks for the current epoch. Scaling the token-mean loss of
+    a minibatch by `num_actions / num_actions_per_batch` keeps every action weighted equally.
+
+    Args:
+        lengths (List[int]): Length of every item in the replay buffer.
+        max_tokens (int): Token budget of a minibatch.
+        num_actions (List[int], optional): Number of actions of every item.
+        strategy (optional): Training strategy used to agree on the number of minibatches across ranks.
+        multiple_of (int, optional): The number of minibatches is rounded up to a multiple of this. Defaults to 1.
+    """
+
+    def __init__(
+        self,
+        lengths: List[int],
+        max_tokens: int,
+        num_actions: Optional[List[int]] = None,
+        strategy=None,
+        multiple_of: int = 1,
+    ) -> None:
+        self.lengths = lengths
+        self.max_tokens = max_tokens
+        self.strategy = strategy
+        self.multiple_of = multiple_of
+
+        total_num_actions = sum(num_actions) if num_actions is not None else sum(lengths)
+        if strategy is not None:
+            total_num_actions = strategy.all_reduce(total_num_actions, "sum")
+        self.total_num_actions = total_num_actions
+        self.num_actions_per_batch = None
+        self.num_batches = None
+
+    def _worst_fit(self, indices: List[int]) -> List[List[int]]:
+        # max-heap of the room left in every minibatch
+        batches, heap = [], []
+        for idx in indices:
+            length = self.lengths[idx]
+            if heap and length <= -heap[0][0]:
+                room, i = heapq.heappop(heap)
+                batches[i].append(idx)
+                heapq.heappush(heap, (room + length, i))
+            else:
+                batches.append([idx])
+                heapq.heappush(heap, (length - self.max_tokens, len(batches) - 1))
+        return batches
+
+    def _split_largest(self, batches: List[List[int]], num_batches: int) -> None:
+        # max-heap of the number of tokens of every minibatch that can be split
+        heap = [(-sum(self.lengths[idx] for idx in batch), i) for i, batch in enumerate(batches) if len(batch) > 1]
+        heapq.heapify(heap)
+        while len(batches) < num_batches and heap:
+            _, i = heapq.heappop(heap)
+            batch = batches[i]
+            batches[i] = batch[0::2]
+            batches.append(batch[1::2])
+            for j in (i, len(batches) - 1):
+                if len(batches[j]) > 1:
+                    heapq.heappush(heap, (-sum(self.lengths[idx] for idx in batches[j]), j))
+
+    def __iter__(self) -> Iterator[List[int]]:
+        indices = torch.randperm(len(self.lengths)).tolist()
+        batches = self._worst_fit(indices)
+
+        num_batches = len(batches)
+        if self.strategy is not None:
+            num_batches = int(self.strategy.all_reduce(num_batches, "max"))
+        num_batches = math.ceil(num_batches / self.multiple_of) * self.multiple_of
+
+        # split the largest minibatches until all ranks have the same number of minibatches
+        self._split_largest(batches, num_batches)
+
+        # a rank with fewer items than minibatches makes up the count with marked copies of its shortest item
+        num_padding_batches = num_batches - len(batches)
+        if num_padding_batches > 0:
+            padding = [padding_index(min(indices, key=self.lengths.__getitem__))]
+
+        self.num_batches = num_batches
+        world_size = self.strategy.world_size if self.strategy is not None else 1
+        self.num_actions_per_batch = self.total_num_actions / (self.num_batches * world_size)
+
+        for i in torch.randperm(len(batches)).tolist():
+            yield batches[i]
+        for _ in range(num_padding_batches):
+            yield padding
+
+    def __len__(self) -> int:
+        if self.num_batches is not None:
+            return self.num_batches
+        return max(1, math.ceil(sum(self.lengths) / self.max_tokens))
+
+
+def _gather_left_padded(flat: torch.Tensor, offsets: torch.Tensor, lengths: torch.Tensor) -> torch.Tensor:
+    # Equivalent to zero_pad_sequences([flat[o : o + l] for o, l in zip(offsets, lengths)], "left")
+    offsets, lengths = offsets.to(flat.device), lengths.to(flat.device)
+    max_len = lengths.max().item()
+    positions = torch.arange(max_len, device=flat.device).unsqueeze(0) - (max_len - lengths).unsqueeze(1)
+    valid = positions >= 0
+    index = (offsets.unsqueeze(1) + positions.clamp(min=0)).clamp(max=flat.numel() - 1)
+    return torch.where(valid, flat[index], torch.zeros((), dtype=flat.dtype))
+
+
+def _gather_packed(flat: torch.Tensor, offsets: torch.Tensor, lengths: torch.Tensor) -> List[torch.Tensor]:
+    # Equivalent to [flat[o : o + l] for o, l in zip(offsets, lengths)]
+    split_sizes = lengths.tolist()
+    offsets, lengths = offsets.to(flat.device), lengths.to(flat.device)
+    starts = torch.cumsum(lengths, dim=0) - lengths
+    index = torch.repeat_interleave(offsets - starts, lengths) + torch.arange(sum(split_sizes), device=flat.device)
+    return list(flat[index].split(split_sizes))
+
+
+class ColumnarReplayBuffer(ABC):
+    """Replay buffer that stores experience in flat columns.
+
+    Instead of one BufferItem per sample, the tokens of all samples are concatenated into one flat
+    buffer per field, indexed by offset/length arrays for the sequences and for the actions. Info
+    scalars are kept as one tensor per key. Sampling a minibatch is a gather from these buffers
+    followed by a single pad (or split when packing samples).
+
+    Items returned by `__getitem__` are plain indices, so `collate_fn` does all the gathering.
+
+    Args:
+        sample_batch_size (int): Batch size when sampling.
+        limit (int, optional): Limit of number of experience samples. A number <= 0 means unlimited. Defaults to 0.
+        cpu_offload (bool, optional): Whether to offload experience to cpu when sampling. Defaults to True.
+    """
+
+    sequence_keys = ("sequences", "attention_mask")
+    action_keys = ("action_log_probs", "values", "returns", "advantages", "action_mask")
+
+    def __init__(
+        self, sample_batch_size: int, limit: int = 0, cpu_offload: bool = True, packing_samples: bool = False
+    ) -> None:
+        super().__init__()
+        self.sample_batch_size = sample_batch_size
+        # limit <= 0 means unlimited
+        self.limit = limit
+        self.cpu_offload = cpu_offload
+        self.packing_samples = packing_samples
+        self.target_device = torch.device(f"cuda:{torch.cuda.current_device()}")
+        self.clear()
+
+    @torch.no_grad()
+    def append(self, experience: Experience) -> None:
+        if self.cpu_offload:
+            experience.to_device(torch.device("cpu"))
+
+        chunk = {"info": {k: v.reshape(-1) for k, v in experience.info.items()}}
+        if self.packing_samples:
+            # the packed samples comes with no padding
+            chunk["seq_lengths"] = torch.tensor([s.numel() for s in experience.sequences])
+            chunk["action_lengths"] = torch.tensor([a.numel() for a in experience.action_log_probs])
+            for key in self.sequence_keys + self.action_keys:
+                value = getattr(experience, key)
+                chunk[key] = torch.cat(value) if value is not None else None
+        else:
+            # remove left padding of sequences and right padding of actions, see remove_padding_in_sequences
+            seq_len, num_actions = experience.sequences.size(1), experience.action_mask.size(1)
+            left_pad = experience.attention_mask.long().argmax(dim=1, keepdim=True)
+            right_pad = (1 - experience.action_mask.long()).sum(dim=1, keepdim=True)
+            seq_positions = torch.arange(seq_len, device=left_pad.device).unsqueeze(0)
+            seq_keep = (seq_positions >= left_pad) & (seq_positions < seq_len - right_pad)
+            action_keep = torch.arange(num_actions, device=left_pad.device).unsqueeze(0) < num_actions - right_pad
+
+            chunk["seq_lengths"] = seq_keep.sum(dim=1).cpu()
+            chunk["action_lengths"] = action_keep.sum(dim=1).cpu()
+            for keys, keep in ((self.sequence_keys, seq_keep), (self.action_keys, action_keep)):
+                for key in keys:
+                    value = getattr(experience, key)
+                    chunk[key] = value[keep] if value is not None else None
+
+        self._chunks.append(chunk)
+        self._num_items += len(chunk["seq_lengths"])
+
+    def clear(self) -> None:
+        self._chunks = []
+        self._num_items = 0
+        self.columns = {}
+        self.info = {}
+        self.seq_offsets = torch.zeros(0, dtype=torch.long)
+        self.seq_lengths = torch.zeros(0, dtype=torch.long)
+        self.action_offsets = torch.zeros(0, dtype=torch.long)
+        self.action_lengths = torch.zeros(0, dtype=torch.long)
+
+    def _consolidate(self) -> None:
+        """Merge the chunks appended since the last call into the flat columns."""
+        if not self._chunks:
+            return
+        chunks, self._chunks = self._chunks, []
+
+        seq_lengths = torch.cat([self.seq_lengths] + [c["seq_lengths"] for c in chunks])
+        action_lengths = torch.cat([self.action_lengths] + [c["action_lengths"] for c in chunks])
+        for key in self.sequence_keys + self.action_keys:
+            parts = [c[key] for c in chunks]
+            if parts[0] is None:
+                self.columns[key] = None
+                continue
+            if self.columns.get(key) is not None:
+                parts = [self.columns[key]] + parts
+            self.columns[key] = torch.cat(parts)
+        for key in chunks[0]["info"].keys():
+            parts = [c["info"][key] for c in chunks]
+            if key in self.info:
+                parts = [self.info[key]] + parts
+            self.info[key] = torch.cat(parts)
+
+        # drop the oldest samples over the limit
+        samples_to_remove = len(seq_lengths) - self.limit if self.limit > 0 else 0
+        if samples_to_remove > 0:
+            seq_start = seq_lengths[:samples_to_remove].sum().item()
+            action_start = action_lengths[:samples_to_remove].sum().item()
+            for keys, start in ((self.sequence_keys, seq_start), (self.action_keys, action_start)):
+                for key in keys:
+                    if self.columns[key] is not None:
+                        self.columns[key] = self.columns[key][start:].clone()
+            self.info = {k: v[samples_to_remove:].clone() for k, v in self.info.items()}
+            seq_lengths = seq_lengths[samples_to_remove:]
+            action_lengths = action_lengths[samples_to_remove:]
+
+        self.seq_lengths, self.action_lengths = seq_lengths, action_lengths
+        self.seq_offsets = torch.cumsum(seq_lengths, dim=0) - seq_lengths
+        self.action_offsets = torch.cumsum(action_lengths, dim=0) - action_lengths
+        self._num_items = len(seq_lengths)
+
+    @torch.no_grad()
+    def sample(self) -> Experience:
+        indices = random.sample(range(len(self)), self.sample_batch_size)
+        experience = self.collate_fn(indices)
+        if self.cpu_offload:
+            experience.to_device(self.target_device)
+        return experience
+
+    def __len__(self) -> int:
+        if self.limit > 0:
+            return min(self._num_items, self.limit)
+        return self._num_items
+
+    def __getitem__(self, idx: int) -> int:
+        return idx
+
+    def sequence_lengths(self) -> List[int]:
+        """Number of tokens (prompt and response, without padding) of every item."""
+        self._consolidate()
+        return self.seq_lengths.tolist()
+
+    def num_actions(self) -> List[int]:
+        """Number of actions (response tokens) of every item."""
+        self._consolidate()
+        return self.action_lengths.tolist()
+
+    @torch.no_grad()
+    def collate_fn(self, batch: List[int]) -> Experience:
+        self._consolidate()
+        is_padding = all(idx < 0 for idx in batch)
+        if is_padding:
+            batch = [padding_index(idx) for idx in batch]
+        indices = torch.tensor(batch, dtype=torch.long)
+        gather = _gather_packed if self.packing_samples else _gather_left_padded
+
+        kwargs = {}
+        for keys, offsets, lengths in (
+            (self.sequence_keys, self.seq_offsets[indices], self.seq_lengths[indices]),
+            (self.action_keys, self.action_offsets[indices], self.action_lengths[indices]),
+        ):
+            for key in keys:
+                column = self.columns[key]
+                kwargs[key] = gather(column, offsets, lengths) if column is not None else None
+        kwargs["info"] = {k: v[indices] for k, v in self.info.items()}
+        return Experience(**kwargs, is_padding=is_padding)
+
+    def normalize(self, attribute: str, strategy) -> None:
+        assert attribute == "advantages"
+        self._consolidate()
+        items_vector = self.columns[attribute].float()
+        action_mask = self.columns["action_mask"]
+
+        if action_mask is None:
+            # packing samples has no action mask
+            action_masks_vector = 1
+            num_actions = items_vector.numel()
+        else:
+            action_masks_vector = action_mask
+            num_actions = action_mask.sum()
+
+        # for DP
+        # mean
+        sum_and_count = torch.tensor([items_vector.sum(), num_actions], device=items_vector.device)
+        all_sum, all_count = strategy.all_reduce(sum_and_count, "sum")
+        mean = all_sum / all_count
+        # std
+        std = ((items_vector - mean).pow(2) * action_masks_vector).sum()
+        all_std = strategy.all_reduce(std, "sum")
+        rstd = (all_std / all_count).clamp(min=1e-8).rsqrt()
+
+        self.columns[attribute] = (self.columns[attribute] - mean) * rstd
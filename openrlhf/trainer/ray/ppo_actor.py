@@ -2,6 +2,7 @@ import itertools
 import math
 import os
 import socket
+import time
 from typing import Callable, Dict, List
 
 import deepspeed
@@ -152,7 +153,7 @@ class ActorPPOTrainer(PPOTrainer):
                             refs.append(engine.wake_up.remote())
                         ray.get(refs)
                 torch.distributed.barrier()
-                self._broadcast_to_vllm()
+                status.update(self._broadcast_to_vllm())
 
         # 5. wait remote critic model training done
         if self.critic_train_remote and not self.strategy.args.colocate_all_models:
@@ -174,7 +175,30 @@ class ActorPPOTrainer(PPOTrainer):
                 cache_reset_refs.append(engine.reset_prefix_cache.remote())
 
         torch.cuda.empty_cache()
+        start = time.time()
         model = self.actor.model.module
+        # the engines pause between two decoding steps of the rollouts in flight (async rollout) and resume them
+        # with the new weights, instead of finishing them before the weights can be updated
+        if torch.distributed.get_rank() == 0:
+            ray.get([engine.begin_weight_update.remote() for engine in self.vllm_engines])
+        if getattr(self.strategy.args, "vllm_sync_bucket_mb", 0) > 0 and not self.use_cuda_ipc:
+            self._broadcast_buckets_to_vllm(model)
+        else:
+            self._broadcast_params_to_vllm(model)
+
+        if cache_reset_refs:
+            ray.get(cache_reset_refs)
+        if torch.distributed.get_rank() == 0:
+            ray.get([engine.end_weight_update.remote() for engine in self.vllm_engines])
+        torch.cuda.empty_cache()
+        torch.distributed.barrier()
+
+        sync_time = time.time() - start
+        num_bytes = sum(getattr(param, "ds_numel", param.numel()) * param.element_size() for param in model.parameters())
+        self.strategy.print(f"Broadcast {num_bytes / 1e9:.2f} GB to vllm engines in {sync_time:.2f}s")
+        return {"vllm_sync_time": sync_time, "vllm_sync_bandwidth_gbps": num_bytes / 1e9 / max(sync_time, 1e-6)}
+
+    def _broadcast_params_to_vllm(self, model):
         count, num_params = 0, len(list(model.named_parameters()))
         for name, param in model.named_parameters():
             count += 1  # empty_cache at last param
@@ -235,10 +259,64 @@ class ActorPPOTrainer(PPOTrainer):
                     torch.distributed.barrier()
                     torch.cuda.synchronize()
 
-        if cache_reset_refs:
-            ray.get(cache_reset_refs)
-        torch.cuda.empty_cache()
-        torch.distributed.barrier()
+    def _broadcast_buckets_to_vllm(self, model):
+        """
+        Broadcast the weights flattened into buckets of `vllm_sync_bucket_mb`, with one rpc and one broadcast
+        per bucket. For ZeRO-3, the parameters of a bucket are gathered while the previous bucket is broadcast.
+        """
+        args = self.strategy.args
+        use_ray = getattr(args, "vllm_sync_with_ray", False)
+        bucket_size = args.vllm_sync_bucket_mb * 1024 * 1024
+
+        # group consecutive parameters of the same dtype into buckets
+        buckets, bucket, size = [], [], 0
+        for name, param in model.named_parameters():
+            param_size = getattr(param, "ds_numel", param.numel()) * param.element_size()
+            if bucket and (size + param_size > bucket_size or param.dtype != bucket[0][1].dtype):
+                buckets.append(bucket)
+                bucket, size = [], 0
+            bucket.append((name, param))
+            size += param_size
+        if bucket:
+            buckets.append(bucket)
+
+        in_flight = None
+        for i, bucket in enumerate(buckets):
+            names = [name for name, _ in bucket]
+            params = [param for _, param in bucket]
+            with deepspeed.zero.GatheredParameters(params, enabled=args.zero_stage == 3):
+                if torch.distributed.get_rank() == 0:
+                    flat = torch.cat([param.data.flatten() for param in params])
+
+            if torch.distributed.get_rank() == 0:
+                # the engines receive one bucket at a time
+                if in_flight is not None:
+                    self._wait_bucket(*in_flight)
+
+                shapes = [param.shape if args.zero_stage != 3 else param.ds_shape for param in params]
+                refs = [
+                    engine.update_weight_bucket.remote(
+                        names, dtype=flat.dtype, shapes=shapes, empty_cache=i == len(buckets) - 1
+                    )
+                    for engine in self.vllm_engines
+                ]
+                if use_ray:
+                    import ray.util.collective as collective
+
+                    collective.broadcast(flat, 0, group_name=self._model_update_group)
+                    handle = None
+                else:
+                    handle = torch.distributed.broadcast(flat, 0, group=self._model_update_group, async_op=True)
+                in_flight = (handle, refs, flat)
+
+        if in_flight is not None:
+            self._wait_bucket(*in_flight)
+
+    def _wait_bucket(self, handle, refs, flat):
+        if handle is not None:
+            handle.wait()
+        ray.get(refs)
+        del flat
 
     def _save_checkpoint(self, args, tag, client_states):
         # call remote critic
@@ -379,7 +457,11 @@ class ActorModelRayActor(BasePPORole):
         )
         prompts_data = prompts_data.select(range(min(args.max_samples, len(prompts_data))))
         self.prompts_dataset = PromptDataset(
-            prompts_data, self.tokenizer, strategy, input_template=args.input_template
+            prompts_data,
+            self.tokenizer,
+            strategy,
+            input_template=args.input_template,
+            max_length=args.prompt_max_len if args.vllm_num_engines else None,
         )
         self.prompts_dataloader = strategy.setup_dataloader(
             self.prompts_dataset,
@@ -4,7 +4,6 @@ from typing import Dict, Optional, Union
 
 import ray
 import torch
-from torch.utils.data import DataLoader
 from tqdm import tqdm
 from transformers.trainer import get_scheduler
 
@@ -19,15 +18,7 @@ from .launcher import BasePPORole
 
 class CriticPPOTrainer(PPOTrainer):
     def ppo_train(self):
-        # replay buffer may be empty at first, we should rebuild at each training
-        dataloader = DataLoader(
-            self.replay_buffer,
-            batch_size=self.replay_buffer.sample_batch_size,
-            shuffle=True,
-            drop_last=True,
-            pin_memory=self.dataloader_pin_memory,
-            collate_fn=self.replay_buffer.collate_fn,
-        )
+        dataloader = self.replay_buffer_dataloader()
         device = torch.cuda.current_device()
 
         status_list = []
@@ -40,7 +31,11 @@ class CriticPPOTrainer(PPOTrainer):
             )
             for experience in pbar:
                 experience.to_device(device)
+                self.update_loss_scale(dataloader, experience)
                 status = self.training_step(experience)
+                # the packed samples comes with no padding
+                if experience.attention_mask is not None:
+                    status["padding_efficiency"] = experience.attention_mask.float().mean().item()
 
                 # for DP
                 status = self.strategy.all_reduce(status)
@@ -1,4 +1,6 @@
 import os
+import threading
+from collections import deque
 
 import numpy as np
 import ray
@@ -36,68 +38,199 @@ class LLMRayActor:
 
         # Number of actors that will send prompt to this engine
         self.num_actors = kwargs.pop("num_actors")
-        self.actor_counter = 0
         self.requests = {}
         self.responses = {}
 
+        # Streaming mode: request id -> (actor rank, index of the request), and finished responses per actor
+        self.request_counter = 0
+        self.streaming_requests = {}
+        self.streaming_responses = {}
+        # Finished outputs of the rollout being generated, by request id
+        self.rollout_outputs = {}
+        # Set between `begin_weight_update` and `end_weight_update`, the engine thread does not step meanwhile
+        self.updating_weights = False
+
         self.llm = LLM(*args, **kwargs)
 
+        # The engine is driven by a background thread: it generates the rollouts queued by `add_requests` and
+        # steps the engine for the streaming requests. The actor runs its calls concurrently (see
+        # `max_concurrency` in create_vllm_engines), so actors can fetch the responses of a rollout or send the
+        # next one while the engine is generating. `llm_lock` serialises the access to the engine and `cond`
+        # guards the request and response queues. The rollouts are generated step by step rather than with
+        # `llm.generate`, so that `llm_lock` is only held for one step and weight updates are applied between
+        # two steps instead of waiting for the whole rollout.
+        self.llm_lock = threading.Lock()
+        self.cond = threading.Condition()
+        self.engine_error = None
+        self.engine_thread = threading.Thread(target=self._engine_loop, daemon=True)
+        self.engine_thread.start()
+
+    def _requests_ready(self):
+        return len(self.requests) == self.num_actors and all(self.requests.values())
+
+    def _engine_loop(self):
+        try:
+            while True:
+                with self.cond:
+                    self.cond.wait_for(lambda: self._requests_ready() or self.streaming_requests)
+                    rollout = self._pop_requests() if self._requests_ready() else None
+                if rollout is not None:
+                    self._generate(*rollout)
+                else:
+                    self._step()
+        except Exception as e:
+            logger.error(f"vLLM engine thread failed: {e}")
+            with self.cond:
+                self.engine_error = e
+                self.cond.notify_all()
+
+    def _pop_requests(self):
+        num_requests = []
+        requests = []
+        for actor_rank, queue in self.requests.items():
+            sampling_params, request = queue.popleft()
+            num_requests.append((actor_rank, len(request)))
+            requests.extend(request)
+        return sampling_params, requests, num_requests
+
+    def _new_request_ids(self, num):
+        request_ids = [str(self.request_counter + i) for i in range(num)]
+        self.request_counter += num
+        return request_ids
+
+    def _generate(self, sampling_params, requests, num_requests):
+        # For now we assume that all requests have the same sampling params
+        with self.llm_lock:
+            with self.cond:
+                request_ids = self._new_request_ids(len(requests))
+            for request_id, token_ids in zip(request_ids, requests):
+                self.llm.llm_engine.add_request(request_id, {"prompt_token_ids": token_ids}, sampling_params)
+        while len(self.rollout_outputs) < len(request_ids):
+            self._step()
+
+        with self.cond:
+            responses = [self.rollout_outputs.pop(request_id) for request_id in request_ids]
+            offset = 0
+            for actor_rank, num in num_requests:
+                self.responses.setdefault(actor_rank, deque()).append(responses[offset : offset + num])
+                offset += num
+            self.cond.notify_all()
+
+    def _step(self):
+        with self.cond:
+            self.cond.wait_for(lambda: not self.updating_weights)
+        with self.llm_lock:
+            outputs = self.llm.llm_engine.step()
+        with self.cond:
+            for output in outputs:
+                if not output.finished:
+                    continue
+                if output.request_id in self.streaming_requests:
+                    rank, index = self.streaming_requests.pop(output.request_id)
+                    self.streaming_responses.setdefault(rank, []).append((index, output))
+                else:
+                    self.rollout_outputs[output.request_id] = output
+            self.cond.notify_all()
+
+    def _check_engine_error(self):
+        if self.engine_error is not None:
+            raise RuntimeError("vLLM engine thread failed") from self.engine_error
+
     def init_process_group(self, master_address, master_port, rank_offset, world_size, group_name, backend, use_ray):
-        return self.llm.collective_rpc(
-            "init_process_group",
-            args=(master_address, master_port, rank_offset, world_size, group_name, backend, use_ray),
-        )
+        with self.llm_lock:
+            return self.llm.collective_rpc(
+                "init_process_group",
+                args=(master_address, master_port, rank_offset, world_size, group_name, backend, use_ray),
+            )
+
+    def begin_weight_update(self):
+        """
+        Pause the engine thread until `end_weight_update`, so that no step runs with partially updated weights.
+        The step in progress, if any, finishes first. The rollouts in flight resume with the new weights.
+        """
+        with self.cond:
+            self.updating_weights = True
+        with self.llm_lock:
+            pass
+
+    def end_weight_update(self):
+        with self.cond:
+            self.updating_weights = False
+            self.cond.notify_all()
 
     def update_weight(self, name, dtype, shape, empty_cache=False):
-        return self.llm.collective_rpc("update_weight", args=(name, dtype, shape, empty_cache))
+        with self.llm_lock:
+            return self.llm.collective_rpc("update_weight", args=(name, dtype, shape, empty_cache))
+
+    def update_weight_bucket(self, names, dtype, shapes, empty_cache=False):
+        with self.llm_lock:
+            return self.llm.collective_rpc("update_weight_bucket", args=(names, dtype, shapes, empty_cache))
 
     def update_weight_cuda_ipc(self, name, dtype, shape, ipc_handles, empty_cache=False):
-        return self.llm.collective_rpc("update_weight_cuda_ipc", args=(name, dtype, shape, ipc_handles, empty_cache))
+        with self.llm_lock:
+            return self.llm.collective_rpc(
+                "update_weight_cuda_ipc", args=(name, dtype, shape, ipc_handles, empty_cache)
+            )
 
     def reset_prefix_cache(self):
-        self.llm.llm_engine.reset_prefix_cache()
+        with self.llm_lock:
+            self.llm.llm_engine.reset_prefix_cache()
 
     def sleep(self, level=1):
-        self.llm.sleep(level=level)
+        with self.llm_lock:
+            self.llm.sleep(level=level)
 
     def wake_up(self):
-        self.llm.wake_up()
+        with self.llm_lock:
+            self.llm.wake_up()
 
     def add_requests(self, actor_rank, *, sampling_params, prompt_token_ids):
         """
-        Save the requests from actors and generate responses when all actors have sent their requests
+        Queue the requests from an actor, the engine thread generates the responses once all actors have sent
+        their requests. The requests of an actor are queued, so that actors can send the requests of the next
+        rollouts before fetching the responses of the current one (async rollout).
         """
-        self.requests[actor_rank] = prompt_token_ids
-        self.actor_counter += 1
-        if self.actor_counter == self.num_actors:
-            assert len(self.requests) == self.num_actors
-            num_requests = []
-            requests = []
-            for actor_rank, request in self.requests.items():
-                num_requests.append((actor_rank, len(request)))
-                requests.extend(request)
-
-            if len(requests) > 0:
-                # For now we assume that all requests have the same sampling params
-                responses = self.llm.generate(sampling_params=sampling_params, prompt_token_ids=requests, use_tqdm=False)
-            else:
-                responses = []
-
-            offset = 0
-            self.responses = {}
-            for actor_rank, num in num_requests:
-                self.responses[actor_rank] = responses[offset : offset + num]
-                offset += num
-
-            self.actor_counter = 0
-            self.requests = {}
+        with self.cond:
+            self._check_engine_error()
+            self.requests.setdefault(actor_rank, deque()).append((sampling_params, prompt_token_ids))
+            self.cond.notify_all()
 
     def get_responses(self, actor_rank):
         """
-        Return the responses for the actor with the given rank
+        Return the responses of the oldest rollout of the actor with the given rank, waiting for its generation.
         """
-        return self.responses.pop(actor_rank)
-    
+        with self.cond:
+            self.cond.wait_for(lambda: self.responses.get(actor_rank) or self.engine_error)
+            self._check_engine_error()
+            return self.responses[actor_rank].popleft()
+
+    def add_requests_streaming(self, actor_rank, *, sampling_params, prompt_token_ids):
+        """
+        Add the requests from an actor to the engine right away, without waiting for the other actors.
+        They are decoded by the engine thread and the finished responses are drained with `poll_responses`.
+        """
+        with self.llm_lock:
+            with self.cond:
+                request_ids = self._new_request_ids(len(prompt_token_ids))
+                for index, request_id in enumerate(request_ids):
+                    self.streaming_requests[request_id] = (actor_rank, index)
+            for request_id, token_ids in zip(request_ids, prompt_token_ids):
+                self.llm.llm_engine.add_request(request_id, {"prompt_token_ids": token_ids}, sampling_params)
+        with self.cond:
+            self.cond.notify_all()
+
+    def poll_responses(self, actor_rank, timeout=0.0):
+        """
+        Return the responses of the actor with the given rank finished since the last call, as a list of
+        (index, RequestOutput), index being the position of the request in the `prompt_token_ids` sent by the
+        actor. The engine is stepped by the engine thread, so this only drains the finished responses, waiting
+        up to `timeout` seconds when there are none yet. The list may be empty.
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.streaming_responses.get(actor_rank) or self.engine_error, timeout=timeout)
+            self._check_engine_error()
+            return self.streaming_responses.pop(actor_rank, [])
+
     def __repr__(self):
         return "VLLM"
 
@@ -161,6 +294,8 @@ def create_vllm_engines(
             LLMRayActor.options(
                 num_cpus=0,
                 num_gpus=num_gpus,
+                # every actor may wait in get_responses, plus room for the calls sending requests and weights
+                max_concurrency=num_actors + 4,
                 scheduling_strategy=scheduling_strategy,
             ).remote(
                 model=pretrain,
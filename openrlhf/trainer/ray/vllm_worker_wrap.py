@@ -1,3 +1,5 @@
+import math
+
 import torch
 from vllm.worker.worker import Worker
 
@@ -57,6 +59,23 @@ class WorkerWrap(Worker):
         # if empty_cache:
         #     torch.cuda.empty_cache()
 
+    def update_weight_bucket(self, names, dtype, shapes, empty_cache=False):
+        """Broadcast a bucket of flattened weights to all vllm workers from source rank 0 (actor model)"""
+        assert dtype == self.model_config.dtype, f"mismatch dtype: src {dtype}, dst {self.model_config.dtype}"
+        numels = [math.prod(shape) for shape in shapes]
+        bucket = torch.empty(sum(numels), dtype=dtype, device="cuda")
+        if self._model_update_with_ray:
+            import ray.util.collective as collective
+
+            collective.broadcast(bucket, 0, group_name=self._model_update_group)
+        else:
+            torch.distributed.broadcast(bucket, 0, group=self._model_update_group)
+
+        weights = [(name, weight.view(shape)) for name, weight, shape in zip(names, bucket.split(numels), shapes)]
+        self.model_runner.model.load_weights(weights=weights)
+
+        del weights, bucket
+
     def update_weight_cuda_ipc(self, name, dtype, shape, ipc_handles=None, empty_cache=False):
         if torch.distributed.get_rank() == 0:
             print(f"update weight: {name}, dtype: {dtype}, shape: {shape}")
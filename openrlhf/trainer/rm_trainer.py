@@ -6,7 +6,7 @@ from torch.optim import Optimizer
 from tqdm import tqdm
 
 from openrlhf.models import LogExpLoss, PairWiseLoss
-from openrlhf.utils.distributed_sampler import DistributedSampler
+from openrlhf.utils.distributed_sampler import DistributedSampler, PackingBatchSampler
 
 
 class RewardModelTrainer(ABC):
@@ -118,6 +118,10 @@ class RewardModelTrainer(ABC):
                 self.train_dataloader.sampler.set_epoch(
                     epoch, consumed_samples=0 if epoch > start_epoch else consumed_samples
                 )
+            elif isinstance(self.train_dataloader.batch_sampler, PackingBatchSampler):
+                self.train_dataloader.batch_sampler.set_epoch(
+                    epoch, consumed_samples=0 if epoch > start_epoch else consumed_samples
+                )
 
             #  train
             step_bar = tqdm(
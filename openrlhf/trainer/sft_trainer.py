@@ -2,11 +2,13 @@ import os
 from abc import ABC
 
 import torch
+import torch.distributed as dist
 from torch.optim import Optimizer
 from tqdm import tqdm
 
+from openrlhf.datasets import StreamingSFTDataset
 from openrlhf.models import GPTLMLoss
-from openrlhf.utils.distributed_sampler import DistributedSampler
+from openrlhf.utils.distributed_sampler import DistributedSampler, PackingBatchSampler
 
 
 class SFTTrainer(ABC):
@@ -123,6 +125,10 @@ class SFTTrainer(ABC):
                 self.train_dataloader.sampler.set_epoch(
                     epoch, consumed_samples=0 if epoch > start_epoch else consumed_samples
                 )
+            elif isinstance(self.train_dataloader.batch_sampler, PackingBatchSampler):
+                self.train_dataloader.batch_sampler.set_epoch(
+                    epoch, consumed_samples=0 if epoch > start_epoch else consumed_samples
+                )
 
             step_bar = tqdm(
                 range(self.train_dataloader.__len__()),
@@ -237,6 +243,11 @@ class SFTTrainer(ABC):
         # TODO: save best model on dev, use loss/perplexity on whole dev dataset as metric
         if global_step % args.save_steps == 0:
             tag = f"global_step{global_step}"
+            if isinstance(self.train_dataloader.dataset, StreamingSFTDataset):
+                # position of every rank in the stream, to resume without replaying it
+                dataset_states = [None] * dist.get_world_size()
+                dist.all_gather_object(dataset_states, self.train_dataloader.dataset.state_dict())
+                client_states = {**client_states, "dataset_states": dataset_states}
             if not self.disable_ds_ckpt:
                 self.strategy.save_ckpt(
                     self.model.model, args.ckpt_path, tag, args.max_ckpt_num, args.max_ckpt_mem, client_states
@@ -15,11 +15,11 @@ from deepspeed.ops.adam import DeepSpeedCPUAdam, FusedAdam
 from peft import PeftModel, get_peft_model_state_dict
 from torch import distributed as dist
 from torch.optim import Optimizer
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, IterableDataset
 
 from openrlhf.models import Actor
 from openrlhf.models.ring_attn_utils import get_ring_attn_group, set_ring_attn_group
-from openrlhf.utils.distributed_sampler import DistributedSampler
+from openrlhf.utils.distributed_sampler import DistributedSampler, LazyDistributedSampler, PackingBatchSampler
 
 from .deepspeed_utils import (
     _z3_params_to_fetch,
@@ -150,12 +150,51 @@ class DeepspeedStrategy(ABC):
         drop_last=True,
         sampler=None,
         consumed_samples=0,
+        packing_max_tokens=None,
     ):
+        if packing_max_tokens:
+            # plan the packs of at most packing_max_tokens tokens from the sample lengths of the dataset
+            batch_sampler = PackingBatchSampler(
+                replay_buffer.sample_lengths(),
+                packing_max_tokens,
+                num_replicas=dist.get_world_size() // self.ring_attn_size,
+                rank=dist.get_rank() // self.ring_attn_size,
+                shuffle=shuffle,
+                seed=self.seed,
+                drop_last=drop_last,
+                batch_size=batch_size,
+                consumed_samples=consumed_samples,
+            )
+            stats = batch_sampler.stats
+            self.print(
+                f"Packing {len(replay_buffer)} samples into {stats['num_packs']} packs of at most {packing_max_tokens} "
+                f"tokens ({stats['samples_per_pack']:.1f} samples per pack), token utilization: "
+                f"{stats['packing_utilization']:.2%} packed vs {stats['padding_utilization']:.2%} padded "
+                f"with micro batch size {batch_size}"
+            )
+            return DataLoader(
+                replay_buffer,
+                batch_sampler=batch_sampler,
+                collate_fn=collate_fn,
+                pin_memory=pin_memory,
+            )
+
+        if isinstance(replay_buffer, IterableDataset):
+            # streaming datasets are already sharded across the ranks
+            return DataLoader(
+                replay_buffer,
+                batch_size=batch_size,
+                drop_last=drop_last,
+                collate_fn=collate_fn,
+                pin_memory=pin_memory,
+            )
+
         # DDP only mode, replay buffers on each rank are different.
         if sampler is None:
             num_replicas = dist.get_world_size() // self.ring_attn_size
             rank = dist.get_rank() // self.ring_attn_size
-            sampler = DistributedSampler(
+            sampler_cls = LazyDistributedSampler if getattr(self.args, "lazy_sampler", False) else DistributedSampler
+            sampler = sampler_cls(
                 replay_buffer,
                 num_replicas=num_replicas,
                 rank=rank,
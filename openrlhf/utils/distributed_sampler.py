@@ -1,13 +1,14 @@
 import math
-from typing import Iterator, Optional, TypeVar
+from typing import Iterator, List, Optional, TypeVar
 
+import numpy as np
 import torch
 import torch.distributed as dist
 from torch.utils.data.dataset import Dataset
 from torch.utils.data.sampler import Sampler
 
 
-__all__ = ["DistributedSampler"]
+__all__ = ["DistributedSampler", "LazyDistributedSampler", "PackingBatchSampler"]
 
 
 _T_co = TypeVar("_T_co", covariant=True)
@@ -149,3 +150,224 @@ class DistributedSampler(Sampler[_T_co]):
         """
         self.epoch = epoch
         self.consumed_indicies = consumed_samples // self.num_replicas
+
+
+_MASK64 = (1 << 64) - 1
+
+
+def _mix64(x: int) -> int:
+    # splitmix64 finalizer
+    x = (x + 0x9E3779B97F4A7C15) & _MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return x ^ (x >> 31)
+
+
+class FeistelPermutation:
+    """
+    Keyed pseudo-random permutation of range(n), computing the i-th element in O(1) time and memory.
+
+    A balanced Feistel network permutes the integers of the smallest even number of bits holding n - 1, and
+    cycle walking (applying it again until the result is below n) restricts it to range(n). The domain is
+    less than 4n, so fewer than 4 rounds of walking are needed on average.
+    """
+
+    def __init__(self, n: int, key: int, num_rounds: int = 4) -> None:
+        self.n = n
+        self.half_bits = max(1, ((n - 1).bit_length() + 1) // 2)
+        self.mask = (1 << self.half_bits) - 1
+        self.round_keys = [_mix64((key & _MASK64) ^ _mix64(r)) for r in range(num_rounds)]
+
+    def _encrypt(self, x: int) -> int:
+        left, right = x >> self.half_bits, x & self.mask
+        for round_key in self.round_keys:
+            left, right = right, left ^ (_mix64(right ^ round_key) & self.mask)
+        return (left << self.half_bits) | right
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __getitem__(self, i: int) -> int:
+        if not 0 <= i < self.n:
+            raise IndexError(f"index {i} out of range for a permutation of {self.n}")
+        x = self._encrypt(i)
+        while x >= self.n:
+            x = self._encrypt(x)
+        return x
+
+
+class LazyDistributedSampler(DistributedSampler):
+    r"""
+    :class:`DistributedSampler` that never materializes the index list of the dataset.
+
+    The shuffled order is a :class:`FeistelPermutation` keyed by the seed and the epoch, so the index at any
+    position is computed on the fly. Epoch start, :meth:`set_epoch` and skipping `consumed_samples` on resume take
+    constant time and memory, which matters for corpora of hundreds of millions of samples. The order is
+    deterministic and the same on all ranks, but differs from the order of :class:`DistributedSampler`.
+    """
+
+    def __iter__(self) -> Iterator[_T_co]:
+        dataset_size = len(self.dataset)  # type: ignore[arg-type]
+        if self.shuffle:
+            # deterministically shuffle based on epoch and seed
+            permutation = FeistelPermutation(dataset_size, _mix64(self.seed) ^ self.epoch)
+        else:
+            permutation = range(dataset_size)
+
+        # positions of this rank in the (padded or truncated) permutation, without the consumed samples;
+        # positions past the end of the dataset wrap around to add extra samples, like DistributedSampler
+        for j in range(self.consumed_indicies, self.num_samples):
+            yield permutation[(self.rank + j * self.num_replicas) % dataset_size]
+
+
+def first_fit_decreasing(lengths: List[int], order: List[int], max_tokens: int) -> List[List[int]]:
+    """
+    Pack the items visited in `order` (by decreasing length) into packs of at most `max_tokens` tokens, every item
+    going to the first pack with enough room left. A segment tree over the room left in the packs finds that pack
+    in O(log n). An item longer than `max_tokens` gets a pack of its own. Returns the packs as positions in `order`.
+    """
+    size = 1
+    while size < len(order):
+        size *= 2
+    room = [max_tokens] * (2 * size)  # max room left over the packs below every node, unopened packs included
+    packs, oversized = [], []
+    for pos, idx in enumerate(order):
+        length = lengths[idx]
+        if length > max_tokens:
+            oversized.append([pos])
+            continue
+
+        node = 1
+        while node < size:
+            node = 2 * node if room[2 * node] >= length else 2 * node + 1
+        pack_idx = node - size
+        if pack_idx == len(packs):
+            packs.append([])
+        packs[pack_idx].append(pos)
+
+        room[node] -= length
+        node //= 2
+        while node:
+            room[node] = max(room[2 * node], room[2 * node + 1])
+            node //= 2
+    return packs + oversized
+
+
+class PackingBatchSampler(Sampler[List[int]]):
+    r"""Batch sampler that packs the samples of a dataset into batches of at most `max_tokens` tokens.
+
+    The packing is planned once with first-fit-decreasing over the sample lengths. Samples of the same length are
+    interchangeable in the plan, so every epoch they are shuffled among themselves and the packs are shuffled, which
+    keeps the number of packs (and the token utilization) the same for every epoch. The packs are then split between
+    the replicas like :class:`DistributedSampler` splits the samples.
+
+    Args:
+        lengths: Number of tokens of every sample of the dataset.
+        max_tokens: Token budget of a pack.
+        num_replicas (int, optional): Number of processes participating in distributed training.
+        rank (int, optional): Rank of the current process within :attr:`num_replicas`.
+        shuffle (bool, optional): If ``True`` (default), the packs are shuffled every epoch.
+        seed (int, optional): Random seed used to shuffle the packs. Defaults to 0.
+        drop_last (bool, optional): If ``True``, drop the tail packs to make the number of packs evenly divisible
+            across the replicas. If ``False``, repeat packs instead. Defaults to ``False``.
+        batch_size (int, optional): Micro batch size of the training without packing. `consumed_samples` is counted as
+            `batch_size` samples per pack and replica, like the trainers do, and the padding utilization of batches of
+            `batch_size` samples is reported in :attr:`stats` for comparison. Defaults to 1.
+        consumed_samples (int, optional): Number of samples consumed in the current epoch, to resume training.
+    """
+
+    def __init__(
+        self,
+        lengths: List[int],
+        max_tokens: int,
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+        shuffle: bool = True,
+        seed: int = 0,
+        drop_last: bool = False,
+        batch_size: int = 1,
+        consumed_samples=0,
+    ) -> None:
+        if num_replicas is None:
+            num_replicas = dist.get_world_size()
+        if rank is None:
+            rank = dist.get_rank()
+        if rank >= num_replicas or rank < 0:
+            raise ValueError(f"Invalid rank {rank}, rank should be in the interval [0, {num_replicas - 1}]")
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.max_tokens = max_tokens
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.batch_size = batch_size
+        self.epoch = 0
+
+        # stable sort: samples of the same length stay in index order
+        self.order = np.argsort(-self.lengths, kind="stable")
+        self.packs = first_fit_decreasing(self.lengths.tolist(), self.order.tolist(), max_tokens)
+
+        if self.drop_last and len(self.packs) % self.num_replicas != 0:
+            self.num_batches = len(self.packs) // self.num_replicas
+        else:
+            self.num_batches = math.ceil(len(self.packs) / self.num_replicas)
+        self.total_size = self.num_batches * self.num_replicas
+        self.consumed_batches = consumed_samples // (self.num_replicas * self.batch_size)
+        self.stats = self._compute_stats()
+
+    def _compute_stats(self):
+        num_tokens = int(self.lengths.sum())
+        pack_ids = np.repeat(np.arange(len(self.packs)), [len(pack) for pack in self.packs])
+        positions = np.fromiter((pos for pack in self.packs for pos in pack), dtype=np.int64, count=len(pack_ids))
+        pack_tokens = np.bincount(pack_ids, weights=self.lengths[self.order[positions]], minlength=len(self.packs))
+        packed_tokens = np.maximum(pack_tokens, self.max_tokens).sum()
+
+        # padded micro batches of `batch_size` samples in random order, as without packing
+        g = torch.Generator()
+        g.manual_seed(self.seed)
+        lengths = self.lengths[torch.randperm(len(self.lengths), generator=g).numpy()]
+        lengths = np.pad(lengths, (0, -len(lengths) % self.batch_size)).reshape(-1, self.batch_size)
+        padded_tokens = (lengths.max(axis=1) * (lengths > 0).sum(axis=1)).sum()
+        return {
+            "num_packs": len(self.packs),
+            "samples_per_pack": len(self.lengths) / max(len(self.packs), 1),
+            "packing_utilization": float(num_tokens / max(packed_tokens, 1)),
+            "padding_utilization": float(num_tokens / max(padded_tokens, 1)),
+        }
+
+    def __iter__(self) -> Iterator[List[int]]:
+        order = self.order
+        packs = list(range(len(self.packs)))
+        if self.shuffle:
+            # deterministically shuffle based on epoch and seed
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            # shuffle the samples of the same length among themselves, then the packs
+            keys = torch.randperm(len(self.lengths), generator=g).numpy()
+            order = np.lexsort((keys, -self.lengths))
+            packs = torch.randperm(len(self.packs), generator=g).tolist()
+
+        if not self.drop_last:
+            # add extra packs to make it evenly divisible
+            padding_size = self.total_size - len(packs)
+            packs += (packs * math.ceil(padding_size / max(len(packs), 1)))[:padding_size]
+        else:
+            # remove tail of packs to make it evenly divisible.
+            packs = packs[: self.total_size]
+        assert len(packs) == self.total_size
+
+        # subsample
+        packs = packs[self.rank : self.total_size : self.num_replicas]
+        # skip consumed batches
+        packs = packs[self.consumed_batches :]
+
+        for pack in packs:
+            yield order[self.packs[pack]].tolist()
+
+    def __len__(self) -> int:
+        return self.num_batches - self.consumed_batches
+
+    def set_epoch(self, epoch: int, consumed_samples=0) -> None:
+        self.epoch = epoch
+        self.consumed_batches = consumed_samples // (self.num_replicas * self.batch_size)
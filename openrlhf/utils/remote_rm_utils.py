@@ -1,13 +1,162 @@
+import hashlib
+import importlib.util
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import re
+import sqlite3
+import threading
 import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import ray
 import requests
 import torch
+from multiprocessing.connection import wait
+from requests.adapters import HTTPAdapter
 
 from openrlhf.utils.logging_utils import init_logger
 
 logger = init_logger(__name__)
 
 
+# Content-Type of the token ids requests, see encode_token_ids
+TOKEN_IDS_CONTENT_TYPE = "application/x-openrlhf-token-ids"
+
+
+def encode_token_ids(batch_ids) -> bytes:
+    """
+    Encodes a batch of token ids as little-endian int32 arrays: the number of sequences, their lengths and
+    the concatenated ids.
+    """
+    lengths = np.array([len(ids) for ids in batch_ids], dtype="<i4")
+    ids = np.fromiter(itertools.chain.from_iterable(batch_ids), dtype="<i4", count=int(lengths.sum()))
+    return np.array([len(batch_ids)], dtype="<i4").tobytes() + lengths.tobytes() + ids.tobytes()
+
+
+def decode_token_ids(data: bytes):
+    """Inverse of encode_token_ids."""
+    array = np.frombuffer(data, dtype="<i4")
+    lengths = array[1 : 1 + array[0]]
+    ids = array[1 + array[0] :].tolist()
+    offsets = [0] + np.cumsum(lengths).tolist()
+    return [ids[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+class RewardCache:
+    """
+    Bounded LRU cache of rewards, keyed by a hash of the reward model identity and the query text.
+
+    Responses sampled from the same prompt are often identical, and the same (prompt, response) pairs recur
+    across episodes, so their rewards can be reused instead of recomputed. The in-memory tier is private to the
+    process. With `cache_dir`, the rewards are also stored in an SQLite file there, which persists across
+    restarts and is shared by the processes using the same directory.
+
+    Args:
+        namespace: identity of the reward model, part of every key
+        max_entries: max number of rewards kept in memory
+        cache_dir: directory of the on-disk tier, disabled if None
+    """
+
+    def __init__(self, namespace: str, max_entries: int = 100000, cache_dir: str = None) -> None:
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.db = None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.db = sqlite3.connect(
+                os.path.join(cache_dir, "reward_cache.sqlite"), timeout=60, check_same_thread=False
+            )
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS rewards (key TEXT PRIMARY KEY, reward TEXT)")
+            self.db.commit()
+
+        self.lookups = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def key(self, *texts) -> str:
+        return hashlib.sha256(json.dumps([self.namespace, *texts]).encode()).hexdigest()
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if self.db is not None:
+            row = self.db.execute("SELECT reward FROM rewards WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self.disk_hits += 1
+                reward = json.loads(row[0])
+                self._put_memory(key, reward)
+                return reward
+        return None
+
+    def _put_memory(self, key, reward):
+        self.entries[key] = reward
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def put_many(self, keys, rewards):
+        for key, reward in zip(keys, rewards):
+            self._put_memory(key, reward)
+        if self.db is not None:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO rewards VALUES (?, ?)",
+                [(key, json.dumps(reward)) for key, reward in zip(keys, rewards)],
+            )
+            self.db.commit()
+
+    def lookup(self, keys):
+        """
+        Returns the cached rewards of keys (None when missing) and the indices of the first occurrence of
+        every missing key, i.e. the queries to score.
+        """
+        rewards = [self.get(key) for key in keys]
+        missing = {}
+        for i, (key, reward) in enumerate(zip(keys, rewards)):
+            if reward is None and key not in missing:
+                missing[key] = i
+        self.lookups += 1
+        self.misses += len(missing)
+        self.hits += len(keys) - len(missing)
+        return rewards, list(missing.values())
+
+    def fill(self, keys, rewards, missing, missing_rewards):
+        """Stores the rewards of the missing queries returned by `lookup` and returns the rewards of all keys."""
+        missing_keys = [keys[i] for i in missing]
+        self.put_many(missing_keys, missing_rewards)
+        computed = dict(zip(missing_keys, missing_rewards))
+        return [computed[key] if reward is None else reward for key, reward in zip(keys, rewards)]
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / max(self.hits + self.misses, 1),
+            "entries": len(self.entries),
+        }
+
+
+_reward_caches = {}
+
+
+def get_reward_cache(namespace, max_entries, cache_dir=None):
+    """Reward cache of this process for the reward model `namespace`, created on first use."""
+    key = (namespace, max_entries, cache_dir)
+    if key not in _reward_caches:
+        _reward_caches[key] = RewardCache(namespace, max_entries, cache_dir)
+    return _reward_caches[key]
+
+
 def request_api_wrapper(url, data, score_key="rewards", try_max_times=5):
     """Synchronous request API wrapper"""
     headers = {
@@ -29,20 +178,380 @@ def request_api_wrapper(url, data, score_key="rewards", try_max_times=5):
     raise Exception(f"Request error for {try_max_times} times, returning None. Please check the API server.")
 
 
-def remote_rm_fn(api_url, queries, prompts, score_key="rewards"):
+class RemoteRewardClient:
+    """
+    HTTP client of a remote reward model served by one or more replicas.
+
+    The connections are kept alive in a pool shared by all calls. A batch of queries is split into chunks
+    of `chunk_size` (by default one chunk per replica) which are sent concurrently, each to the replica with
+    the fewest outstanding requests. Failed requests are retried on the least loaded replica after an
+    exponential backoff with full jitter.
+
+    Args:
+        urls: URLs of the replicas
+        score_key: RM score key
+        chunk_size: max number of queries per request, None to split the batch evenly across the replicas
+        max_concurrency: max number of requests in flight
+        timeout: timeout of a request in seconds
+        try_max_times: max number of attempts of a request
+    """
+
+    def __init__(
+        self, urls, score_key="rewards", chunk_size=None, max_concurrency=8, timeout=180, try_max_times=5
+    ) -> None:
+        self.urls = urls
+        self.score_key = score_key
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.try_max_times = try_max_times
+        self.backoff = 0.5
+        self.max_backoff = 30
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(urls), pool_maxsize=max_concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+        self.lock = threading.Lock()
+        self.outstanding = {url: 0 for url in urls}
+
+    def acquire_url(self):
+        with self.lock:
+            # least outstanding requests, ties broken at random
+            url = min(self.urls, key=lambda url: (self.outstanding[url], random.random()))
+            self.outstanding[url] += 1
+        return url
+
+    def release_url(self, url):
+        with self.lock:
+            self.outstanding[url] -= 1
+
+    def post(self, data):
+        if "query_ids" in data:
+            # token ids are sent in the binary encoding, the prompts are not needed by the RM
+            request = {
+                "data": encode_token_ids(data["query_ids"]),
+                "headers": {"Content-Type": TOKEN_IDS_CONTENT_TYPE},
+            }
+        else:
+            request = {"json": data}
+        for attempt in range(self.try_max_times):
+            url = self.acquire_url()
+            try:
+                response = self.session.post(url=url, timeout=self.timeout, **request)
+                response.raise_for_status()  # Raise an HTTPError for bad responses
+                response = response.json()
+                assert self.score_key in response, f"{self.score_key} not in {response}"
+                return response.get(self.score_key)
+            except requests.RequestException as e:
+                logger.info(f"Request error to {url}, please check: {e}")
+            except Exception as e:
+                logger.info(f"Unexpected error from {url}, please check: {e}")
+            finally:
+                self.release_url(url)
+            if attempt + 1 < self.try_max_times:
+                time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt)))
+
+        raise Exception(f"Request error for {self.try_max_times} times, returning None. Please check the API server.")
+
+    def get_rewards(self, queries, prompts, token_ids=False):
+        """Rewards of the queries, which are token ids of the RM tokenizer if token_ids else texts."""
+        query_key = "query_ids" if token_ids else "query"
+        chunk_size = self.chunk_size or math.ceil(len(queries) / len(self.urls))
+        chunks = [
+            {query_key: queries[i : i + chunk_size], "prompts": prompts[i : i + chunk_size]}
+            for i in range(0, len(queries), max(chunk_size, 1))
+        ]
+        if len(chunks) == 1:
+            return self.post(chunks[0])
+        return [score for scores in self.executor.map(self.post, chunks) for score in scores]
+
+
+_remote_reward_clients = {}
+
+
+def get_remote_reward_client(api_url, score_key="rewards", chunk_size=None, max_concurrency=8):
+    """
+    Client of this process for api_url, created on first use so that its connections are reused.
+    api_url may list several replicas of the same RM separated by "|".
+    """
+    key = (api_url, score_key, chunk_size, max_concurrency)
+    if key not in _remote_reward_clients:
+        _remote_reward_clients[key] = RemoteRewardClient(api_url.split("|"), score_key, chunk_size, max_concurrency)
+    return _remote_reward_clients[key]
+
+
+def normalize_query(query, special_tokens):
+    """
+    Strips the leading and trailing `special_tokens` (pad / EOS) of a query, either a text or token ids,
+    like the RM server does before scoring, so that differently padded copies share a cache key.
+    """
+    special_tokens = [token for token in special_tokens if token is not None]
+    if not special_tokens:
+        return query
+    if isinstance(query, str):
+        pattern = "|".join(re.escape(token) for token in special_tokens)
+        return re.sub(f"({pattern})+$", "", re.sub(f"^({pattern})+", "", query))
+    start, end = 0, len(query)
+    while start < end and query[start] in special_tokens:
+        start += 1
+    while end > start and query[end - 1] in special_tokens:
+        end -= 1
+    return query[start:end]
+
+
+def remote_rm_fn(
+    api_url,
+    queries,
+    prompts,
+    score_key="rewards",
+    cache_size=0,
+    cache_dir=None,
+    chunk_size=None,
+    max_concurrency=8,
+    token_ids=False,
+    special_tokens=(),
+    cache_namespace=None,
+):
     """remote reward model API
     api_url: RM API, We assume that the API supports two modes: merging query + response and not merging
     queries: query+response with the template
     design is made optional.
+    token_ids: queries are the token ids of query+response, sent in the binary encoding to RMs sharing the
+    policy tokenizer
     score_key: RM score key
+    cache_size: cache the rewards of up to cache_size (query, prompt) pairs in memory, disabled if 0
+    cache_dir: directory of the on-disk reward cache, disabled if None
+    chunk_size: max number of queries per request, see RemoteRewardClient
+    max_concurrency: max number of requests in flight
+    special_tokens: pad / EOS tokens (ids if token_ids) stripped from the ends of the queries for the cache keys
+    cache_namespace: identity of the RM in the cache keys, so that the rewards of another RM served at the same
+    URL are not reused from the on-disk cache
     """
-    scores = request_api_wrapper(api_url, {"query": queries, "prompts": prompts}, score_key)
+    client = get_remote_reward_client(api_url, score_key, chunk_size, max_concurrency)
+    if not cache_size and not cache_dir:
+        scores = client.get_rewards(queries, prompts, token_ids)
+        return torch.tensor(scores)
+
+    cache = get_reward_cache(f"{cache_namespace}|{api_url}|{score_key}", cache_size, cache_dir)
+    keys = [cache.key(normalize_query(query, special_tokens), prompt) for query, prompt in zip(queries, prompts)]
+    scores, missing = cache.lookup(keys)
+    missing_scores = []
+    if missing:
+        missing_scores = client.get_rewards(
+            [queries[i] for i in missing], [prompts[i] for i in missing], token_ids
+        )
+    scores = cache.fill(keys, scores, missing, missing_scores)
+    if cache.lookups % 100 == 0:
+        logger.info(f"Reward cache of {api_url}: {cache.stats()}")
     return torch.tensor(scores)
 
 
 @ray.remote
-def remote_rm_fn_ray(api_url, queries, prompts, score_key="rewards"):
-    return remote_rm_fn(api_url, queries, prompts, score_key)
+def remote_rm_fn_ray(
+    api_url,
+    queries,
+    prompts,
+    score_key="rewards",
+    cache_size=0,
+    cache_dir=None,
+    chunk_size=None,
+    max_concurrency=8,
+    token_ids=False,
+    special_tokens=(),
+    cache_namespace=None,
+):
+    # Ray runs these tasks in pooled worker processes, each with its own in-memory reward cache that only
+    # the tasks landing on the same worker reuse: cache_dir is the tier shared by all of them.
+    return remote_rm_fn(
+        api_url,
+        queries,
+        prompts,
+        score_key,
+        cache_size,
+        cache_dir,
+        chunk_size,
+        max_concurrency,
+        token_ids,
+        special_tokens,
+        cache_namespace,
+    )
+
+
+def _reward_func_worker(reward_func_path, conn):
+    try:
+        spec = importlib.util.spec_from_file_location("reward_func", reward_func_path)
+        reward_module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(reward_module)
+    except Exception as e:
+        conn.send((False, repr(e), 0.0))
+        return
+    # ready, the timeouts do not include the start-up of the worker
+    conn.send((True, None, 0.0))
+
+    while True:
+        task = conn.recv()
+        if task is None:
+            return
+        queries, prompts = task
+        start = time.perf_counter()
+        try:
+            rewards = torch.as_tensor(reward_module.reward_func(queries, prompts), dtype=torch.float).flatten()
+            assert len(rewards) == len(queries), f"{len(rewards)} rewards for {len(queries)} queries"
+            conn.send((True, rewards.tolist(), time.perf_counter() - start))
+        except Exception as e:
+            conn.send((False, repr(e), time.perf_counter() - start))
+
+
+class RewardFuncExecutor:
+    """
+    Runs the custom `reward_func(queries, prompts)` of reward_func_path over a pool of worker processes.
+
+    A batch is split into chunks of `chunk_size` samples (1 scores every sample on its own, larger chunks
+    suit batched reward functions) which are scored concurrently. A chunk that raises, takes longer than
+    `timeout` seconds or crashes its worker gets `default_reward`; hung and crashed workers are replaced, so
+    one bad sample never stalls the batch. `metrics` reports the per-sample latency percentiles and the
+    failure counts.
+
+    Args:
+        reward_func_path: path of the .py file defining reward_func
+        num_workers: number of worker processes
+        timeout: max time in seconds to score a chunk
+        chunk_size: number of samples passed to reward_func at once
+        default_reward: reward of the samples that failed
+        load_timeout: max time in seconds for a worker to load reward_func_path when no worker is ready
+    """
+
+    def __init__(
+        self, reward_func_path, num_workers, timeout=30, chunk_size=1, default_reward=0.0, load_timeout=600
+    ) -> None:
+        self.reward_func_path = reward_func_path
+        self.timeout = timeout
+        self.load_timeout = load_timeout
+        self.chunk_size = chunk_size
+        self.default_reward = default_reward
+        # spawn, as forking a process holding CUDA or Ray state is unsafe
+        self.ctx = multiprocessing.get_context("spawn")
+        self.workers = [self.start_worker() for _ in range(num_workers)]
+        self.ready = [False] * num_workers
+
+        self.num_calls = 0
+        self.num_errors = 0
+        self.num_timeouts = 0
+        self.num_crashes = 0
+        self.latencies = deque(maxlen=10000)
+
+    def start_worker(self):
+        conn, child_conn = self.ctx.Pipe()
+        process = self.ctx.Process(target=_reward_func_worker, args=(self.reward_func_path, child_conn), daemon=True)
+        process.start()
+        child_conn.close()
+        self.load_deadline = time.monotonic() + self.load_timeout
+        return process, conn
+
+    def restart_worker(self, i):
+        process, conn = self.workers[i]
+        process.kill()
+        process.join()
+        conn.close()
+        self.workers[i] = self.start_worker()
+        self.ready[i] = False
+
+    def get_rewards(self, queries, prompts):
+        rewards = [self.default_reward] * len(queries)
+        chunks = deque(range(0, len(queries), self.chunk_size))
+        idle = [i for i in range(len(self.workers)) if self.ready[i]]
+        running = {}  # worker index -> (chunk start, deadline)
+
+        while chunks or running:
+            while chunks and idle:
+                i, start = idle.pop(), chunks.popleft()
+                try:
+                    end = start + self.chunk_size
+                    self.workers[i][1].send((queries[start:end], prompts[start:end]))
+                except (BrokenPipeError, OSError):
+                    # the worker died while idle
+                    self.num_crashes += 1
+                    self.restart_worker(i)
+                    chunks.appendleft(start)
+                    continue
+                running[i] = (start, time.monotonic() + self.timeout)
+
+            # wait for the running chunks and the workers starting up
+            conns = {conn: i for i, (_, conn) in enumerate(self.workers) if i in running or not self.ready[i]}
+            timeout = None
+            if running:
+                timeout = max(min(deadline for _, deadline in running.values()) - time.monotonic(), 0)
+            elif not any(self.ready):
+                # a hanging import of reward_func_path must not stall the trainer forever
+                if time.monotonic() > self.load_deadline:
+                    raise RuntimeError(f"Timed out loading reward_func from {self.reward_func_path}")
+                timeout = max(self.load_deadline - time.monotonic(), 0)
+            for conn in wait(list(conns), timeout=timeout):
+                i = conns[conn]
+                try:
+                    ok, result, elapsed = conn.recv()
+                except (EOFError, OSError):
+                    if not self.ready[i]:
+                        raise RuntimeError(f"Reward function worker crashed loading {self.reward_func_path}")
+                    start, _ = running.pop(i)
+                    self.num_crashes += 1
+                    logger.info(f"Reward function worker crashed on samples {start} to {start + self.chunk_size}")
+                    self.restart_worker(i)
+                    continue
+
+                if not self.ready[i]:
+                    if not ok:
+                        raise RuntimeError(f"Failed to load reward_func from {self.reward_func_path}: {result}")
+                    self.ready[i] = True
+                    idle.append(i)
+                    continue
+
+                start, _ = running.pop(i)
+                idle.append(i)
+                if ok:
+                    rewards[start : start + len(result)] = result
+                    self.latencies.extend([elapsed / len(result)] * len(result))
+                else:
+                    self.num_errors += 1
+                    logger.info(f"Reward function error on samples {start} to {start + self.chunk_size}: {result}")
+
+            now = time.monotonic()
+            for i, (start, deadline) in list(running.items()):
+                if deadline <= now:
+                    self.num_timeouts += 1
+                    logger.info(f"Reward function timed out on samples {start} to {start + self.chunk_size}")
+                    self.restart_worker(i)
+                    running.pop(i)
+
+        self.num_calls += 1
+        if self.num_calls % 10 == 0:
+            logger.info(f"Reward function executor: {self.metrics()}")
+        return torch.tensor(rewards)
+
+    def metrics(self):
+        latencies = torch.tensor(list(self.latencies) or [0.0])
+        p50, p90, p99 = torch.quantile(latencies, torch.tensor([0.5, 0.9, 0.99])).tolist()
+        return {
+            "latency_p50_ms": 1000 * p50,
+            "latency_p90_ms": 1000 * p90,
+            "latency_p99_ms": 1000 * p99,
+            "latency_max_ms": 1000 * latencies.max().item(),
+            "num_errors": self.num_errors,
+            "num_timeouts": self.num_timeouts,
+            "num_crashes": self.num_crashes,
+        }
+
+    def close(self):
+        for process, conn in self.workers:
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            process.join(timeout=5)
+            if process.is_alive():
+                process.kill()
 
 
 if __name__ == "__main__":
@@ -1,6 +1,8 @@
 import os
 
-from datasets import interleave_datasets, load_dataset, load_from_disk
+import torch.distributed as dist
+from datasets import Dataset, DatasetDict, IterableDatasetDict, interleave_datasets, load_dataset, load_from_disk
+from datasets.distributed import split_dataset_by_node
 from transformers import AutoTokenizer
 
 
@@ -32,6 +34,39 @@ def get_strategy(args):
     return strategy
 
 
+def load_data(dataset, strategy, data_dir=None, streaming=False):
+    dataset_basename = os.path.basename(dataset)
+
+    ext = os.path.splitext(dataset)[-1]
+    # local python script
+    if ext == ".py" or (
+        os.path.isdir(dataset) and os.path.exists(os.path.join(dataset, f"{dataset_basename}.py"))
+    ):
+        data = load_dataset(dataset, trust_remote_code=True, streaming=streaming)
+        strategy.print(f"loaded {dataset} with python script")
+    # local text file
+    elif ext in [".json", ".jsonl", ".csv", ".parquet"]:
+        ext = ext.lower().strip(".")
+        if ext == "jsonl":
+            ext = "json"
+        data = load_dataset(ext, data_files=dataset, streaming=streaming)
+        strategy.print(f"loaded {dataset} with data_files={dataset}")
+    # local dataset saved with `datasets.Dataset.save_to_disk`
+    elif os.path.isdir(dataset):
+        data = load_from_disk(dataset)
+        if streaming:
+            if isinstance(data, DatasetDict):
+                data = IterableDatasetDict({split: d.to_iterable_dataset() for split, d in data.items()})
+            else:
+                data = data.to_iterable_dataset()
+        strategy.print(f"loaded {dataset} from disk")
+    # remote/local folder or common file
+    else:
+        data = load_dataset(dataset, data_dir=data_dir, streaming=streaming)
+        strategy.print(f"loaded {dataset} from files")
+    return data
+
+
 def blending_datasets(
     datasets,
     probabilities,
@@ -42,7 +77,16 @@ def blending_datasets(
     stopping_strategy="first_exhausted",
     train_split="train",
     eval_split="test",
+    streaming=False,
 ):
+    """
+    Load the comma separated `datasets` and interleave them with the given sampling `probabilities`.
+
+    With `streaming`, the train datasets are never loaded in memory: they are returned as a shuffled
+    `IterableDataset` sharded across the data parallel ranks (and split across the dataloader workers by
+    `datasets`), which supports `state_dict` / `load_state_dict` to resume. The eval datasets are capped at
+    10000 samples per dataset and are still returned as a regular `Dataset`.
+    """
     datasets = datasets.split(",")
     probabilities = list(map(float, probabilities.split(",")))
     assert len(probabilities) == len(datasets)
@@ -55,30 +99,25 @@ def blending_datasets(
 
         data_dir = dataset.split("@")[1].strip() if "@" in dataset else None
         dataset = dataset.split("@")[0].strip()
-        dataset_basename = os.path.basename(dataset)
-
-        ext = os.path.splitext(dataset)[-1]
-        # local python script
-        if ext == ".py" or (
-            os.path.isdir(dataset) and os.path.exists(os.path.join(dataset, f"{dataset_basename}.py"))
-        ):
-            data = load_dataset(dataset, trust_remote_code=True)
-            strategy.print(f"loaded {dataset} with python script")
-        # local text file
-        elif ext in [".json", ".jsonl", ".csv"]:
-            ext = ext.lower().strip(".")
-            if ext == "jsonl":
-                ext = "json"
-            data = load_dataset(ext, data_files=dataset)
-            strategy.print(f"loaded {dataset} with data_files={dataset}")
-        # local dataset saved with `datasets.Dataset.save_to_disk`
-        elif os.path.isdir(dataset):
-            data = load_from_disk(dataset)
-            strategy.print(f"loaded {dataset} from disk")
-        # remote/local folder or common file
-        else:
-            data = load_dataset(dataset, data_dir=data_dir)
-            strategy.print(f"loaded {dataset} from files")
+        data = load_data(dataset, strategy, data_dir=data_dir, streaming=streaming)
+
+        if streaming:
+            if isinstance(data, IterableDatasetDict) and train_split not in data:
+                raise ValueError(f"Split {train_split} not found in {dataset}, available splits: {list(data.keys())}")
+            splits = data if isinstance(data, IterableDatasetDict) else {}
+            train_data = splits[train_split] if train_split in splits else data
+            train_data = train_data.take(int(max_count))
+            train_data_list.append(train_data)
+
+            if return_eval:
+                # the eval samples are loaded in memory and the size of the stream is unknown: take at most
+                # 10000 samples of the eval split, or 3% of max_count up to 10000 samples of the train split
+                if eval_split in splits:
+                    eval_data = splits[eval_split].take(min(int(max_count), 10000))
+                else:
+                    eval_data = train_data.take(min(int(max_count * 0.03), 10000))
+                eval_data_list.append(Dataset.from_list(list(eval_data)))
+            continue
 
         if train_split and train_split in data:
             train_data = data[train_split].select(range(min(max_count, len(data[train_split]))))
@@ -104,6 +143,14 @@ def blending_datasets(
         seed=seed,
         stopping_strategy=stopping_strategy,
     )
+    if streaming:
+        # the ranks of a ring attention group train on the same samples
+        ring_attn_size = getattr(strategy, "ring_attn_size", 1)
+        train_dataset = split_dataset_by_node(
+            train_dataset.shuffle(seed=seed),
+            rank=dist.get_rank() // ring_attn_size,
+            world_size=dist.get_world_size() // ring_attn_size,
+        )
     if return_eval:
         eval_dataset = interleave_datasets(
             eval_data_list,
@@ -0,0 +1,19 @@
+import pytest
+import torch
+
+from openrlhf.trainer.ppo_utils.experience_maker import NaiveExperienceMaker
+
+
+@pytest.fixture
+def experience_maker():
+    # the advantage / return helpers only depend on their arguments
+    return object.__new__(NaiveExperienceMaker)
+
+
+@pytest.fixture
+def random_action_mask():
+    def make(batch_size, length):
+        lengths = torch.randint(1, length + 1, (batch_size,))
+        return (torch.arange(length).unsqueeze(0) < lengths.unsqueeze(1)).float()
+
+    return make
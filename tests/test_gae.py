@@ -0,0 +1,66 @@
+import pytest
+import torch
+
+from openrlhf.models.utils import reverse_discounted_cumsum
+
+
+def loop_advantages_and_returns(values, rewards, action_mask, gamma, lambd):
+    # reference: the per-timestep loop get_advantages_and_returns used before the vectorized version
+    if action_mask is not None:
+        values = action_mask * values
+        rewards = action_mask * rewards
+
+    lastgaelam = 0
+    advantages_reversed = []
+    response_length = rewards.size(1)
+    for t in reversed(range(response_length)):
+        nextvalues = values[:, t + 1] if t < response_length - 1 else 0.0
+        delta = rewards[:, t] + gamma * nextvalues - values[:, t]
+        lastgaelam = delta + gamma * lambd * lastgaelam
+        advantages_reversed.append(lastgaelam)
+    advantages = torch.stack(advantages_reversed[::-1], dim=1)
+    returns = advantages + values
+    return advantages, returns
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("length", [1, 7, 256, 1000])
+@pytest.mark.parametrize("gamma,lambd", [(1.0, 1.0), (1.0, 0.95), (0.99, 0.95), (0.9, 0.5)])
+def test_padded_gae_matches_loop(experience_maker, random_action_mask, length, gamma, lambd):
+    torch.manual_seed(0)
+    values, rewards = torch.randn(8, length), torch.randn(8, length)
+    action_mask = random_action_mask(8, length)
+
+    advantages, returns = experience_maker.get_advantages_and_returns(values, rewards, action_mask, gamma, lambd)
+    expected_advantages, expected_returns = loop_advantages_and_returns(values, rewards, action_mask, gamma, lambd)
+    torch.testing.assert_close(advantages, expected_advantages, rtol=1e-4, atol=1e-4)
+    torch.testing.assert_close(returns, expected_returns, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("gamma,lambd", [(1.0, 0.95), (0.99, 0.95)])
+def test_packed_gae_matches_loop(experience_maker, gamma, lambd):
+    torch.manual_seed(0)
+    num_actions = torch.randint(1, 300, (16,)).tolist()
+    values = [torch.randn(n) for n in num_actions]
+    rewards = [torch.randn(n) for n in num_actions]
+
+    advantages, returns = experience_maker.get_advantages_and_returns(values, rewards, None, gamma, lambd)
+    for v, r, adv, ret in zip(values, rewards, advantages, returns):
+        expected_adv, expected_ret = loop_advantages_and_returns(v.unsqueeze(0), r.unsqueeze(0), None, gamma, lambd)
+        torch.testing.assert_close(adv, expected_adv.squeeze(0), rtol=1e-4, atol=1e-4)
+        torch.testing.assert_close(ret, expected_ret.squeeze(0), rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("chunk_size", [1, 3, 64, 4096])
+def test_reverse_discounted_cumsum_chunk_sizes(chunk_size):
+    torch.manual_seed(0)
+    x = torch.randn(4, 500)
+    expected = torch.zeros_like(x)
+    running = torch.zeros(4)
+    for t in reversed(range(500)):
+        running = x[:, t] + 0.97 * running
+        expected[:, t] = running
+    torch.testing.assert_close(reverse_discounted_cumsum(x, 0.97, chunk_size), expected, rtol=1e-4, atol=1e-4)
+
@@ -0,0 +1,74 @@
+import pytest
+import torch
+
+from openrlhf.models.utils import compute_reward
+from openrlhf.trainer.ppo_utils.experience_maker import pad_unpacked_samples
+
+
+def loop_cumulative_returns(rewards, action_mask, gamma):
+    # reference: the per-timestep loop get_cumulative_returns used before the vectorized version
+    if action_mask is not None:
+        rewards = action_mask * rewards
+    returns = torch.zeros_like(rewards)
+    cumulative_return = torch.zeros(rewards.size(0), device=rewards.device)
+    for t in reversed(range(rewards.size(1))):
+        cumulative_return = rewards[:, t] + gamma * cumulative_return
+        returns[:, t] = cumulative_return
+    return returns
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("gamma", [1.0, 0.99, 0.5])
+def test_padded_cumulative_returns_match_loop(experience_maker, random_action_mask, seed, gamma):
+    torch.manual_seed(seed)
+    length = torch.randint(1, 700, ()).item()
+    rewards = torch.randn(8, length)
+    action_mask = random_action_mask(8, length)
+
+    returns = experience_maker.get_cumulative_returns(rewards, action_mask, gamma)
+    torch.testing.assert_close(returns, loop_cumulative_returns(rewards, action_mask, gamma), rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("gamma", [1.0, 0.99])
+def test_packed_cumulative_returns_match_loop(experience_maker, seed, gamma):
+    torch.manual_seed(seed)
+    rewards = [torch.randn(n) for n in torch.randint(1, 300, (12,)).tolist()]
+
+    returns = experience_maker.get_cumulative_returns(rewards, None, gamma)
+    for r, ret in zip(rewards, returns):
+        expected = loop_cumulative_returns(r.unsqueeze(0), None, gamma).squeeze(0)
+        torch.testing.assert_close(ret, expected, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("concatenated", [False, True])
+def test_packed_compute_reward_matches_padded(seed, concatenated):
+    torch.manual_seed(seed)
+    num_actions = torch.randint(1, 200, (10,)).tolist()
+    kl = [torch.randn(n) for n in num_actions]
+    r = torch.randn(len(num_actions))
+
+    padded_kl, action_mask = pad_unpacked_samples(kl)
+    expected = compute_reward(r, 0.1, padded_kl, action_mask=action_mask)
+
+    packed_kl = torch.cat(kl).unsqueeze(0) if concatenated else kl
+    reward = compute_reward(r, 0.1, packed_kl, action_mask=None, num_actions=num_actions)
+    assert len(reward) == len(num_actions)
+    for i, n in enumerate(num_actions):
+        torch.testing.assert_close(reward[i], expected[i, :n], rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.unit
+def test_packed_compute_reward_clip_range():
+    torch.manual_seed(0)
+    num_actions = [3, 1, 5]
+    kl = [torch.zeros(n) for n in num_actions]
+    r = torch.tensor([-10.0, 0.5, 10.0])
+
+    reward = compute_reward(r, 0.1, kl, num_actions=num_actions, reward_clip_range=(-1.0, 1.0))
+    assert [x[-1].item() for x in reward] == [-1.0, 0.5, 1.0]
+    assert all((x[:-1] == 0).all() for x in reward)